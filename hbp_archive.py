@@ -74,9 +74,28 @@ Example Usage
 """
 
 from __future__ import division
+import bisect
+import calendar
+import collections
+import email.utils
 import getpass
+import hashlib
+import io
+import json
+import mimetypes
 import os
+import re
+import socket
+import sqlite3
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime
 from keystoneauth1.identity import v3
 from keystoneauth1 import session
@@ -95,12 +114,52 @@ try:
     raw_input
 except NameError:  # Python 3
     raw_input = input
+try:
+    from urllib.parse import quote, unquote
+except ImportError:
+    from urllib import quote, unquote  # Python 2
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from fsspec.spec import AbstractFileSystem, AbstractBufferedFile
+except ImportError:  # fsspec is only needed for HBPArchiveFileSystem
+    fsspec_available = False
+    AbstractFileSystem = AbstractBufferedFile = object
+else:
+    fsspec_available = True
 
 __version__ = "0.9.0"
 
 OS_AUTH_URL = 'https://pollux.cscs.ch:13000/v3'
 OS_IDENTITY_PROVIDER = 'cscskc'
 OS_IDENTITY_PROVIDER_URL = 'https://auth.cscs.ch/auth/realms/cscs/protocol/saml/'
+PUBLIC_STORAGE_URL = 'https://object.cscs.ch/v1'
+
+DOWNLOAD_CHUNK_SIZE = 1048576  # 1 MB
+CHECKPOINT_INTERVAL = 67108864  # 64 MB
+LISTING_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+BULK_MAX_BYTES = 268435456  # 256 MB
+BULK_MAX_FILES = 1000
+BULK_DELETE_MAX_FILES = 10000  # default limit of the Swift bulk middleware
+LISTING_PAGE_SIZE = 10000  # maximum number of files returned by Swift in one listing request
+LISTING_PROBE_WORKERS = 8  # number of parallel requests used to choose the ranges listed by `iter_files`
+CODEC_HEADER = 'X-Object-Meta-Codec'  # records the compression applied by `Container.upload`
+UNCOMPRESSED_SIZE_HEADER = 'X-Object-Meta-Uncompressed-Size'  # size of a compressed file before compression
+SEGMENT_SIZE = 67108864  # 64 MB, size of the segments of large files written with `Container.open`
+MIN_SEGMENT_SIZE = 1048576  # 1 MB, minimum size of the segments of a Swift static large object
+CONTAINER_SETTINGS_HEADERS = ('x-container-read', 'x-container-write', 'x-versions-location',
+                              'x-history-location', 'x-container-sync-to', 'x-container-sync-key',
+                              'x-storage-policy')  # container headers set by users, besides metadata
 
 logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
 logger = logging.getLogger("hbp_archive")
@@ -164,6 +223,472 @@ def set_logger(location="screen", level="INFO"):
             logging.basicConfig(filename=location, level=eval("logging.{}".format(level)))
 
 
+def _md5(local_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Return the hex MD5 digest of a local file, as used in Swift ETags."""
+    checksum = hashlib.md5()
+    with open(local_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _walk_directory(local_directory, remote_directory=""):
+    """Generate (local path, remote path) pairs for all files below a local directory."""
+    for dirpath, dirnames, filenames in os.walk(local_directory):
+        relative_dir = os.path.relpath(dirpath, local_directory)
+        parts = [] if relative_dir == os.curdir else relative_dir.split(os.sep)
+        if remote_directory:
+            parts.insert(0, remote_directory)
+        for filename in filenames:
+            yield os.path.join(dirpath, filename), "/".join(parts + [filename])
+
+
+def _iter_file(local_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Generate the contents of a local file in chunks."""
+    return _iter_fileobj(open(local_path, "rb"), chunk_size)
+
+
+def _iter_fileobj(fp, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Generate the contents of an open binary file in chunks, from its
+    current position, closing it at the end."""
+    with fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            yield chunk
+
+
+def _compressor(codec):
+    if codec == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 gives a gzip header
+    elif codec == "zstd":
+        if zstandard is None:
+            raise ImportError("Please install the 'zstandard' package to use zstd compression")
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError("Unknown codec '{}'. Options: 'gzip', 'zstd'".format(codec))
+
+
+def _decompressor(codec):
+    if codec == "gzip":
+        return zlib.decompressobj(31)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise ImportError("Please install the 'zstandard' package to read zstd-compressed files")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError("Unknown codec '{}'".format(codec))
+
+
+def _put_unless_stopped(items, item, stopped):
+    """Put `item` on the queue `items`, waiting for space unless the
+    consumer signals through the event `stopped` that it has gone away."""
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=1)
+            return
+        except queue.Full:
+            pass
+
+
+def _compress_file(local_path, codec, executor, stopped, max_queued_chunks=8):
+    """Start compressing a local file, and return a generator of the compressed contents.
+
+    Compression is performed by a task submitted to `executor` straight away,
+    so that it runs while the caller is sending earlier chunks, or earlier
+    files, over the network. At most `max_queued_chunks` chunks are held in
+    memory; the caller sets the event `stopped` to abandon the task.
+    """
+    chunks = queue.Queue(max_queued_chunks)
+
+    def put(item):
+        _put_unless_stopped(chunks, item, stopped)
+
+    def compress():
+        try:
+            compressor = _compressor(codec)
+            for chunk in _iter_file(local_path):
+                data = compressor.compress(chunk)
+                if data:
+                    put(data)
+            put(compressor.flush())
+            put(None)
+        except Exception as err:
+            put(err)
+
+    def iter_chunks():
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    executor.submit(compress)
+    return iter_chunks()
+
+
+def _decompress_chunks(codec, chunks):
+    decompressor = _decompressor(codec)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if hasattr(decompressor, "flush"):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def _decode_stream(headers, chunks):
+    """Decompress an iterator over the contents of a file, if the file was
+    compressed when uploaded. `headers` are the response headers, with lower-case keys."""
+    codec = headers.get(CODEC_HEADER.lower())
+    if codec:
+        return _decompress_chunks(codec, chunks)
+    return chunks
+
+
+def _decoded_size(headers, size):
+    """Return the size of the contents of a file of `size` bytes once decompressed,
+    from the response headers (with lower-case keys), or None if it is not known."""
+    if not headers.get(CODEC_HEADER.lower()):
+        return size
+    uncompressed_size = headers.get(UNCOMPRESSED_SIZE_HEADER.lower())
+    return int(uncompressed_size) if uncompressed_size else None
+
+
+def _slice_chunks(chunks, start, end=None):
+    """Return the bytes from `start` up to `end` (or the end) of the contents
+    given by an iterator over chunks, without retrieving any chunks beyond `end`."""
+    data = []
+    position = 0
+    for chunk in chunks:
+        if end is not None and position >= end:
+            break
+        if position + len(chunk) > start:
+            data.append(chunk[max(start - position, 0):None if end is None else end - position])
+        position += len(chunk)
+    if hasattr(chunks, "close"):
+        chunks.close()
+    return b"".join(data)
+
+
+def _range_ignored(headers, offset):
+    """Return True if the response (with lower-case `headers`) to a request for
+    the bytes of a file from `offset` onwards starts at the beginning of the
+    file instead, because the server ignored the Range header."""
+    return offset > 0 and "content-range" not in headers
+
+
+def _discard(stream, count, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """Read and discard up to `count` bytes from a file-like object."""
+    while count > 0:
+        data = stream.read(min(count, chunk_size))
+        if not data:
+            return
+        count -= len(data)
+
+
+def _retry(func, retries=3, backoff=1.0):
+    """Call `func`, retrying with exponential backoff after transient errors:
+    server errors, rate limiting and connection failures."""
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except (ClientException, IOError, socket.error) as err:
+            status = getattr(err, "http_status", None)
+            if attempt >= retries or (status is not None and status < 500 and status != 429):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+
+
+def _file_from_headers(container, file_path, headers):
+    """Create a File from the response headers (with lower-case keys) of a HEAD request."""
+    last_modified = headers.get("last-modified")
+    if last_modified:
+        last_modified = datetime(*email.utils.parsedate(last_modified)[:6]).strftime(LISTING_DATE_FORMAT)
+    f = File(name=file_path, bytes=int(headers.get("content-length", 0)),
+             content_type=headers.get("content-type"), hash=headers.get("etag", "").strip('"'),
+             last_modified=last_modified, container=container)
+    f.metadata = {key[len("x-object-meta-"):]: value for key, value in headers.items()
+                  if key.startswith("x-object-meta-")}
+    return f
+
+
+def _shard_of(name, num_shards):
+    """Return the shard to which a file path belongs, the same in every process."""
+    return (zlib.crc32(name.encode("utf-8")) & 0xffffffff) % num_shards
+
+
+def _timestamp(last_modified):
+    """Convert a last-modified date from a container listing to a Unix timestamp."""
+    return calendar.timegm(datetime.strptime(last_modified, LISTING_DATE_FORMAT).timetuple())
+
+
+def _iter_tar(members):
+    """Generate the bytes of a tar archive without buffering whole members.
+
+    `members` is an iterable of (TarInfo, chunks) pairs, where `chunks` is an
+    iterable of bytes whose total length must match `TarInfo.size`.
+    """
+    total = 0
+    for tarinfo, chunks in members:
+        header = tarinfo.tobuf(tarfile.PAX_FORMAT, "utf-8", "strict")
+        yield header
+        received = 0
+        for chunk in chunks:
+            received += len(chunk)
+            yield chunk
+        if received != tarinfo.size:
+            raise IOError("Size of '{}' changed during export: expected {} bytes, got {}".format(
+                tarinfo.name, tarinfo.size, received))
+        padding = -received % tarfile.BLOCKSIZE
+        yield tarfile.NUL * padding
+        total += len(header) + received + padding
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(total + end) % tarfile.RECORDSIZE
+    yield tarfile.NUL * end
+
+
+def _bulk_failures(response, container_name, num_files, count_keys):
+    """Return a dict of the files which the bulk middleware reports as failed,
+    with the reason, or None if the whole request failed.
+
+    Errors affecting the whole request are reported in the body of the response,
+    with a successful status code, so the "Response Status" field is checked,
+    and the number of files processed (the sum of the fields `count_keys`) is
+    compared with the number of files sent.
+    """
+    try:
+        report = response.json()
+    except ValueError:
+        return None
+    if "Errors" not in report:
+        return None
+    # error entries contain the quoted path "/<version>/<account>/<container>/<object>"
+    failed = dict((unquote(name).split("/{}/".format(container_name), 1)[-1], status)
+                  for name, status in report["Errors"])
+    if not failed and not report.get("Response Status", "200").startswith("2"):
+        return None
+    if sum(int(report.get(key) or 0) for key in count_keys) < num_files - len(failed):
+        return None
+    return failed
+
+
+def _iter_local_sorted(local_directory, relative_path=""):
+    """Generate listing entries for all files below a local directory, in
+    the same order as a Swift container listing (sorted by full path)."""
+    directory = os.path.join(local_directory, *relative_path.split("/"))
+    entries = []
+    for name in os.listdir(directory):
+        if os.path.isdir(os.path.join(directory, name)):
+            entries.append((name + "/", name, True))  # sort as "name/..." would
+        else:
+            entries.append((name, name, False))
+    for key, name, is_dir in sorted(entries):
+        if is_dir:
+            for entry in _iter_local_sorted(local_directory, relative_path + name + "/"):
+                yield entry
+        else:
+            local_path = os.path.join(directory, name)
+            yield {"name": relative_path + name, "bytes": os.path.getsize(local_path),
+                   "hash": None, "local_path": local_path}
+
+
+class DiffEntry(collections.namedtuple("DiffEntry", ["status", "name", "source", "target"])):
+    """A difference between two containers, reported by :meth:`Container.diff`.
+
+    `status` is 'added' (the file is only in the target), 'removed' (only in
+    the source), 'changed' (the size or checksum differs) or 'unchanged'.
+    `source` and `target` are the listing entries (dicts with keys 'name',
+    'bytes' and 'hash') for the file in each location, or None.
+    """
+    __slots__ = ()
+
+
+def _read_checkpoint(state_path):
+    """Return the contents of a checkpoint file, or None if missing or unreadable."""
+    try:
+        with open(state_path) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_checkpoint(state_path, etag, size, completed):
+    """Record the ETag of the object being downloaded and the byte ranges already on disk."""
+    with open(state_path, "w") as fp:
+        json.dump({"etag": etag, "bytes": size, "ranges": [[0, completed]]}, fp)
+
+
+class TransferResult(object):
+    """The outcome of transferring many files at once.
+
+    Attributes
+    ----------
+    completed : dict
+        Mapping from source path to destination path, for each file transferred
+        (or to the file contents, for :meth:`Container.read_many`, or to the
+        changes made, for :meth:`Project.set_access`).
+    skipped : list
+        Source paths which were not transferred, as an identical copy already
+        exists at the destination.
+    failed : dict
+        Mapping from source path to the exception raised when transferring it.
+    """
+
+    def __init__(self):
+        self.completed = {}
+        self.skipped = []
+        self.failed = {}
+
+    def __repr__(self):
+        return "TransferResult(completed={}, skipped={}, failed={})".format(
+            len(self.completed), len(self.skipped), len(self.failed))
+
+    @property
+    def ok(self):
+        """True if no transfers failed."""
+        return not self.failed
+
+
+class ScrubReport(object):
+    """The outcome of verifying the files in a container with :meth:`Container.scrub`.
+
+    Attributes
+    ----------
+    verified : int
+        Number of files whose contents match their checksum.
+    bytes_verified : int
+        Total size of the files verified.
+    corrupted : dict
+        Mapping from path to a description of the problem, for each file whose
+        contents do not match their checksum.
+    unverified : list
+        Paths of files which were read but have no checksum to compare with,
+        e.g. dynamic large objects.
+    failed : dict
+        Mapping from path to error message, for each file which could not be read.
+    """
+
+    def __init__(self, verified=0, bytes_verified=0, corrupted=None, unverified=None, failed=None):
+        self.verified = verified
+        self.bytes_verified = bytes_verified
+        self.corrupted = corrupted or {}
+        self.unverified = unverified or []
+        self.failed = failed or {}
+
+    def __repr__(self):
+        return "ScrubReport(verified={}, corrupted={}, unverified={}, failed={})".format(
+            self.verified, len(self.corrupted), len(self.unverified), len(self.failed))
+
+    @property
+    def ok(self):
+        """True if no files were found to be corrupted or unreadable."""
+        return not (self.corrupted or self.failed)
+
+
+class _RateLimiter(object):
+    """Limit the rate at which several threads transfer data, in bytes per second.
+
+    A rate of None means no limit.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Wait until `nbytes` more bytes may be transferred."""
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now) + nbytes / self.rate
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _KeySpace(object):
+    """Map the names in a container listing to integers, preserving their order,
+    so that names evenly spaced between two others can be found by interpolation.
+
+    Beyond their common prefix, names are treated as numbers with `digits`
+    digits, in a base given by the number of distinct characters in the
+    sample `names`, so that names made of only a few characters (e.g. decimal
+    or hexadecimal digits) are spread evenly.
+    """
+
+    def __init__(self, names, digits=8):
+        self.start = len(os.path.commonprefix(names))
+        self.prefix = names[0][:self.start]
+        self.alphabet = sorted(set(c for name in names for c in name[self.start:self.start + digits]))
+        self.base = len(self.alphabet) + 1  # 0 stands for the end of the name
+        self.digits = digits
+
+    def number(self, name):
+        """Return the position of `name` in the key space."""
+        value = 0
+        suffix = name[self.start:self.start + self.digits]
+        for i in range(self.digits):
+            digit = bisect.bisect_left(self.alphabet, suffix[i]) + 1 if i < len(suffix) else 0
+            value = value * self.base + min(digit, self.base - 1)
+        return value
+
+    def name(self, number):
+        """Return the name at position `number` in the key space."""
+        digits = []
+        for i in range(self.digits):
+            number, digit = divmod(number, self.base)
+            digits.append(digit)
+        chars = []
+        for digit in reversed(digits):
+            if digit == 0:
+                break
+            chars.append(self.alphabet[digit - 1])
+        return self.prefix + "".join(chars)
+
+
+class _ByteBudget(object):
+    """Limit the total number of bytes being transferred by several threads.
+
+    A capacity of None means no limit.
+    """
+
+    def __init__(self, capacity=None):
+        self.capacity = capacity
+        self.available = capacity
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes):
+        """Wait until `nbytes` are available, reserve them and return the amount reserved."""
+        if self.capacity is None:
+            return 0
+        nbytes = min(nbytes, self.capacity)
+        with self._condition:
+            while self.available < nbytes:
+                if self.capacity is None:
+                    return 0
+                self._condition.wait()
+            self.available -= nbytes
+        return nbytes
+
+    def release(self, nbytes):
+        if self.capacity is None:
+            return
+        with self._condition:
+            self.available += nbytes
+            self._condition.notify_all()
+
+    def stop(self):
+        """Remove the limit, releasing any threads waiting in :meth:`acquire`."""
+        with self._condition:
+            self.capacity = None
+            self._condition.notify_all()
+
+
 class File(object):
     """A representation of a file in a container.
 
@@ -184,7 +709,8 @@ class File(object):
     ====================================   ====================================
     """
 
-    def __init__(self, name, bytes, content_type, hash, last_modified, container=None):
+    def __init__(self, name, bytes, content_type, hash, last_modified, container=None, **extra):
+        # `extra` receives additional listing fields, e.g. "slo_etag" for static large objects
         self.name = name
         self.bytes = bytes
         self.content_type = content_type
@@ -192,6 +718,7 @@ class File(object):
         self.last_modified = last_modified
         self.container = container
         self.path = os.path.join(container.public_url, name) if container.public_url else name
+        self.metadata = None  # custom metadata (X-Object-Meta-*), only retrieved by `head_many`
 
     def __str__(self):
         return "'{}'".format(self.name)
@@ -239,7 +766,7 @@ class File(object):
              Path of file created inside specified local directory.
         """
         if self.container:
-            self.container.download(self.name, local_directory=local_directory, with_tree=with_tree, overwrite=overwrite)
+            return self.container.download(self.name, local_directory=local_directory, with_tree=with_tree, overwrite=overwrite)
         else:
             raise Exception("Parent container not known, unable to download")
 
@@ -330,7 +857,1605 @@ class File(object):
         return scale_bytes(self.bytes, units)
 
 
-class Container(object):
+class PrefixTree(object):
+    """An index of the files in a container, organised by pseudo-directory.
+
+    Each node holds the total size and number of files below it, so that
+    disk usage, directory listings and prefix queries do not require
+    scanning the full list of files.
+
+    The following actions can be performed:
+
+    ====================================   ====================================
+    Action                                 Method / Property
+    ====================================   ====================================
+    Get a subdirectory                     :meth:`find`
+    List contents of a directory           :meth:`ls`
+    Iterate over all files                 :meth:`iter_files`
+    Find files with a given prefix         :meth:`startswith`
+    Get size of each directory             :meth:`usage`
+    ====================================   ====================================
+    """
+
+    def __init__(self, name=""):
+        self.name = name
+        self.directories = {}
+        self.files = {}
+        self.bytes = 0
+        self.count = 0
+
+    def __repr__(self):
+        return "PrefixTree('{}', count={}, bytes={})".format(self.name, self.count, self.bytes)
+
+    @classmethod
+    def from_files(cls, files):
+        """Build a tree from an iterable of `hbp_archive.File` objects."""
+        tree = cls()
+        for f in files:
+            tree.add(f)
+        return tree
+
+    def add(self, f):
+        """Add a `hbp_archive.File` to the tree. Pseudo-directory markers
+        (objects whose name ends with "/") only create the directory."""
+        is_marker = f.name.endswith("/")
+        size, count = (0, 0) if is_marker else (f.bytes, 1)
+        node = self
+        parts = f.name.split("/")
+        node.bytes += size
+        node.count += count
+        for part in parts[:-1]:
+            child = node.directories.get(part)
+            if child is None:
+                child = node.directories[part] = PrefixTree(node.name + part + "/")
+            child.bytes += size
+            child.count += count
+            node = child
+        if not is_marker:
+            node.files[parts[-1]] = f
+
+    def find(self, directory_path):
+        """Return the subtree for the given directory, or None if it does not exist."""
+        node = self
+        for part in directory_path.strip("/").split("/"):
+            if part:
+                node = node.directories.get(part)
+                if node is None:
+                    return None
+        return node
+
+    def ls(self, directory_path=""):
+        """List the contents of a directory.
+
+        Returns
+        -------
+        list
+            Sorted list of the names of subdirectories (with a trailing "/")
+            and files directly within the directory.
+        """
+        node = self.find(directory_path)
+        if node is None:
+            raise ValueError("Directory '{}' does not exist".format(directory_path))
+        return sorted([name + "/" for name in node.directories] + list(node.files))
+
+    def iter_files(self):
+        """Generate all `hbp_archive.File` objects in this tree."""
+        for name in sorted(self.files):
+            yield self.files[name]
+        for name in sorted(self.directories):
+            for f in self.directories[name].iter_files():
+                yield f
+
+    def startswith(self, prefix):
+        """Generate the `hbp_archive.File` objects whose path starts with `prefix`."""
+        directory_path, _, partial = prefix.rpartition("/")
+        node = self.find(directory_path)
+        if node is None:
+            return
+        for name in sorted(node.files):
+            if name.startswith(partial):
+                yield node.files[name]
+        for name in sorted(node.directories):
+            if name.startswith(partial):
+                for f in node.directories[name].iter_files():
+                    yield f
+
+    def usage(self, depth=1, units='bytes'):
+        """Total size and number of files in each directory, down to the given depth.
+
+        Parameters
+        ----------
+        depth : int, optional
+            Number of directory levels to report. With depth 0, only the
+            total for the whole tree is given.
+        units : string, optional
+            Requested units for sizes.
+            Options: 'bytes' (default), 'kB', 'MB', 'GB', 'TB'
+
+        Returns
+        -------
+        OrderedDict
+            Mapping from directory path to a (size, count) tuple, sorted by path.
+        """
+        result = collections.OrderedDict()
+        stack = [(self, 0)]
+        while stack:
+            node, level = stack.pop()
+            result[node.name] = (scale_bytes(node.bytes, units), node.count)
+            if level < depth:
+                stack.extend((node.directories[name], level + 1)
+                             for name in sorted(node.directories, reverse=True))
+        return result
+
+
+class _ObjectReader(io.RawIOBase):
+    """A readable, seekable file-like object for a file in a container,
+    which retrieves the contents as they are read, with ranged requests after each seek."""
+
+    def __init__(self, container, file_path):
+        self.container = container
+        self.name = file_path
+        headers = container._head_object(file_path)
+        self._size = int(headers.get("content-length", 0))
+        self._etag = headers.get("etag")
+        self._codec = headers.get(CODEC_HEADER.lower())
+        self._position = 0
+        self._stream = None
+        self._leftover = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return not self._codec  # positions in compressed files are unknown until decompressed
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if not self.seekable():
+            raise io.UnsupportedOperation("Compressed files cannot be seeked")
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        if offset != self._position:
+            self._close_stream()
+            self._position = offset
+        return offset
+
+    def readinto(self, buffer):
+        if self._codec:
+            return self._readinto_decoded(buffer)
+        if self._position >= self._size:
+            return 0
+        if self._stream is None:
+            headers = None
+            if self._position > 0:
+                headers = {"Range": "bytes={}-".format(self._position), "If-Match": self._etag}
+            headers, self._stream = self.container._get_object_stream(self.name, headers=headers)
+            if _range_ignored(headers, self._position):
+                _discard(self._stream, self._position)
+        count = self._stream.readinto(buffer)
+        if not count:
+            raise IOError("Connection closed after {} of {} bytes of '{}'".format(
+                self._position, self._size, self.name))
+        self._position += count
+        return count
+
+    def readall(self):
+        if self._codec:
+            return super(_ObjectReader, self).readall()
+        buffer = bytearray(max(self._size - self._position, 0))
+        view = memoryview(buffer)
+        position = 0
+        while position < len(buffer):
+            position += self.readinto(view[position:])
+        return bytes(buffer)
+
+    def _readinto_decoded(self, buffer):
+        if self._stream is None:
+            headers, chunks = self.container._get_object(self.name)
+            self._stream = iter(_decode_stream(headers, chunks))
+        while not self._leftover:
+            self._leftover = next(self._stream, None)
+            if self._leftover is None:
+                self._leftover = b""
+                return 0
+        count = min(len(buffer), len(self._leftover))
+        buffer[:count] = self._leftover[:count]
+        self._leftover = self._leftover[count:]
+        self._position += count
+        return count
+
+    def _close_stream(self):
+        if self._stream is not None and hasattr(self._stream, "close"):
+            self._stream.close()
+        self._stream = None
+
+    def close(self):
+        self._close_stream()
+        super(_ObjectReader, self).close()
+
+
+class _ObjectWriter(io.RawIOBase):
+    """A writable file-like object which uploads the data written to a file in a container.
+
+    Data are held in memory until `segment_size` bytes have been written; if the
+    file is closed before then, they are uploaded with a single request. Larger
+    files are uploaded in segments, in parallel, to the container named
+    "<container>_segments", and a static large object manifest is created when
+    the file is closed. If an exception is raised within a `with` block, or if
+    the file is never closed, the file is not created and any segments already
+    uploaded are deleted.
+    """
+
+    def __init__(self, container, file_path, content_type=None, segment_size=SEGMENT_SIZE, workers=4):
+        if segment_size < MIN_SEGMENT_SIZE:
+            raise ValueError("segment_size must be at least {} bytes".format(MIN_SEGMENT_SIZE))
+        self.container = container
+        self.name = file_path
+        self.content_type = content_type or mimetypes.guess_type(file_path)[0]
+        self.segment_size = segment_size
+        self.workers = workers
+        self._buffer = bytearray()
+        self._segments = []  # (path, size, future returning the ETag) for each segment
+        self._segment_container = container.name + "_segments"
+        self._segment_prefix = None
+        self._executor = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        size = len(self._buffer)
+        self._buffer.extend(data)
+        count = len(self._buffer) - size  # in bytes, even for buffers of larger items
+        while len(self._buffer) > self.segment_size:
+            segment = bytes(self._buffer[:self.segment_size])
+            del self._buffer[:self.segment_size]
+            self._upload_segment(segment)
+        return count
+
+    def _upload_segment(self, data):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            self._segment_prefix = "{}/slo/{}/".format(self.name, uuid.uuid4().hex)
+            self.container.project._connection.put_container(self._segment_container)
+        # wait for a worker to be free, so that at most `workers` segments are held in memory
+        in_progress = [future for path, size, future in self._segments if not future.done()]
+        if len(in_progress) >= self.workers:
+            wait(in_progress, return_when=FIRST_COMPLETED)
+        for path, size, future in self._segments:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        path = "{}{:08d}".format(self._segment_prefix, len(self._segments))
+        self._segments.append((path, len(data), self._executor.submit(self._put, self._segment_container,
+                                                                      path, data)))
+
+    def _put(self, container_name, path, data, **kwargs):
+        etag = hashlib.md5(data).hexdigest()  # Swift rejects the upload if the data are corrupted in transit
+        _retry(lambda: self.container.project._connection.put_object(container_name, path, data,
+                                                                     content_length=len(data),
+                                                                     etag=etag, **kwargs))
+        return etag
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            replaced_segments = self._replaced_segments()
+            if self._executor is None:
+                self._put(self.container.name, self.name, bytes(self._buffer), content_type=self.content_type)
+            else:
+                if self._buffer:
+                    self._upload_segment(bytes(self._buffer))
+                manifest = [{"path": "/{}/{}".format(self._segment_container, path),
+                             "etag": future.result(), "size_bytes": size}
+                            for path, size, future in self._segments]
+                _retry(lambda: self.container.project._connection.put_object(
+                    self.container.name, self.name, json.dumps(manifest),
+                    content_type=self.content_type, query_string="multipart-manifest=put"))
+            self.container._metadata = None  # needs to be refreshed
+        except Exception:
+            self.abort()
+            raise
+        else:
+            self._delete_segments(replaced_segments)
+        finally:
+            self._buffer = bytearray()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            super(_ObjectWriter, self).close()
+
+    def abort(self):
+        """Discard the data written, deleting any segments already uploaded."""
+        if self.closed:
+            return
+        if self._executor is not None:
+            for path, size, future in self._segments:
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._delete_segments([path for path, size, future in self._segments
+                                   if not future.cancelled() and future.exception() is None])
+        self._buffer = bytearray()
+        super(_ObjectWriter, self).close()
+
+    def _replaced_segments(self):
+        """Return the paths of the segments uploaded by a previous `_ObjectWriter`
+        for the file being replaced, which are no longer needed once it is."""
+        try:
+            headers = self.container.project._connection.head_object(self.container.name, self.name)
+        except ClientException as err:
+            if err.http_status == 404:
+                return []
+            raise
+        if headers.get("x-static-large-object", "").lower() != "true":
+            return []
+        metadata = self.container.metadata
+        if metadata.get("x-versions-location") or metadata.get("x-history-location"):
+            return []  # kept as the segments of the previous version
+        container_prefix = "/{}/".format(self._segment_container)
+        return [segment["name"][len(container_prefix):] for segment in self.container._get_slo_manifest(self.name)
+                if segment["name"].startswith("{}{}/slo/".format(container_prefix, self.name))]
+
+    def _delete_segments(self, paths):
+        for path in paths:
+            try:
+                self.container.project._connection.delete_object(self._segment_container, path)
+            except ClientException as err:
+                logger.warning("Unable to delete segment '{}': {}".format(path, err))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # unlike other files, a file which was never closed is discarded
+        # rather than written, as its contents may be incomplete
+        if not self.closed and hasattr(self, "_segments"):
+            self.abort()
+
+
+class _TextObjectWriter(io.TextIOWrapper):
+    """Text wrapper for `_ObjectWriter` which, like it, discards the data
+    written if an exception is raised within a `with` block, or if it is
+    never closed."""
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.buffer.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        if not self.closed:
+            self.buffer.abort()
+
+
+class _BaseContainer(object):
+    """Functionality shared by :class:`Container` and :class:`PublicContainer`.
+
+    Subclasses must implement :meth:`_get_object`, :meth:`_get_object_stream`,
+    :meth:`_head_object` and :meth:`_get_listing_page`.
+    """
+
+    def _get_object(self, file_path, headers=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Return the response headers (with lower-case keys) and an iterator
+        over the contents of a file, in chunks of `chunk_size` bytes."""
+        raise NotImplementedError
+
+    def _head_object(self, file_path):
+        """Return the headers (with lower-case keys) for a file."""
+        raise NotImplementedError
+
+    def _get_object_stream(self, file_path, headers=None):
+        """Return the response headers (with lower-case keys) and the raw
+        response stream for a file, which must support `readinto()`."""
+        raise NotImplementedError
+
+    def _get_slo_manifest(self, file_path):
+        """Return the list of segments of a static large object."""
+        raise NotImplementedError
+
+    def _get_listing_page(self, prefix=None, marker=None, end_marker=None, limit=LISTING_PAGE_SIZE,
+                          delimiter=None, reverse=False):
+        """Return one page of the container listing, as a list of dicts.
+        With `reverse`, the listing is in descending order of name."""
+        raise NotImplementedError
+
+    def _iter_listing_pages(self, prefix=None, marker=None, end_marker=None, delimiter=None):
+        """Generate the pages of the container listing between `marker` and
+        `end_marker` (both exclusive)."""
+        while True:
+            page = self._get_listing_page(prefix=prefix, marker=marker, end_marker=end_marker,
+                                          delimiter=delimiter)
+            # as for swiftclient's `full_listing`, only an empty page ends the listing,
+            # since servers may return fewer entries than requested
+            if not page:
+                return
+            yield page
+            marker = page[-1].get("name", page[-1].get("subdir"))
+
+    def _iter_listing(self, prefix=None, marker=None, end_marker=None, delimiter=None):
+        """Generate the entries of the container listing, sorted by name,
+        retrieving one page at a time. With a delimiter, entries for
+        pseudo-directories have a "subdir" key instead of "name"."""
+        for page in self._iter_listing_pages(prefix=prefix, marker=marker, end_marker=end_marker,
+                                             delimiter=delimiter):
+            for entry in page:
+                yield entry
+
+    def _sample_split_points(self, prefix, num_points, max_depth=3):
+        """Choose up to `num_points` file paths which divide the listing of the
+        container into ranges, using the names of the top-level directories
+        and files below `prefix` (descending into a directory if it is the only one).
+
+        If there are more names than fit in one page of the listing, points
+        are spread between the first and the last name, found with a reverse
+        listing, rather than chosen from the first page only.
+        """
+        prefix = prefix or ""
+        for depth in range(max_depth):
+            names = [entry.get("subdir", entry.get("name"))
+                     for entry in self._get_listing_page(prefix=prefix or None, delimiter="/")]
+            if len(names) == 1 and names[0].endswith("/"):
+                prefix = names[0]
+            else:
+                break
+        if len(names) < 2:
+            return []
+        if self._get_listing_page(prefix=prefix or None, marker=names[-1], limit=1, delimiter="/"):
+            points = self._probe_split_points(prefix, names, num_points)
+            if points is not None:
+                return points
+        step = max(len(names) / (num_points + 1), 1)
+        points = sorted(set(names[int(i * step)] for i in range(1, num_points + 1) if int(i * step) < len(names)))
+        return [point for point in points if point > names[0]]
+
+    def _probe_split_points(self, prefix, names, num_points):
+        """Choose up to `num_points` names evenly spaced in the key space between
+        the first of `names` (the first page of the listing) and the last name
+        in the listing. Each point is the first name after an interpolated
+        marker, found with a request for a single entry.
+
+        Returns None if the server does not support reverse listings.
+        """
+        last = self._get_listing_page(prefix=prefix or None, limit=1, delimiter="/", reverse=True)
+        last = last[0].get("subdir", last[0].get("name")) if last else None
+        if last is None or last <= names[-1]:
+            return None
+        keys = _KeySpace(names + [last])
+        low, high = keys.number(names[0]), keys.number(last)
+        markers = [keys.name(low + (high - low) * i // (num_points + 1)) for i in range(1, num_points + 1)]
+
+        def probe(marker):
+            page = self._get_listing_page(prefix=prefix or None, marker=marker, limit=1, delimiter="/")
+            return page[0].get("subdir", page[0].get("name")) if page else None
+
+        with ThreadPoolExecutor(max_workers=LISTING_PROBE_WORKERS) as executor:
+            points = set(executor.map(probe, markers))
+        return sorted(point for point in points if point is not None and point > names[0])
+
+    def sample_split_points(self, num_points, prefix=None):
+        """Choose file paths which divide the listing of the container into ranges.
+
+        The result can be passed as `split_points` to :meth:`iter_files` or
+        :meth:`download_directory` with `partition='range'`, so that
+        processes working on different shares of a container all use the
+        same ranges, even if the container changes while they run:
+
+        .. code-block:: python
+
+            # once, e.g. in the job submission script
+            split_points = container.sample_split_points(num_shards - 1)
+            # then, in each process
+            container.download_directory("", shard=rank, num_shards=num_shards,
+                                         partition="range", split_points=split_points)
+
+        Parameters
+        ----------
+        num_points : int
+            Maximum number of split points, i.e. one less than the number of ranges.
+        prefix : string, optional
+            only consider files whose path starts with this prefix.
+
+        Returns
+        -------
+        list
+            Sorted list of file paths (or path prefixes), which may be
+            shorter than `num_points` if the container has few files.
+        """
+        return self._sample_split_points(prefix, num_points)
+
+    def iter_files(self, prefix=None, workers=1, split_points=None, ordered=True,
+                   shard=None, num_shards=None, partition="hash"):
+        """Generate the files in the container, without retrieving the whole listing first.
+
+        With more than one worker, the listing is divided into ranges of file
+        paths, which are retrieved in parallel. This is much faster for
+        containers with very many files.
+
+        With `shard` and `num_shards`, only one of `num_shards` disjoint subsets
+        of the files is generated. Every process computes the same subsets, so
+        independent processes, e.g. on different nodes of a cluster, can each
+        work on their own share of a container without coordination:
+
+        .. code-block:: python
+
+            rank, size = int(os.environ["SLURM_PROCID"]), int(os.environ["SLURM_NTASKS"])
+            for f in container.iter_files(shard=rank, num_shards=size):
+                process(f)
+
+        Parameters
+        ----------
+        prefix : string, optional
+            only list files whose path starts with this prefix.
+        workers : int, optional
+            Number of ranges to list in parallel.
+        split_points : list of strings, optional
+            File paths (or path prefixes) at which to divide the listing. If
+            not given, they are chosen from the names of the top-level directories.
+            With `partition='range'`, these define the subsets: subset `shard`
+            is the range between split points `shard - 1` and `shard`.
+        ordered : boolean, optional
+            If True (default), files are generated in order of path, as for
+            :meth:`list`. If False, files are generated in whichever order
+            they are received, which uses less memory.
+        shard : int, optional
+            Index of the subset of files to generate, from 0 to `num_shards` - 1.
+        num_shards : int, optional
+            Number of subsets into which the files are divided.
+        partition : string, optional
+            How files are assigned to subsets. With 'hash' (default), by a hash of
+            the file path, which gives subsets of similar size, but each process
+            retrieves the whole listing. With 'range', each subset is a range of
+            file paths between top-level directories, so each process retrieves
+            only its own part of the listing, but the subsets may be unbalanced
+            and, if there are fewer top-level directories than shards, some are empty.
+            Unless `split_points` is given, each process chooses the ranges
+            from the current listing, so the subsets are only consistent
+            between processes if the container does not change in the
+            meantime. To avoid this, choose the split points once with
+            :meth:`sample_split_points` and pass them to every process.
+
+        Yields
+        ------
+        `hbp_archive.File`
+        """
+        if num_shards is not None:
+            if shard is None or not 0 <= shard < num_shards:
+                raise ValueError("shard must be between 0 and num_shards - 1")
+            if partition == "hash":
+                for f in self.iter_files(prefix=prefix, workers=workers, split_points=split_points,
+                                         ordered=ordered):
+                    if _shard_of(f.name, num_shards) == shard:
+                        yield f
+            elif partition == "range":
+                if split_points is None:
+                    split_points = self._sample_split_points(prefix, num_shards - 1)
+                elif len(set(split_points)) >= num_shards:
+                    raise ValueError("At most num_shards - 1 split points can be given")
+                bounds = [None] + sorted(set(split_points)) + [None]
+                if shard + 1 < len(bounds):
+                    marker, end_marker = bounds[shard], bounds[shard + 1]
+                    # as below, each range ends just after the next split point
+                    for entry in self._iter_listing(prefix=prefix, marker=marker,
+                                                    end_marker=end_marker + "\x01" if end_marker else None):
+                        yield File(container=self, **entry)
+            else:
+                raise ValueError("partition must be 'hash' or 'range'")
+            return
+        if split_points is None:
+            split_points = self._sample_split_points(prefix, 4 * workers) if workers > 1 else []
+        split_points = sorted(set(split_points))
+        if not split_points:
+            for entry in self._iter_listing(prefix=prefix):
+                yield File(container=self, **entry)
+            return
+
+        # Both "marker" and "end_marker" are exclusive, so each range ends just
+        # after the next split point; names cannot contain a null character.
+        bounds = [None] + split_points
+        ranges = [(bounds[i], bounds[i + 1] + "\x01" if i + 1 < len(bounds) else None)
+                  for i in range(len(bounds))]
+        done = object()
+        stopped = threading.Event()
+        if ordered:
+            queues = [queue.Queue(4) for r in ranges]
+        else:
+            queues = [queue.Queue(4 * workers)] * len(ranges)
+
+        def list_range(index):
+            marker, end_marker = ranges[index]
+            try:
+                for page in self._iter_listing_pages(prefix=prefix, marker=marker, end_marker=end_marker):
+                    if stopped.is_set():
+                        return
+                    _put_unless_stopped(queues[index], page, stopped)
+                _put_unless_stopped(queues[index], done, stopped)
+            except Exception as err:
+                _put_unless_stopped(queues[index], err, stopped)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(list_range, index) for index in range(len(ranges))]
+            try:
+                remaining = len(ranges)
+                current = 0
+                while remaining:
+                    page = queues[current].get()
+                    if page is done:
+                        remaining -= 1
+                        if ordered:
+                            current += 1
+                    elif isinstance(page, Exception):
+                        raise page
+                    else:
+                        for entry in page:
+                            yield File(container=self, **entry)
+            finally:
+                # ranges not yet started are dropped; those in progress stop
+                # after their current page
+                stopped.set()
+                for future in futures:
+                    future.cancel()
+
+    def _local_path(self, file_path, local_directory, with_tree):
+        if with_tree:
+            local_directory = os.path.join(os.path.abspath(local_directory),
+                                           *os.path.dirname(file_path).split("/"))
+        return os.path.join(local_directory, os.path.basename(file_path))
+
+    def diff(self, other, prefix=None, include_unchanged=False):
+        """Compare the files in this container with those in another
+        container, or in a local directory.
+
+        Both listings are read page by page and compared as they arrive, so
+        memory use does not depend on the number of files.
+
+        Parameters
+        ----------
+        other : `hbp_archive.Container`, `hbp_archive.PublicContainer` or string
+            Container, or path of local directory, to compare with. Files in a
+            local directory are compared with the files in this container
+            whose path is `prefix` followed by the path relative to the directory.
+        prefix : string, optional
+            only compare files whose path starts with this prefix.
+        include_unchanged : boolean, optional
+            If True, also report files which are identical in both locations.
+
+        Yields
+        ------
+        `hbp_archive.DiffEntry`
+            One entry per file which is in only one location, or which differs
+            in size or checksum (ETag), in order of file path. Files compressed
+            on upload are compared by their contents after decompression,
+            which are retrieved if the stored size or checksum differs.
+        """
+        source = self._iter_listing(prefix=prefix)
+        if isinstance(other, _BaseContainer):
+            target = other._iter_listing(prefix=prefix)
+        else:
+            def local_entries(prefix=prefix or ""):
+                for entry in _iter_local_sorted(other):
+                    entry["name"] = prefix + entry["name"]
+                    yield entry
+            target = local_entries()
+
+        sentinel = {"name": None}
+        source_entry = next(source, sentinel)
+        target_entry = next(target, sentinel)
+        while source_entry is not sentinel or target_entry is not sentinel:
+            if target_entry is sentinel or (source_entry is not sentinel
+                                            and source_entry["name"] < target_entry["name"]):
+                yield DiffEntry("removed", source_entry["name"], source_entry, None)
+                source_entry = next(source, sentinel)
+            elif source_entry is sentinel or target_entry["name"] < source_entry["name"]:
+                yield DiffEntry("added", target_entry["name"], None, target_entry)
+                target_entry = next(target, sentinel)
+            else:
+                status = "unchanged" if self._same_contents(source_entry, other, target_entry) else "changed"
+                if status == "changed" or include_unchanged:
+                    yield DiffEntry(status, source_entry["name"], source_entry, target_entry)
+                source_entry = next(source, sentinel)
+                target_entry = next(target, sentinel)
+
+    def _same_contents(self, source_entry, other, target_entry):
+        """Return True if the file with listing entry `source_entry` in this
+        container has the same contents as the file with `target_entry` in
+        `other` (a container or local directory)."""
+        if source_entry["bytes"] == target_entry["bytes"]:
+            if target_entry["hash"] is None:  # local file, only hashed if sizes match
+                target_entry["hash"] = _md5(target_entry["local_path"])
+            if source_entry["hash"] == target_entry["hash"]:
+                return True
+        # the stored contents differ, but may be the same once decompressed
+        source = self._decoded_checksum(source_entry["name"])
+        target = None
+        if isinstance(other, _BaseContainer):
+            target = other._decoded_checksum(target_entry["name"])
+        if source is None and target is None:
+            return False
+        source = source or (source_entry["bytes"], source_entry["hash"])
+        if target is None:
+            if target_entry["hash"] is None and target_entry["bytes"] == source[0]:
+                target_entry["hash"] = _md5(target_entry["local_path"])
+            target = (target_entry["bytes"], target_entry["hash"])
+        return source == target
+
+    def _decoded_checksum(self, file_path):
+        """Return the size and MD5 checksum of the contents of a compressed
+        file after decompression, or None if the file is not compressed."""
+        if not self._head_object(file_path).get(CODEC_HEADER.lower()):
+            return None
+        headers, chunks = self._get_object(file_path)
+        checksum = hashlib.md5()
+        size = 0
+        for chunk in _decode_stream(headers, chunks):
+            checksum.update(chunk)
+            size += len(chunk)
+        return size, checksum.hexdigest()
+
+    def tree(self, prefix=None):
+        """Return an index of the files in the container, organised by directory.
+
+        Parameters
+        ----------
+        prefix : string, optional
+            only include files whose path starts with this prefix.
+
+        Returns
+        -------
+        `hbp_archive.PrefixTree`
+            Tree built from a single listing of the container, added to the
+            tree page by page as it is retrieved.
+        """
+        return PrefixTree.from_files(self.iter_files(prefix=prefix))
+
+    def usage(self, depth=1, units='bytes', prefix=None):
+        """Total size and number of files in each directory of the container.
+
+        Parameters
+        ----------
+        depth : int, optional
+            Number of directory levels to report.
+        units : string, optional
+            Requested units for sizes.
+            Options: 'bytes' (default), 'kB', 'MB', 'GB', 'TB'
+        prefix : string, optional
+            only include files whose path starts with this prefix.
+
+        Returns
+        -------
+        OrderedDict
+            Mapping from directory path to a (size, count) tuple, sorted by
+            path. The entry with key "" gives the total.
+        """
+        return self.tree(prefix=prefix).usage(depth=depth, units=units)
+
+    def read_into(self, file_path, buffer, offset=0):
+        """Read the contents of a file directly into a writable buffer, such as a
+        bytearray, memoryview or NumPy array, without intermediate copies.
+
+        Parameters
+        ----------
+        file_path : string
+            Path of file to be retrieved.
+        buffer : writable buffer
+            Destination of the data. At most `len(buffer)` bytes are read,
+            so a byte range of the file can be read by passing a smaller buffer.
+            On Python 2, the buffer must be a one-dimensional buffer of bytes.
+        offset : int, optional
+            Position in the file of the first byte to read. For files compressed
+            on upload, this is a position in the decompressed contents, and
+            the file is retrieved and decompressed from the beginning.
+
+        Returns
+        -------
+        int
+            Number of bytes read, which is less than the size of the buffer
+            if the end of the file is reached first.
+        """
+        view = memoryview(buffer)
+        if view.readonly:
+            raise ValueError("buffer is read-only")
+        if view.ndim != 1 or view.itemsize != 1:
+            if not hasattr(view, "cast"):  # Python 2
+                raise ValueError("buffer must be a one-dimensional buffer of bytes")
+            view = view.cast("B")
+        if len(view) == 0:
+            return 0
+        range_header = {"Range": "bytes={}-{}".format(offset, offset + len(view) - 1)}
+        try:
+            headers, stream = self._get_object_stream(file_path, headers=range_header)
+        except ClientException as err:
+            if err.http_status != 416:
+                raise
+            # the offset is beyond the end of the stored file, which for a
+            # compressed file may still be within the decompressed contents
+            if not self._head_object(file_path).get(CODEC_HEADER.lower()):
+                return 0
+            return self._read_decoded_into(file_path, view, offset)
+        try:
+            if headers.get(CODEC_HEADER.lower()):
+                # byte ranges refer to the compressed data, so decompress from the beginning
+                return self._read_decoded_into(file_path, view, offset)
+            if _range_ignored(headers, offset):
+                _discard(stream, offset)
+            position = 0
+            while position < len(view):
+                count = stream.readinto(view[position:])
+                if not count:
+                    break
+                position += count
+            return position
+        finally:
+            stream.close()
+
+    def _read_decoded_into(self, file_path, view, offset):
+        """Decompress a file, copying the bytes from `offset` onwards into the
+        memoryview `view` until it is full. Returns the number of bytes copied."""
+        headers, chunks = self._get_object(file_path)
+        position = 0
+        try:
+            for chunk in _decode_stream(headers, chunks):
+                if offset >= len(chunk):
+                    offset -= len(chunk)
+                    continue
+                chunk = memoryview(chunk)[offset:offset + len(view) - position]
+                offset = 0
+                view[position:position + len(chunk)] = chunk
+                position += len(chunk)
+                if position == len(view):
+                    break
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        return position
+
+    def open(self, file_path, mode="r", encoding="utf-8"):
+        """Open a file in the container as a file-like object, for reading
+        without downloading the file first.
+
+        Data are retrieved as they are read; seeking to another position
+        starts a new request from that position.
+
+        Parameters
+        ----------
+        file_path : string
+            Path of file to be opened.
+        mode : string, optional
+            'r' (default) to read text, 'rb' to read bytes.
+        encoding : string, optional
+            Encoding used to decode text (default: 'utf-8').
+
+        Returns
+        -------
+        file-like object
+        """
+        if mode not in ("r", "rb"):
+            raise ValueError("mode must be 'r' or 'rb'")
+        fp = io.BufferedReader(_ObjectReader(self, file_path), buffer_size=DOWNLOAD_CHUNK_SIZE)
+        if mode == "r":
+            return io.TextIOWrapper(fp, encoding=encoding)
+        return fp
+
+    def load_array(self, file_path, dtype, shape, offset=0, order="C"):
+        """Load a NumPy array stored as raw binary data, reading directly into
+        the memory of the array. Requires NumPy.
+
+        Parameters
+        ----------
+        file_path : string
+            Path of file to be retrieved.
+        dtype : data-type
+            Data type of the array elements, including byte order.
+        shape : int or tuple of ints
+            Shape of the array.
+        offset : int, optional
+            Position in the file of the start of the array data, e.g. to skip a header.
+        order : {'C', 'F'}, optional
+            Memory layout of the data in the file.
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        if numpy is None:
+            raise ImportError("Please install NumPy to use load_array()")
+        array = numpy.empty(shape, dtype=dtype, order=order)
+        count = self.read_into(file_path, array.ravel(order="K").view(numpy.uint8), offset=offset)
+        if count != array.nbytes:
+            raise IOError("'{}' contains {} bytes after offset {}, expected {}".format(
+                file_path, count, offset, array.nbytes))
+        return array
+
+    def iter_contents(self, files, prefetch=4, max_prefetch_bytes=268435456):
+        """Generate the contents of several files, in order, while the
+        following files are retrieved in the background, so that processing
+        each file overlaps with retrieving the next ones.
+
+        .. code-block:: python
+
+            for f, contents in container.iter_contents(container.list(extension=".json")):
+                process(json.loads(contents))
+
+        Parameters
+        ----------
+        files : iterable of `hbp_archive.File` objects
+            Files to be read, e.g. from :meth:`list` or :meth:`iter_files`.
+        prefetch : int, optional
+            Maximum number of files to retrieve ahead of the one being processed.
+        max_prefetch_bytes : int, optional
+            Maximum total size of the files held in memory ahead of being
+            processed (default 256 MB).
+
+        Yields
+        ------
+        tuple
+            (File, contents) for each file. `contents` is a bytes object, except
+            for files larger than `max_prefetch_bytes`, which are not retrieved in
+            advance and for which `contents` is an iterator over chunks of bytes.
+        """
+        for f, size, chunks in self._prefetch(files, prefetch, max_prefetch_bytes):
+            if isinstance(chunks, list):
+                yield f, chunks[0]
+            else:
+                yield f, chunks
+
+    def read_many(self, file_paths, decode='utf-8', accept=[], workers=8, max_bytes_in_flight=None):
+        """Read the contents of several files in parallel.
+
+        A failure to read one file does not stop the others; failures are
+        listed in the returned :class:`TransferResult`.
+
+        Parameters
+        ----------
+        file_paths : list of strings or `hbp_archive.File` objects
+            Files to be read.
+        decode, accept
+            As for :meth:`read`.
+        workers : int, optional
+            Number of files to read in parallel.
+        max_bytes_in_flight : int, optional
+            Upper limit on the total size of the files being read at any one time.
+
+        Returns
+        -------
+        `hbp_archive.TransferResult`
+            Mapping of path to contents for each file read, and the exception
+            raised for each file that could not be read.
+        """
+        result = TransferResult()
+        for file_path, contents, err in self.iter_read_many(file_paths, decode=decode, accept=accept,
+                                                            workers=workers,
+                                                            max_bytes_in_flight=max_bytes_in_flight):
+            if err is None:
+                result.completed[file_path] = contents
+            else:
+                logger.warning("Unable to read '{}': {}".format(file_path, err))
+                result.failed[file_path] = err
+        return result
+
+    def head_many(self, file_paths, workers=8, retries=3):
+        """Retrieve the properties and custom metadata of several files in parallel.
+
+        Parameters
+        ----------
+        file_paths : list of strings
+            Paths of the files.
+        workers : int, optional
+            Number of requests to make in parallel.
+        retries : int, optional
+            Number of times to retry a request after a server or connection error.
+
+        Returns
+        -------
+        `hbp_archive.TransferResult`
+            Mapping of path to `hbp_archive.File` for each file, including its
+            custom metadata in `File.metadata`, and the exception raised for
+            each file whose metadata could not be retrieved.
+        """
+        def head_one(file_path):
+            headers = _retry(lambda: self._head_object(file_path), retries)
+            return _file_from_headers(self, file_path, headers)
+
+        return self._map_files(head_one, file_paths, workers, "retrieve metadata of")
+
+    def _map_files(self, func, file_paths, workers, description):
+        """Call `func` for each path in parallel, collecting the results and
+        exceptions in a :class:`TransferResult`."""
+        result = TransferResult()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(func, file_path): file_path for file_path in file_paths}
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    result.completed[file_path] = future.result()
+                except Exception as err:
+                    logger.warning("Unable to {} '{}': {}".format(description, file_path, err))
+                    result.failed[file_path] = err
+        return result
+
+    def iter_read_many(self, file_paths, decode='utf-8', accept=[], workers=8, max_bytes_in_flight=None):
+        """Read several files in parallel, generating the contents of each file
+        as soon as it has been retrieved.
+
+        Parameters are as for :meth:`read_many`. The contents of a file count
+        towards `max_bytes_in_flight` until the caller moves on to the next
+        file. If the limit is set, the size of files given as paths rather
+        than as `hbp_archive.File` objects is first obtained with a HEAD request.
+
+        Yields
+        ------
+        tuple
+            (path, contents, exception) for each file, in order of completion.
+            `exception` is None if the file was read successfully, otherwise
+            `contents` is None.
+        """
+        budget = _ByteBudget(max_bytes_in_flight)
+
+        def read_one(item):
+            if isinstance(item, File):
+                file_path, size = item.name, item.bytes
+            else:
+                file_path, size = item, 0
+                if max_bytes_in_flight:
+                    size = int(self._head_object(file_path).get("content-length", 0))
+            reserved = budget.acquire(size)
+            try:
+                return reserved, self.read(file_path, decode=decode, accept=accept)
+            except Exception:
+                budget.release(reserved)
+                raise
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = {executor.submit(read_one, item): getattr(item, "name", item) for item in file_paths}
+        try:
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    reserved, contents = future.result()
+                except Exception as err:
+                    yield file_path, None, err
+                else:
+                    try:
+                        yield file_path, contents, None
+                    finally:
+                        budget.release(reserved)
+        finally:
+            for future in futures:
+                future.cancel()
+            budget.stop()
+            executor.shutdown(wait=True)
+
+    def scrub(self, prefix=None, workers=4, max_bytes_per_second=None, checkpoint=None):
+        """Verify that the files in the container are intact, by reading each one
+        and comparing the MD5 checksum of its contents with its ETag.
+
+        The contents are discarded as they are read, so no disk space is needed.
+        For static large objects, each segment is checked against the manifest.
+
+        Parameters
+        ----------
+        prefix : string, optional
+            only verify files whose path starts with this prefix.
+        workers : int, optional
+            Number of files to read in parallel.
+        max_bytes_per_second : int, optional
+            Upper limit on the total rate at which data are read, so that an
+            audit can run in the background without saturating the network.
+        checkpoint : string, optional
+            Path of a local file in which progress is recorded. If the scrub is
+            interrupted, calling this method again with the same checkpoint
+            continues from where it stopped. The file is deleted once the scrub
+            is complete.
+
+        Returns
+        -------
+        `hbp_archive.ScrubReport`
+            Counts of files verified, and the files which are corrupted or could not be read.
+        """
+        state = (_read_checkpoint(checkpoint) if checkpoint else None) or {}
+        marker = state.pop("marker", None)
+        report = ScrubReport(**state)
+        limiter = _RateLimiter(max_bytes_per_second)
+
+        def save(marker):
+            with open(checkpoint, "w") as fp:
+                json.dump({"marker": marker, "verified": report.verified,
+                           "bytes_verified": report.bytes_verified, "corrupted": report.corrupted,
+                           "unverified": report.unverified, "failed": report.failed}, fp)
+
+        def record(f, future):
+            try:
+                problem = future.result()
+            except Exception as err:
+                logger.warning("Unable to read '{}': {}".format(f.name, err))
+                report.failed[f.name] = str(err)
+            else:
+                if problem is None:
+                    report.verified += 1
+                    report.bytes_verified += f.bytes
+                elif problem == "unverified":
+                    report.unverified.append(f.name)
+                else:
+                    logger.warning("'{}' is corrupted: {}".format(f.name, problem))
+                    report.corrupted[f.name] = problem
+
+        # files are submitted in order, so all files up to the first one still
+        # being read are finished, and the checkpoint records the last of these
+        files = (File(container=self, **entry) for entry in self._iter_listing(prefix=prefix, marker=marker))
+        pending = collections.OrderedDict()
+        last_saved = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                for f in files:
+                    pending[executor.submit(self._scrub_file, f, limiter)] = f
+                    if len(pending) >= 2 * workers:
+                        # wait for the oldest file, so that no more than
+                        # 2 * workers files are submitted at any time
+                        wait([next(iter(pending))])
+                    while pending and next(iter(pending)).done():
+                        future, done_file = pending.popitem(last=False)
+                        record(done_file, future)
+                        marker = done_file.name
+                    if checkpoint and time.time() - last_saved > 10:
+                        save(marker)
+                        last_saved = time.time()
+                for future, f in pending.items():
+                    record(f, future)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                if checkpoint:
+                    save(marker)
+                raise
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        logger.info("Scrub of {} complete: {}".format(self, report))
+        return report
+
+    def _scrub_file(self, f, limiter):
+        """Read a file, discarding the contents, and return None if it matches
+        its checksum, "unverified" if there is no checksum, or a description of the problem."""
+        headers, chunks = self._get_object(f.name)
+        if headers.get("x-static-large-object", "").lower() == "true":
+            return self._scrub_segments(headers, chunks, self._get_slo_manifest(f.name), limiter)
+        md5 = hashlib.md5()
+        for chunk in chunks:
+            limiter.consume(len(chunk))
+            md5.update(chunk)
+        if "x-object-manifest" in headers:  # dynamic large object: the ETag is not a checksum
+            return "unverified"
+        if md5.hexdigest() != f.hash:
+            return "MD5 checksum {} does not match ETag {}".format(md5.hexdigest(), f.hash)
+        return None
+
+    def _scrub_segments(self, headers, chunks, manifest, limiter):
+        """Check each segment of a static large object against its checksum in the manifest."""
+        if any("range" in segment or segment.get("sub_slo") for segment in manifest):
+            for chunk in chunks:
+                limiter.consume(len(chunk))
+            return "unverified"
+        # the ETag of a static large object is the MD5 checksum of the ETags of its segments
+        etag = hashlib.md5("".join(segment["hash"] for segment in manifest).encode("ascii")).hexdigest()
+        if etag != headers.get("etag", "").strip('"'):
+            return "manifest checksum {} does not match ETag {}".format(etag, headers.get("etag"))
+        problems = []
+        index = 0
+        remaining = manifest[0]["bytes"] if manifest else 0
+        md5 = hashlib.md5()
+        for chunk in chunks:
+            limiter.consume(len(chunk))
+            while chunk and index < len(manifest):
+                part = chunk[:remaining]
+                md5.update(part)
+                chunk = chunk[len(part):]
+                remaining -= len(part)
+                if remaining == 0:
+                    if md5.hexdigest() != manifest[index]["hash"]:
+                        problems.append("segment {} does not match its checksum".format(manifest[index]["name"]))
+                    index += 1
+                    remaining = manifest[index]["bytes"] if index < len(manifest) else 0
+                    md5 = hashlib.md5()
+            if chunk:
+                problems.append("object is longer than its segments")
+                break
+        if index < len(manifest):
+            problems.append("object is shorter than its segments")
+        return "; ".join(problems) or None
+
+    def download(self, file_path, local_directory=".", with_tree=True, overwrite=False,
+                 resume=True, retries=3):
+        """Download a file from the container.
+
+        The file is first written to "<local_path>.part", with a small
+        checkpoint file "<local_path>.part.json" recording the ETag of the
+        object and the bytes already received. If the transfer is interrupted,
+        it is retried, and later calls to this method continue where the
+        previous attempt stopped, provided the object has not changed.
+
+        Parameters
+        ----------
+        file_path : string
+            Path of file to be downloaded.
+        local_directory : string, optional
+            Local directory path where file is to be saved.
+        with_tree : boolean, optional
+            Specify if directory structure of file is to be retained.
+        overwrite : boolean, optional
+            Specify if any already existing file should be overwritten.
+        resume : boolean, optional
+            Specify if a partially downloaded file from a previous attempt
+            should be reused (default True).
+        retries : int, optional
+            Number of times in a row an interrupted transfer is resumed without
+            receiving any more data before giving up.
+
+        Returns
+        -------
+        string
+             Path of file created inside specified local directory.
+        """
+        # todo: allow file_path to be a File object
+        local_path = self._local_path(file_path, local_directory, with_tree)
+        return self._download_to(file_path, local_path, overwrite=overwrite, resume=resume, retries=retries)
+        # todo: check hash
+
+    def _download_to(self, file_path, local_path, overwrite=False, resume=True, retries=3, headers=None):
+        if not overwrite and os.path.exists(local_path):
+            raise IOError("Destination file '{}' already exists! Set `overwrite=True` to overwrite file.".format(local_path))
+        Path(os.path.dirname(local_path)).mkdir(parents=True, exist_ok=True)
+        part_path = local_path + ".part"
+        state_path = part_path + ".json"
+
+        if headers is None:
+            headers = self._head_object(file_path)
+        etag = headers.get("etag", "").strip('"')
+        size = int(headers.get("content-length", 0))
+        offset = 0
+        if resume and os.path.exists(part_path):
+            state = _read_checkpoint(state_path)
+            if state and state["etag"] == etag and state["bytes"] == size:
+                offset = min(state["ranges"][0][1], os.path.getsize(part_path))
+            else:
+                logger.info("'{}' has changed since the previous attempt, restarting download".format(file_path))
+
+        attempt = 0
+        while True:
+            try:
+                offset = self._download_part(file_path, part_path, state_path, etag, size, offset)
+                break
+            except (ClientException, IOError, socket.error, requests.exceptions.RequestException) as err:
+                changed = getattr(err, "http_status", None) in (412, 416)
+                received = 0
+                if not changed:
+                    state = _read_checkpoint(state_path)
+                    if state and state["etag"] == etag and os.path.exists(part_path):
+                        received = min(state["ranges"][0][1], os.path.getsize(part_path))
+                    if received > offset:
+                        attempt = 0  # only consecutive failures without progress count
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                if changed:
+                    # the object was replaced since the checkpoint was written
+                    logger.info("'{}' has changed during download, restarting".format(file_path))
+                    headers = self._head_object(file_path)
+                    etag = headers.get("etag", "").strip('"')
+                    size = int(headers.get("content-length", 0))
+                    offset = 0
+                else:
+                    offset = received
+                    logger.warning("Download of '{}' interrupted ({}), resuming from byte {}".format(
+                        file_path, err, offset))
+
+        if offset != size:
+            raise IOError("Incomplete download of '{}': received {} of {} bytes".format(file_path, offset, size))
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        codec = headers.get(CODEC_HEADER.lower())
+        if codec:
+            # the partial file holds the compressed data, so that the transfer can be resumed
+            with open(local_path, "wb") as local:
+                for chunk in _decompress_chunks(codec, _iter_file(part_path)):
+                    local.write(chunk)
+            os.remove(part_path)
+        else:
+            os.rename(part_path, local_path)
+        os.remove(state_path)
+        return local_path
+
+    def download_many(self, file_paths, local_directory=".", with_tree=True, overwrite=False,
+                      workers=4, max_bytes_in_flight=None):
+        """Download several files from the container in parallel.
+
+        Files are scheduled in the order given. A failure to download one file
+        does not stop the others; failures are listed in the returned
+        :class:`TransferResult`. If several files would be saved to the same
+        local path (e.g. files with the same name in different directories,
+        with `with_tree=False`), only the first is downloaded, and the others
+        are listed as failed.
+
+        Parameters
+        ----------
+        file_paths : list of strings or `hbp_archive.File` objects
+            Files to be downloaded.
+        local_directory : string, optional
+            Local directory path where files are to be saved.
+        with_tree : boolean, optional
+            Specify if directory structure of files is to be retained.
+        overwrite : boolean, optional
+            Specify if any already existing files should be overwritten.
+        workers : int, optional
+            Number of files to download in parallel.
+        max_bytes_in_flight : int, optional
+            Upper limit on the total size of the files being downloaded at any
+            one time. A single file larger than this limit is downloaded on its own.
+
+        Returns
+        -------
+        `hbp_archive.TransferResult`
+            Mapping of remote path to local path for each file downloaded,
+            and the exception raised for each file that could not be downloaded.
+        """
+        budget = _ByteBudget(max_bytes_in_flight)
+
+        def download_one(item, local_path):
+            if isinstance(item, File):
+                file_path, size, headers = item.name, item.bytes, None
+            else:
+                file_path = item
+                headers = self._head_object(file_path)
+                size = int(headers.get("content-length", 0))
+            reserved = budget.acquire(size)
+            try:
+                return self._download_to(file_path, local_path, overwrite=overwrite, headers=headers)
+            finally:
+                budget.release(reserved)
+
+        result = TransferResult()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            sources = {}  # remote path for each local path, as two files must not be written to the same place
+            for item in file_paths:
+                file_path = getattr(item, "name", item)
+                local_path = self._local_path(file_path, local_directory, with_tree)
+                if local_path in sources:
+                    if sources[local_path] != file_path:
+                        logger.warning("Not downloading '{}', as '{}' is also saved to '{}'".format(
+                            file_path, sources[local_path], local_path))
+                        result.failed[file_path] = Exception("'{}' is also saved to '{}'".format(
+                            sources[local_path], local_path))
+                    continue
+                sources[local_path] = file_path
+                futures[executor.submit(download_one, item, local_path)] = file_path
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    result.completed[file_path] = future.result()
+                except Exception as err:
+                    logger.warning("Unable to download '{}': {}".format(file_path, err))
+                    result.failed[file_path] = err
+        return result
+
+    def download_directory(self, directory_path, local_directory=".", with_tree=True, overwrite=False,
+                           workers=4, max_bytes_in_flight=None, shard=None, num_shards=None, partition="hash",
+                           split_points=None):
+        """Download all files within a directory of the container, in parallel.
+
+        With `shard` and `num_shards`, only one share of the files is downloaded,
+        so that the download can be divided between several processes or nodes
+        (see :meth:`iter_files`).
+
+        Parameters
+        ----------
+        directory_path : string
+            Path of directory to be downloaded. Use "" for the whole container.
+        local_directory : string, optional
+            Local directory path where files are to be saved.
+        with_tree : boolean, optional
+            Specify if directory structure of files is to be retained.
+        overwrite : boolean, optional
+            Specify if any already existing files should be overwritten.
+        workers : int, optional
+            Number of files to download in parallel.
+        max_bytes_in_flight : int, optional
+            Upper limit on the total size of the files being downloaded at any one time.
+        shard : int, optional
+            Index of the share of files to download, from 0 to `num_shards` - 1.
+        num_shards : int, optional
+            Number of shares into which the files are divided.
+        partition : string, optional
+            How files are assigned to shares: 'hash' (default) or 'range'. With
+            'range', each process lists only its own share of the files (see :meth:`iter_files`).
+        split_points : list of strings, optional
+            With `partition='range'`, the file paths dividing the shares, as
+            returned by :meth:`sample_split_points`. Give the same split points
+            to every process, as otherwise each process chooses them from the
+            current listing, and the shares may overlap or leave gaps if the
+            container changes in between.
+
+        Returns
+        -------
+        `hbp_archive.TransferResult`
+            Mapping of remote path to local path for each file downloaded,
+            and the exception raised for each file that could not be downloaded.
+        """
+        if directory_path and directory_path[-1] != '/':
+            directory_path += '/'
+        if num_shards is not None:
+            dir_files = list(self.iter_files(prefix=directory_path or None, shard=shard, num_shards=num_shards,
+                                             partition=partition, split_points=split_points))
+        else:
+            dir_files = self.list(prefix=directory_path or None)
+        if not dir_files and num_shards is None:
+            raise Exception("Specified directory '{}' does not exist in this container!".format(directory_path[:-1]))
+        # start with the largest files so that the workers finish at around the same time
+        dir_files = sorted(dir_files, key=lambda f: f.bytes, reverse=True)
+        return self.download_many(dir_files, local_directory=local_directory, with_tree=with_tree,
+                                  overwrite=overwrite, workers=workers, max_bytes_in_flight=max_bytes_in_flight)
+
+    def export_archive(self, directory_path, fileobj, format="tar", prefetch=4, max_prefetch_bytes=268435456):
+        """Write the files within a directory of the container to a tar or zip archive.
+
+        The archive is written directly to `fileobj` as the files are
+        retrieved, so no temporary disk space is needed and `fileobj` may be
+        a pipe or socket. The next few files are retrieved in the background
+        while the current one is being written.
+
+        Parameters
+        ----------
+        directory_path : string
+            Path of directory to be exported. Use "" for the whole container.
+        fileobj : file-like object
+            Writable binary file-like object to which the archive is written.
+        format : string, optional
+            Archive format: 'tar' (default) or 'zip' (requires Python 3.6 or later).
+        prefetch : int, optional
+            Maximum number of files to retrieve ahead of the one being written.
+        max_prefetch_bytes : int, optional
+            Maximum total size of the files held in memory ahead of being
+            written (default 256 MB). Larger files are streamed directly into the archive.
+
+        Returns
+        -------
+        list
+            List of `hbp_archive.File` objects written to the archive.
+        """
+        if format not in ("tar", "zip"):
+            raise ValueError("format must be 'tar' or 'zip'")
+        if format == "zip" and sys.version_info < (3, 6):
+            raise ValueError("Exporting to zip requires Python 3.6 or later")
+        if directory_path and directory_path[-1] != '/':
+            directory_path += '/'
+        dir_files = self.list(prefix=directory_path or None)
+
+        if format == "tar":
+            members = (self._tar_member(f, size, chunks)
+                       for f, size, chunks in self._prefetch(dir_files, prefetch, max_prefetch_bytes))
+            for block in _iter_tar(members):
+                fileobj.write(block)
+        else:
+            with zipfile.ZipFile(fileobj, mode="w", allowZip64=True) as archive:
+                for f, size, chunks in self._prefetch(dir_files, prefetch, max_prefetch_bytes):
+                    date_time = datetime.strptime(f.last_modified, LISTING_DATE_FORMAT).timetuple()[:6]
+                    info = zipfile.ZipInfo(f.name, date_time)
+                    with archive.open(info, mode="w", force_zip64=True) as member:
+                        for chunk in chunks:
+                            member.write(chunk)
+        return dir_files
+
+    def _tar_member(self, f, size, chunks):
+        """Return the TarInfo and the chunks of contents of a file, as generated
+        by :meth:`_prefetch`, to be written to a tar archive."""
+        if size is None:
+            # the header gives the size, so a compressed file whose size before
+            # compression is unknown is first decompressed to a temporary file
+            spool = tempfile.TemporaryFile()
+            for chunk in chunks:
+                spool.write(chunk)
+            size = spool.tell()
+            spool.seek(0)
+            chunks = _iter_fileobj(spool)
+        tarinfo = tarfile.TarInfo(f.name)
+        tarinfo.size = size
+        tarinfo.mtime = _timestamp(f.last_modified)
+        tarinfo.mode = 0o644
+        return tarinfo, chunks
+
+    def _read_bytes(self, f):
+        """Return the expected size (see :func:`_decoded_size`) and the
+        decompressed contents of a file."""
+        headers, contents = self._get_object(f.name)
+        contents = b"".join(_decode_stream(headers, contents))
+        size = _decoded_size(headers, f.bytes)
+        return len(contents) if size is None else size, contents
+
+    def _prefetch(self, files, prefetch, max_prefetch_bytes):
+        """Generate (File, size, chunks) triples for each of `files`, in order,
+        while retrieving up to `prefetch` of the following files in background threads.
+
+        Compressed files are decompressed; `size` is the size of the contents
+        after decompression, or None if this is not known in advance. Files
+        larger than `max_prefetch_bytes` are not retrieved in advance; their
+        chunks are streamed when the caller reaches them.
+        """
+        prefetch = max(prefetch, 1)
+        files = iter(files)
+        pending = collections.deque()
+        reserved = {}  # bytes counted towards `max_prefetch_bytes` for each file retrieved in advance
+        next_file = next(files, None)
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            while next_file is not None or pending:
+                # files are counted by their stored size until they have been
+                # retrieved, then by their size after decompression
+                for f, future in pending:
+                    if future is not None and future.done() and future.exception() is None:
+                        reserved[future] = len(future.result()[1])
+                buffered = sum(reserved.values())
+                while next_file is not None and len(pending) < prefetch:
+                    f = next_file
+                    if f.bytes > max_prefetch_bytes:
+                        pending.append((f, None))
+                    elif pending and buffered + f.bytes > max_prefetch_bytes:
+                        break
+                    else:
+                        future = executor.submit(self._read_bytes, f)
+                        pending.append((f, future))
+                        reserved[future] = f.bytes
+                        buffered += f.bytes
+                    next_file = next(files, None)
+                f, future = pending.popleft()
+                if future is None:
+                    headers, chunks = self._get_object(f.name)
+                    yield f, _decoded_size(headers, f.bytes), _decode_stream(headers, chunks)
+                else:
+                    size, contents = future.result()
+                    del reserved[future]
+                    yield f, size, [contents]
+
+    def _download_part(self, file_path, part_path, state_path, etag, size, offset):
+        """Fetch the bytes of `file_path` from `offset` onwards, appending them
+        to `part_path`. Returns the number of bytes on disk when done."""
+        _write_checkpoint(state_path, etag, size, offset)
+        headers = {}
+        if offset > 0:
+            headers = {"Range": "bytes={}-".format(offset), "If-Match": etag}
+        mode = "r+b" if offset > 0 else "wb"
+        with open(part_path, mode) as local:
+            local.seek(offset)
+            local.truncate()
+            if offset >= size:
+                return offset
+            last_checkpoint = offset
+            try:
+                response_headers, contents = self._get_object(file_path, headers=headers)
+                if _range_ignored(response_headers, offset):
+                    offset = 0  # start again from the beginning
+                    local.seek(0)
+                    local.truncate()
+                for chunk in contents:
+                    local.write(chunk)
+                    offset += len(chunk)
+                    if offset - last_checkpoint >= CHECKPOINT_INTERVAL:
+                        local.flush()
+                        _write_checkpoint(state_path, etag, size, offset)
+                        last_checkpoint = offset
+            finally:
+                local.flush()
+                _write_checkpoint(state_path, etag, size, offset)
+        return offset
+
+
+class Container(_BaseContainer):
     """A representation of a CSCS storage container. Can be used to operate both
     public and private CSCS containers. A CSCS account is needed to use this class.
 
@@ -342,18 +2467,34 @@ class Container(object):
     Get metadata about the container       :attr:`metadata`
     Get url if container is public         :attr:`public_url`
     List all files in container            :meth:`list`
+    List files using parallel requests     :meth:`iter_files`
+    Choose ranges for sharded jobs         :meth:`sample_split_points`
     Return a file from given path          :meth:`get`
     Get number of files in container       :meth:`count`
     Get total size of data in container    :meth:`size`
+    Get size of each directory             :meth:`usage`
+    Get index of files by directory        :meth:`tree`
     Upload file(s) to container            :meth:`upload`
+    Upload a directory tree to container   :meth:`upload_directory`
     Download a file from container         :meth:`download`
+    Download several files in parallel     :meth:`download_many`
+    Download a directory from container    :meth:`download_directory`
+    Export a directory as tar/zip archive  :meth:`export_archive`
     Read contents of file in container     :meth:`read`
+    Open a file as a file-like object      :meth:`open`
+    Read several files in parallel         :meth:`read_many`
+    Get metadata of several files          :meth:`head_many`
+    Update metadata of several files       :meth:`update_metadata`
+    Read files while prefetching the next  :meth:`iter_contents`
     Copy a file in container               :meth:`copy`
     Move a file in container               :meth:`move`
     Delete a file in container             :meth:`delete`
     Copy a directory in container          :meth:`copy_directory`
     Move a directory in container          :meth:`move_directory`
     Delete a directory  in container       :meth:`delete_directory`
+    Copy files to another container        :meth:`replicate_to`
+    Compare with a container or directory  :meth:`diff`
+    Verify integrity of stored files       :meth:`scrub`
     List users with access to container    :meth:`access_control`
     Grant container access to user         :meth:`grant_access`
     Revoke container access from user      :meth:`revoke_access`
@@ -400,11 +2541,12 @@ class Container(object):
             URL to access public container; returns None for private containers.
         """
         if "PUBLIC" in self.access_control()["read"]:
-            return "https://object.cscs.ch/v1/AUTH_{self.project.id}/{self.name}".format(self=self)
+            return "{}/AUTH_{self.project.id}/{self.name}".format(PUBLIC_STORAGE_URL, self=self)
         else:
             return None
 
-    def list(self, content_type=None, newer_than=None, older_than=None, contains_substring=None, extension=None):
+    def list(self, content_type=None, newer_than=None, older_than=None, contains_substring=None, extension=None,
+             prefix=None):
         """List all files in the container.
 
         Parameters
@@ -419,20 +2561,24 @@ class Container(object):
             substring to be matched for files to be listed.
         extension : string
             extension to be matched for files to be listed.
+        prefix : string
+            only list files whose path starts with this prefix
+            (filtered on the server).
 
         Returns
         -------
         list
             List of `hbp_archive.File` objects existing in container.
         """
-        self._metadata, contents = self.project._connection.get_container(self.name, full_listing=True)
+        self._metadata, contents = self.project._connection.get_container(self.name, prefix=prefix,
+                                                                          full_listing=True)
         contents = [File(container=self, **item) for item in contents]
         if content_type:
             contents = [item for item in contents if item.content_type==content_type]
         if newer_than and isinstance(newer_than, datetime):
-            contents = [item for item in contents if datetime.strptime(item.last_modified, '%Y-%m-%dT%H:%M:%S.%f') >= newer_than]
+            contents = [item for item in contents if datetime.strptime(item.last_modified, LISTING_DATE_FORMAT) >= newer_than]
         if older_than and isinstance(older_than, datetime):
-            contents = [item for item in contents if datetime.strptime(item.last_modified, '%Y-%m-%dT%H:%M:%S.%f') <= older_than]
+            contents = [item for item in contents if datetime.strptime(item.last_modified, LISTING_DATE_FORMAT) <= older_than]
         if contains_substring:
             contents = [item for item in contents if contains_substring in item.name]
         if extension:
@@ -483,7 +2629,9 @@ class Container(object):
         """
         return scale_bytes(int(self.metadata['x-container-bytes-used']), units)
 
-    def upload(self, local_paths, remote_directory="", overwrite=False):
+    def upload(self, local_paths, remote_directory="", overwrite=False, bulk=False,
+               bulk_max_bytes=BULK_MAX_BYTES, bulk_max_files=BULK_MAX_FILES, compress=None,
+               compress_workers=4, dedup=False, index=None):
         """Upload file(s) to the container.
 
         Parameters
@@ -494,6 +2642,32 @@ class Container(object):
             Remote directory path where data is to be uploaded. Default is root directory.
         overwrite : boolean, optional
             Specify if any already existing file at target should be overwritten.
+        bulk : boolean, optional
+            If True, files are packed into tar archives on the fly and each
+            archive is expanded into individual files by the server, so that
+            many small files need only a single request. Files which the
+            server could not create are then uploaded individually.
+        bulk_max_bytes : int, optional
+            Maximum total size of the files sent in a single bulk request.
+            Larger files are uploaded individually.
+        bulk_max_files : int, optional
+            Maximum number of files sent in a single bulk request.
+        compress : string, optional
+            Compress files while uploading them, using 'gzip' or 'zstd'
+            (requires the 'zstandard' package). File names are unchanged; the
+            codec is recorded in the file metadata, and files are decompressed
+            automatically when they are read or downloaded.
+            Cannot be combined with `bulk`.
+        compress_workers : int, optional
+            Number of files compressed in parallel ahead of the file being
+            uploaded, when `compress` is given.
+        dedup : boolean, optional
+            If True, files identical (same size and MD5 checksum) to a file
+            already in the container, or in `index`, are not uploaded again;
+            instead, the existing file is copied on the server.
+        index : `hbp_archive.Inventory`, optional
+            Inventory in which to look for identical files in other containers
+            and projects, when `dedup` is True.
 
         Returns
         -------
@@ -510,48 +2684,358 @@ class Container(object):
             local_paths = [local_paths]
         remote_paths = []
 
-        contents = [f.name for f in self.list()]
+        existing_files = self.list()
+        contents = [f.name for f in existing_files]
+        targets = []
         for path in local_paths:
             remote_path = os.path.join(remote_directory, os.path.basename(path))
             if not overwrite and remote_path in contents:
                 raise Exception("Target file path '{}' already exists! Set `overwrite=True` to overwrite file.".format(remote_path))
+            targets.append((path, remote_path))
+        if dedup:
+            copied, targets = self._deduplicate(targets, existing_files, index)
+            remote_paths.extend(copied)
+        if bulk:
+            if compress:
+                raise ValueError("Compression is not supported for bulk uploads")
+            return remote_paths + self._bulk_upload(targets, bulk_max_bytes, bulk_max_files)
+        if compress:
+            _compressor(compress)  # check the codec is available before starting
+            stopped = threading.Event()
+            # one worker compresses the file being uploaded, the others the following files
+            with ThreadPoolExecutor(max_workers=compress_workers + 1) as executor:
+                try:
+                    pending = collections.deque()
+                    next_index = 0
+                    while next_index < len(targets) or pending:
+                        while next_index < len(targets) and len(pending) <= compress_workers:
+                            path, remote_path = targets[next_index]
+                            pending.append((path, remote_path,
+                                            _compress_file(path, compress, executor, stopped)))
+                            next_index += 1
+                        path, remote_path, chunks = pending.popleft()
+                        headers = {CODEC_HEADER: compress,
+                                   UNCOMPRESSED_SIZE_HEADER: str(os.path.getsize(path))}
+                        self.project._connection.put_object(self.name, remote_path, chunks, headers=headers)
+                        remote_paths.append(remote_path)
+                finally:
+                    stopped.set()
+            return remote_paths
+        for path, remote_path in targets:
             with open(path, 'rb') as file_obj:
                 self.project._connection.put_object(self.name, remote_path, file_obj)
                 remote_paths.append(remote_path)
         return remote_paths
 
-    def download(self, file_path, local_directory=".", with_tree=True, overwrite=False):
-        """Download a file from the container.
+    def _deduplicate(self, targets, existing_files, index=None):
+        """For each (local path, remote path) pair in `targets`, look for a file
+        with the same size and checksum in `existing_files` or in `index`, and
+        if one is found, create the remote file as a server-side copy.
+
+        Returns the list of remote paths created by copying, or which already
+        had the same contents, and the list of targets which still need to be uploaded.
+        """
+        by_checksum = {(f.hash, f.bytes): f.name for f in existing_files}
+        by_name = {f.name: (f.hash, f.bytes) for f in existing_files}
+        sizes = set(f.bytes for f in existing_files)
+        copied, remaining = [], []
+        for local_path, remote_path in targets:
+            size = os.path.getsize(local_path)
+            source = None
+            if size in sizes or index is not None:
+                checksum = _md5(local_path)
+                if by_name.get(remote_path) == (checksum, size):
+                    logger.info("'{}' is already identical to '{}', skipped".format(local_path, remote_path))
+                    copied.append(remote_path)
+                    continue
+                if (checksum, size) in by_checksum:
+                    source = (self.project.id, self.name, by_checksum[(checksum, size)])
+                elif index is not None:
+                    for match in index.find(hash=checksum, min_size=size, max_size=size):
+                        ks_project = self.project.archive._ks_projects.get(match["project"])
+                        if ks_project is not None:
+                            source = (ks_project.id, match["container"], match["name"])
+                            break
+            if source is None:
+                remaining.append((local_path, remote_path))
+                continue
+            source_project_id, source_container, source_path = source
+            try:
+                self._server_side_copy(remote_path, source_container, source_path, source_project_id)
+            except ClientException as err:
+                # the index may be out of date, e.g. if the source has been deleted
+                logger.warning("Unable to copy '{}/{}', uploading '{}' instead: {}".format(
+                    source_container, source_path, local_path, err))
+                remaining.append((local_path, remote_path))
+            else:
+                logger.info("'{}' is identical to '{}/{}', copied instead of uploading".format(
+                    local_path, source_container, source_path))
+                copied.append(remote_path)
+        return copied, remaining
+
+    def _server_side_copy(self, remote_path, source_container, source_path, source_project_id=None,
+                          manifest=False):
+        """Create `remote_path` in this container as a copy of a file which is
+        already in the archive, possibly in another container or project.
+
+        If `manifest` is True, a static large object is copied as a manifest
+        referring to the same segments, rather than as a single object
+        containing their contents."""
+        headers = {"X-Copy-From": "/{}/{}".format(quote(source_container), quote(source_path))}
+        if source_project_id and source_project_id != self.project.id:
+            headers["X-Copy-From-Account"] = "AUTH_{}".format(source_project_id)
+        query_string = "multipart-manifest=get" if manifest else None
+        self.project._connection.put_object(self.name, remote_path, None, headers=headers,
+                                            query_string=query_string)
+
+    def _bulk_upload(self, targets, max_bytes, max_files):
+        """Upload (local path, remote path) pairs using the "extract-archive"
+        feature of the bulk middleware, in batches limited to `max_bytes`
+        and `max_files`."""
+        remote_paths = []
+        batch, batch_bytes = [], 0
+        for local_path, remote_path in targets:
+            size = os.path.getsize(local_path)
+            if size > max_bytes:
+                self._upload_file(local_path, remote_path)
+                remote_paths.append(remote_path)
+                continue
+            if batch and (batch_bytes + size > max_bytes or len(batch) >= max_files):
+                remote_paths.extend(self._extract_archive(batch))
+                batch, batch_bytes = [], 0
+            batch.append((local_path, remote_path, size))
+            batch_bytes += size
+        if batch:
+            remote_paths.extend(self._extract_archive(batch))
+        return remote_paths
+
+    def _extract_archive(self, batch):
+        """Send a batch of (local path, remote path, size) as a tar stream to
+        be expanded by the server, then upload any files it reports as failed."""
+        def members():
+            for local_path, remote_path, size in batch:
+                tarinfo = tarfile.TarInfo(remote_path)
+                tarinfo.size = size
+                tarinfo.mtime = os.path.getmtime(local_path)
+                yield tarinfo, _iter_file(local_path)
+
+        response = self.project._request("PUT", quote(self.name), params={"extract-archive": "tar"},
+                                         headers={"Accept": "application/json"},
+                                         data=_iter_tar(members()))
+        failed = _bulk_failures(response, self.name, len(batch), ["Number Files Created"])
+        if failed is None:
+            logger.warning("Bulk upload failed ({}), uploading files individually".format(response.status_code))
+            failed = set(remote_path for local_path, remote_path, size in batch)
+        else:
+            logger.debug("Bulk upload created {} file(s), {} error(s)".format(
+                len(batch) - len(failed), len(failed)))
+        remote_paths = []
+        for local_path, remote_path, size in batch:
+            if remote_path in failed:
+                self._upload_file(local_path, remote_path)
+            remote_paths.append(remote_path)
+        return remote_paths
+
+    def upload_directory(self, local_directory, remote_directory="", workers=4, shard=None, num_shards=None):
+        """Upload the contents of a local directory, and all its subdirectories,
+        to the container.
+
+        The directory tree is reproduced under `remote_directory`. Files that
+        already exist in the container with the same size and MD5 checksum are
+        skipped, so this method can also be used to update a previous upload.
+
+        With `shard` and `num_shards`, only one share of the files is uploaded,
+        so that the upload can be divided between several processes or nodes
+        with access to the same file system. Files are assigned to shards as by
+        :meth:`iter_files` with `partition='hash'`.
+
+        Parameters
+        ----------
+        local_directory : string
+            Local path of directory to be uploaded.
+        remote_directory : string, optional
+            Remote directory path where data is to be uploaded. Default is root directory.
+        workers : int, optional
+            Number of files to upload in parallel.
+        shard : int, optional
+            Index of the share of files to upload, from 0 to `num_shards` - 1.
+        num_shards : int, optional
+            Number of shares into which the files are divided.
+
+        Returns
+        -------
+        `hbp_archive.TransferResult`
+            The local paths uploaded, skipped or which could not be uploaded.
+        """
+        remote_directory = remote_directory.strip("/")
+        prefix = remote_directory + "/" if remote_directory else None
+        existing = {f.name: f for f in self.iter_files(prefix=prefix, shard=shard, num_shards=num_shards)}
+        result = TransferResult()
+        pending = []
+        for local_path, remote_path in _walk_directory(local_directory, remote_directory):
+            if num_shards is not None and _shard_of(remote_path, num_shards) != shard:
+                continue
+            size = os.path.getsize(local_path)
+            remote_file = existing.get(remote_path)
+            if remote_file is not None and remote_file.bytes == size and remote_file.hash == _md5(local_path):
+                result.skipped.append(local_path)
+            else:
+                pending.append((size, local_path, remote_path))
+        # start with the largest files so that the workers finish at around the same time
+        pending.sort(reverse=True)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._upload_file, local_path, remote_path): (local_path, remote_path)
+                       for size, local_path, remote_path in pending}
+            for future in as_completed(futures):
+                local_path, remote_path = futures[future]
+                try:
+                    future.result()
+                except Exception as err:
+                    logger.warning("Unable to upload '{}': {}".format(local_path, err))
+                    result.failed[local_path] = err
+                else:
+                    logger.info("Uploaded '{}'".format(remote_path))
+                    result.completed[local_path] = remote_path
+        return result
+
+    def _upload_file(self, local_path, remote_path):
+        with open(local_path, 'rb') as file_obj:
+            self.project._connection.put_object(self.name, remote_path, file_obj,
+                                                content_length=os.path.getsize(local_path))
+
+    def _get_object(self, file_path, headers=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        return self.project._connection.get_object(self.name, file_path, resp_chunk_size=chunk_size,
+                                                   headers=headers)
+
+    def _get_object_stream(self, file_path, headers=None):
+        headers, body = self.project._connection.get_object(self.name, file_path,
+                                                            resp_chunk_size=DOWNLOAD_CHUNK_SIZE,
+                                                            headers=headers)
+        return headers, body.resp.raw
+
+    def _head_object(self, file_path):
+        return self.project._connection.head_object(self.name, file_path)
+
+    def open(self, file_path, mode="r", encoding="utf-8", content_type=None, segment_size=SEGMENT_SIZE,
+             workers=4):
+        """Open a file in the container as a file-like object, for reading or writing.
+
+        In read mode, data are retrieved as they are read, without downloading
+        the file first. In write mode, data are uploaded as they are written,
+        without being written to local disk first:
+
+        .. code-block:: python
+
+            with container.open("results/output.dat", "wb") as fp:
+                for block in simulation.run():
+                    fp.write(block)
+
+        Files no larger than `segment_size` are uploaded when the file is closed.
+        Larger files are uploaded in segments while they are being written, to a
+        container named "<container>_segments", and joined together as a
+        static large object when the file is closed. If an exception is raised
+        within the `with` block, or if the file is never closed, the file is not created.
 
         Parameters
         ----------
         file_path : string
-            Path of file to be downloaded.
-        local_directory : string, optional
-            Local directory path where file is to be saved.
-        with_tree : boolean, optional
-            Specify if directory structure of file is to be retained.
-        overwrite : boolean, optional
-            Specify if any already existing file should be overwritten.
+            Path of file to be opened.
+        mode : string, optional
+            'r' (default) to read text, 'rb' to read bytes, 'w' to write text
+            or 'wb' to write bytes. Writing replaces any existing file, and
+            deletes the segments of a large file it replaces, unless the
+            container keeps previous versions.
+        encoding : string, optional
+            Encoding used for text (default: 'utf-8').
+        content_type : string, optional
+            Content type of a file being written. If not given, it is guessed from the file extension.
+        segment_size : int, optional
+            Size of the segments in which large files are written (default 64 MB).
+            At most 1000 segments are allowed, so increase this for files larger than 64 GB.
+        workers : int, optional
+            Number of segments to upload in parallel. Up to `workers` + 1
+            segments are held in memory.
 
         Returns
         -------
-        string
-             Path of file created inside specified local directory.
+        file-like object
         """
-        # todo: allow file_path to be a File object
-        headers, contents = self.project._connection.get_object(self.name, file_path)
-        if with_tree:
-            local_directory = os.path.join(os.path.abspath(local_directory),
-                                           *os.path.dirname(file_path).split("/"))
-        Path(local_directory).mkdir(parents=True, exist_ok=True)
-        local_path = os.path.join(local_directory, os.path.basename(file_path))
-        if not overwrite and os.path.exists(local_path):
-            raise IOError("Destination file '{}' already exists! Set `overwrite=True` to overwrite file.".format(local_path))
-        with open(local_path, "wb") as local:
-            local.write(contents)
-        return local_path
-        # todo: check hash
+        if mode in ("w", "wb"):
+            fp = _ObjectWriter(self, file_path, content_type=content_type, segment_size=segment_size,
+                               workers=workers)
+            if mode == "w":
+                return _TextObjectWriter(fp, encoding=encoding)
+            return fp
+        return super(Container, self).open(file_path, mode=mode, encoding=encoding)
+
+    def update_metadata(self, metadata, workers=8, retries=3):
+        """Update the custom metadata and/or content types of several files in parallel.
+
+        The current metadata of each file is retrieved and merged with the
+        changes, since Swift replaces all custom metadata on each update.
+        The Content-Disposition, Content-Encoding and X-Delete-At headers
+        are kept unchanged.
+        Changes made to a file by someone else between these two steps may be lost.
+
+        .. code-block:: python
+
+            container.update_metadata({
+                "results/run1.json": {"content-type": "application/json", "experiment": "A"},
+                "results/run2.json": {"content-type": "application/json", "experiment": None},
+            })
+
+        Parameters
+        ----------
+        metadata : dict
+            Mapping from file path to a dict of changes. Keys are metadata
+            names, stored as "X-Object-Meta-<name>" headers, except for
+            "content-type", which sets the content type. A value of None removes
+            the metadata item.
+        workers : int, optional
+            Number of files to update in parallel.
+        retries : int, optional
+            Number of times to retry a request after a server or connection error.
+
+        Returns
+        -------
+        `hbp_archive.TransferResult`
+            Mapping of path to the updated `hbp_archive.File` for each file, and
+            the exception raised for each file which could not be updated.
+        """
+        def update_one(file_path):
+            headers = _retry(lambda: self._head_object(file_path), retries)
+            f = _file_from_headers(self, file_path, headers)
+            for key, value in metadata[file_path].items():
+                key = key.lower()
+                if key == "content-type":
+                    f.content_type = value
+                elif value is None:
+                    f.metadata.pop(key, None)
+                else:
+                    f.metadata[key] = str(value)
+            post_headers = {"X-Object-Meta-{}".format(key): value for key, value in f.metadata.items()}
+            post_headers["Content-Type"] = f.content_type
+            for key in ("content-disposition", "content-encoding", "x-delete-at"):
+                if key in headers:  # also replaced by the update, so sent again
+                    post_headers[key] = headers[key]
+            _retry(lambda: self.project._connection.post_object(self.name, file_path, post_headers), retries)
+            return f
+
+        return self._map_files(update_one, list(metadata), workers, "update metadata of")
+
+    def _get_slo_manifest(self, file_path):
+        headers, contents = self.project._connection.get_object(self.name, file_path,
+                                                                query_string="multipart-manifest=get")
+        return json.loads(contents.decode("utf-8"))
+
+    def _get_listing_page(self, prefix=None, marker=None, end_marker=None, limit=LISTING_PAGE_SIZE,
+                          delimiter=None, reverse=False):
+        headers, contents = self.project._connection.get_container(self.name, prefix=prefix, marker=marker,
+                                                                   end_marker=end_marker, limit=limit,
+                                                                   delimiter=delimiter,
+                                                                   query_string="reverse=on" if reverse else None)
+        return contents
 
     def read(self, file_path, decode='utf-8', accept=[]):
         """Read and return the contents of a file in the container.
@@ -573,6 +3057,7 @@ class Container(object):
         """
         text_content_types = ["application/json", ]
         headers, contents = self.project._connection.get_object(self.name, file_path)
+        contents = b"".join(_decode_stream(headers, [contents]))
         # todo: check hash
         content_type = headers["content-type"]
         ct_parts = content_type.split("/")
@@ -595,17 +3080,22 @@ class Container(object):
         overwrite : boolean, optional
             Specify if any already existing file should be overwritten.
         """
+        self._copy(file_path, target_directory, new_name, overwrite, set(f.name for f in self.list()))
+        logger.info("Successfully copied the object")
+
+    def _copy(self, file_path, target_directory, new_name, overwrite, contents):
+        """Copy a file, given the set of names of the files in the container,
+        which is updated. Returns the path of the copy."""
         if not new_name:
             new_name = os.path.basename(file_path)
-
-        contents = [f.name for f in self.list()]
         path = os.path.join(target_directory, new_name)
         if file_path not in contents:
             raise Exception("Source file path '{}' does not exist!".format(file_path))
         if not overwrite and path in contents:
             raise Exception("Target file path '{}' already exists! Set `overwrite=True` to overwrite file.".format(path))
         self.project._connection.copy_object(self.name, file_path, destination=os.path.join(self.name, path))
-        logger.info("Successfully copied the object")
+        contents.add(path)
+        return path
 
     def move(self, file_path, target_directory, new_name=None, overwrite=False):
         """Move a file to the specified directory.
@@ -621,15 +3111,7 @@ class Container(object):
         overwrite : boolean, optional
             Specify if any already existing file should be overwritten.
         """
-        if not new_name:
-            new_name = os.path.basename(file_path)
-        contents = [f.name for f in self.list()]
-        path = os.path.join(target_directory, new_name)
-        if file_path not in contents:
-            raise Exception("Source file path '{}' does not exist!".format(file_path))
-        if not overwrite and path in contents:
-            raise Exception("Target file path '{}' already exists! Set `overwrite=True` to overwrite file.".format(path))
-        self.project._connection.copy_object(self.name, file_path, destination=os.path.join(self.name, path))
+        self._copy(file_path, target_directory, new_name, overwrite, set(f.name for f in self.list()))
         self.project._connection.delete_object(self.name, file_path)
         if os.path.dirname(file_path) == target_directory:
             logger.info("Successfully renamed the object")
@@ -682,15 +3164,11 @@ class Container(object):
             directory_path += '/'
         if not new_name:
             new_name = os.path.basename(directory_path)
-        all_files = self.list()
-        dir_files = [f for f in all_files if f.name.startswith(directory_path)]
-        if not dir_files:
-            raise Exception("Specified directory '{}' does not exist in this container!".format(directory_path[:-1]))
-        else:
-            logger.info("***** Directory Copy Details *****")
-            for f in dir_files:
-                logger.info("Filename: {}".format(f.name))
-                self.copy(f.name, os.path.join(target_directory, new_name), overwrite=overwrite)
+        dir_files, markers, contents = self._directory_listing(directory_path)
+        logger.info("***** Directory Copy Details *****")
+        for f in dir_files:
+            logger.info("Filename: {}".format(f.name))
+            self._copy(f.name, os.path.join(target_directory, new_name), None, overwrite, contents)
 
     def move_directory(self, directory_path, target_directory, new_name=None, overwrite=False):
         """Move a directory to the specified directory location.
@@ -715,15 +3193,17 @@ class Container(object):
             directory_path += '/'
         if not new_name:
             new_name = os.path.basename(directory_path)
-        all_files = self.list()
-        dir_files = [f for f in all_files if f.name.startswith(directory_path)]
-        if not dir_files:
-            raise Exception("Specified directory '{}' does not exist in this container!".format(directory_path[:-1]))
-        else:
-            logger.info("***** Directory Move Details *****")
+        dir_files, markers, contents = self._directory_listing(directory_path)
+        logger.info("***** Directory Move Details *****")
+        moved = []
+        try:
             for f in dir_files:
                 logger.info("Filename: {}".format(f.name))
-                self.move(f.name, os.path.join(target_directory, new_name), overwrite=overwrite)
+                self._copy(f.name, os.path.join(target_directory, new_name), None, overwrite, contents)
+                moved.append(f.name)
+        finally:
+            # files already copied are removed from the source even if a later copy fails
+            self._delete_files(moved + (markers if len(moved) == len(dir_files) else []))
 
     def delete_directory(self, directory_path):
         """Delete the specified directory (and its contents).
@@ -735,15 +3215,122 @@ class Container(object):
         """
         if directory_path[-1] != '/':
             directory_path += '/'
-        all_files = self.list()
-        dir_files = [f for f in all_files if f.name.startswith(directory_path)]
+        dir_files, markers, contents = self._directory_listing(directory_path, prefix=directory_path)
+        logger.info("***** Directory Delete Details *****")
+        for f in dir_files:
+            logger.info("Filename: {}".format(f.name))
+        self._delete_files([f.name for f in dir_files] + markers)
+
+    def _directory_listing(self, directory_path, prefix=None):
+        """List the container (or the files starting with `prefix`) once for
+        the directory operations. Returns the files in the directory, the names
+        of the pseudo-directory markers within it, and the set of names of all
+        files listed."""
+        contents = set()
+        dir_files, markers = [], []
+        for f in self.iter_files(prefix=prefix):
+            contents.add(f.name)
+            if f.name.startswith(directory_path):
+                if f.name.endswith("/"):
+                    markers.append(f.name)
+                else:
+                    dir_files.append(f)
         if not dir_files:
             raise Exception("Specified directory '{}' does not exist in this container!".format(directory_path[:-1]))
-        else:
-            logger.info("***** Directory Delete Details *****")
-            for f in dir_files:
-                logger.info("Filename: {}".format(f.name))
-                self.delete(f.name)
+        return dir_files, markers, contents
+
+    def _delete_files(self, file_paths):
+        """Delete files with bulk requests, raising an exception if any could not be deleted."""
+        failed = self._bulk_delete(file_paths)
+        if failed:
+            raise Exception("Unable to delete {} file(s): {}".format(len(failed), sorted(failed)))
+
+    def replicate_to(self, target_container, prefix=None, workers=8, delete_source=False):
+        """Copy the files in this container to another container, which may be
+        in a different project.
+
+        Files are copied on the server, several at a time. Files already
+        present in the target container with the same checksum are skipped.
+
+        Parameters
+        ----------
+        target_container : `hbp_archive.Container`
+            Container to which files are to be copied.
+        prefix : string, optional
+            only copy files whose path starts with this prefix.
+        workers : int, optional
+            Number of files to copy in parallel.
+        delete_source : boolean, optional
+            If True, files which were copied successfully, or skipped as
+            identical copies already exist, are deleted from this container
+            (i.e. the files are moved). Files which could not be deleted are
+            reported as failed. Large files moved within the same project
+            keep their segments, which are not copied.
+
+        Returns
+        -------
+        `hbp_archive.TransferResult`
+            Mapping of file paths copied, skipped or which could not be copied.
+        """
+        source_files = self.list(prefix=prefix)
+        target_hashes = {f.name: f.hash for f in target_container.list(prefix=prefix)}
+        # when moving within a project, a large file's manifest is moved and its segments left where they are
+        move_manifests = delete_source and target_container.project.id == self.project.id
+        result = TransferResult()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for f in source_files:
+                if target_hashes.get(f.name) == f.hash:
+                    result.skipped.append(f.name)
+                else:
+                    future = executor.submit(target_container._server_side_copy, f.name, self.name, f.name,
+                                             self.project.id, move_manifests)
+                    futures[future] = f.name
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    future.result()
+                except Exception as err:
+                    logger.warning("Unable to copy '{}': {}".format(file_path, err))
+                    result.failed[file_path] = err
+                else:
+                    result.completed[file_path] = file_path
+        logger.info("Copied {} file(s) from {} to {}, {} skipped, {} failed".format(
+            len(result.completed), self, target_container, len(result.skipped), len(result.failed)))
+        if delete_source:
+            not_deleted = self._bulk_delete(list(result.completed) + result.skipped)
+            for file_path, reason in not_deleted.items():
+                logger.warning("Unable to delete '{}' from {}: {}".format(file_path, self, reason))
+                result.completed.pop(file_path, None)
+                if file_path in result.skipped:
+                    result.skipped.remove(file_path)
+                result.failed[file_path] = Exception("Copied, but not deleted from source: {}".format(reason))
+        return result
+
+    def _bulk_delete(self, file_paths):
+        """Delete many files using the "bulk-delete" feature of the bulk
+        middleware. Returns a dict of the files which could not be deleted,
+        with the reason."""
+        failed = {}
+        for start in range(0, len(file_paths), BULK_DELETE_MAX_FILES):
+            batch = file_paths[start:start + BULK_DELETE_MAX_FILES]
+            body = "\n".join("/{}/{}".format(quote(self.name), quote(path)) for path in batch)
+            response = self.project._request("POST", params={"bulk-delete": "true"}, data=body.encode("utf-8"),
+                                             headers={"Accept": "application/json", "Content-Type": "text/plain"})
+            batch_failed = _bulk_failures(response, self.name, len(batch),
+                                          ["Number Deleted", "Number Not Found"])
+            if batch_failed is not None:
+                failed.update(batch_failed)
+            else:
+                logger.warning("Bulk delete failed ({}), deleting files individually".format(response.status_code))
+                for path in batch:
+                    try:
+                        self.project._connection.delete_object(self.name, path)
+                    except ClientException as err:
+                        if err.http_status != 404:
+                            failed[path] = err
+        self._metadata = None  # needs to be refreshed
+        return failed
 
     def access_control(self, show_usernames=True):
         """List the users that have access to this container.
@@ -853,7 +3440,7 @@ class Container(object):
             logger.info("User {} has been revoked {} access to this container.".format(username, mode))
 
 
-class PublicContainer(object):  # todo: figure out inheritance relationship with Container
+class PublicContainer(_BaseContainer):  # todo: figure out inheritance relationship with Container
     """A representation of a public CSCS storage container. Can be used to operate
     only public CSCS containers. A CSCS account is not needed to use this class.
 
@@ -863,24 +3450,52 @@ class PublicContainer(object):  # todo: figure out inheritance relationship with
     Action                                 Method
     ====================================   ====================================
     List all files in container            :meth:`list`
+    List files using parallel requests     :meth:`iter_files`
+    Choose ranges for sharded jobs         :meth:`sample_split_points`
     Return a file from given path          :meth:`get`
     Get number of files in container       :meth:`count`
     Get total size of data in container    :meth:`size`
+    Get metadata about the container       :attr:`metadata`
+    Get size of each directory             :meth:`usage`
+    Get index of files by directory        :meth:`tree`
     Download a file from container         :meth:`download`
+    Download several files in parallel     :meth:`download_many`
+    Download a directory from container    :meth:`download_directory`
+    Export a directory as tar/zip archive  :meth:`export_archive`
+    Compare with a container or directory  :meth:`diff`
+    Verify integrity of stored files       :meth:`scrub`
     Read contents of file in container     :meth:`read`
+    Open a file as a file-like object      :meth:`open`
+    Read several files in parallel         :meth:`read_many`
+    Get metadata of several files          :meth:`head_many`
+    Read files while prefetching the next  :meth:`iter_contents`
     ====================================   ====================================
 
+    Parameters
+    ----------
+    url : string
+        Public URL of the container.
+    metadata_ttl : float, optional
+        Number of seconds for which :attr:`metadata`, and hence :meth:`count`
+        and :meth:`size`, are cached. Set to 0 to always retrieve the latest values.
+
     Note
     ----
     This class only permits read-only operations. For other features,
     you may access a public container via the :class:`Container` class.
     """
 
-    def __init__(self, url):
+    def __init__(self, url, metadata_ttl=60):
         self.public_url = url
         self.name = url.split("/")[-1]
         self.project = None
+        self.metadata_ttl = metadata_ttl
+        self._metadata = None
+        self._metadata_time = None
         self._content_list = None
+        self._listing_pages = []  # (marker, ETag, files) for each page of the cached listing
+        self._session = requests.Session()  # reuses connections between requests
+        self._session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=32))
 
     def __str__(self):
         return self.public_url
@@ -888,22 +3503,92 @@ class PublicContainer(object):  # todo: figure out inheritance relationship with
     def __repr__(self):
         return "PublicContainer('{}')".format(self.public_url)
 
-    def list(self):  # todo: allow refreshing, in case contents have changed
+    @property
+    def metadata(self):
+        """Metadata about the container, retrieved with a HEAD request and
+        cached for `metadata_ttl` seconds.
+
+        Returns
+        -------
+        dict
+            Dictionary with metadata about the container (lower-case keys).
+        """
+        now = time.time()
+        if self._metadata is None or now - self._metadata_time >= self.metadata_ttl:
+            response = self._session.head(self.public_url)
+            if not response.ok:
+                raise ClientException(response.reason, http_status=response.status_code)
+            self._metadata = {key.lower(): value for key, value in response.headers.items()}
+            self._metadata_time = now
+        return self._metadata
+
+    def list(self, prefix=None, refresh=False):
         """List all files in the container.
 
+        The full listing is cached after the first call. With `refresh=True`
+        the cached listing is revalidated, page by page, with conditional
+        requests, so only pages which have changed are retrieved again.
+
+        Parameters
+        ----------
+        prefix : string, optional
+            only list files whose path starts with this prefix.
+        refresh : boolean, optional
+            check for changes to the container contents since the last call.
+
         Returns
         -------
         list
             List of `hbp_archive.File` objects existing in container.
         """
-        if self._content_list is None:
-            response = requests.get(self.public_url, headers={"Accept": "application/json"})
-            if response.ok:
-                self._content_list = [File(container=self, **entry) for entry in response.json()]
-            else:
-                raise Exception(response.content)
+        if prefix and (refresh or self._content_list is None):
+            return [File(container=self, **entry) for entry in self._iter_listing(prefix=prefix)]
+        if refresh or self._content_list is None:
+            self._content_list = list(self._iter_cached_listing())
+        if prefix:
+            return [f for f in self._content_list if f.name.startswith(prefix)]
         return self._content_list
 
+    def _iter_cached_listing(self):
+        """Generate the files in the container one page at a time, sending the
+        ETag of each previously retrieved page in an If-None-Match header, and
+        reusing the cached page if the server replies "304 Not Modified"."""
+        cached = {marker: (etag, files) for marker, etag, files in self._listing_pages}
+        pages = []
+        marker = None
+        while True:
+            cached_etag, cached_files = cached.get(marker, (None, None))
+            etag, entries = self._fetch_listing_page(marker=marker, etag=cached_etag)
+            if entries is None:
+                files = cached_files
+            else:
+                files = [File(container=self, **entry) for entry in entries]
+            pages.append((marker, etag, files))
+            # the server may return fewer entries than requested before the end
+            # of the listing, so only an empty page means the listing is complete
+            if not files:
+                break
+            for f in files:
+                yield f
+            marker = files[-1].name
+        # only complete listings are cached, so that a refresh never reuses a truncated one
+        self._listing_pages = pages
+
+    def _fetch_listing_page(self, marker=None, etag=None, limit=LISTING_PAGE_SIZE, **params):
+        """Return the ETag and the entries of one page of the container listing.
+        If `etag` is given and the page has not changed, the entries are None."""
+        params.update(format="json", marker=marker, limit=limit)
+        headers = {"If-None-Match": etag} if etag else None
+        response = self._session.get(self.public_url, params=params, headers=headers)
+        if response.status_code == 304:
+            return etag, None
+        if not response.ok:
+            raise ClientException(response.reason, http_status=response.status_code,
+                                  http_response_content=response.content)
+        if response.status_code == 204:  # empty container
+            return response.headers.get("ETag"), []
+        return response.headers.get("ETag"), response.json()
+
     def get(self, file_path):
         """Return a File object for the file at the given path.
 
@@ -930,7 +3615,7 @@ class PublicContainer(object):  # todo: figure out inheritance relationship with
         int
             Count of number of files in the container.
         """
-        return len(self.list())
+        return int(self.metadata['x-container-object-count'])
 
     def size(self, units='bytes'):
         """Total size of all data in the container.
@@ -946,46 +3631,47 @@ class PublicContainer(object):  # todo: figure out inheritance relationship with
         float
             Total size of all data in the container in requested units.
         """
-        total_bytes = sum(f.bytes for f in self.list())
-        return scale_bytes(total_bytes, units)
-
-    def download(self, file_path, local_directory=".", with_tree=True, overwrite=False):
-        """Download a file from the container.
-
-        file_path : string
-            Path of file to be downloaded.
-        local_directory : string, optional
-            Local directory path where file is to be saved.
-        with_tree : boolean, optional
-            Specify if directory structure of file is to be retained.
-        overwrite : boolean, optional
-            Specify if any already existing file should be overwritten.
+        return scale_bytes(int(self.metadata['x-container-bytes-used']), units)
 
-        Returns
-        -------
-        string
-             Path of file created inside specified local directory.
-        """
-        # todo: allow file_path to be a File object
-        # todo: implement direct streaming to file without
-        #       storing copy in memory, see for example
-        #       https://stackoverflow.com/questions/13137817/how-to-download-image-using-requests
-        response = requests.get(self.url + file_path)
-        if response.ok:
-            contents = response.content
-        else:
-            raise Exception(response.content)
-        if with_tree:
-            local_directory = os.path.join(os.path.abspath(local_directory),
-                                           *os.path.dirname(file_path).split("/"))
-        Path(local_directory).mkdir(parents=True, exist_ok=True)
-        local_path = os.path.join(local_directory, os.path.basename(file_path))
-        if not overwrite and os.path.exists(local_path):
-            raise IOError("Destination file ({}) already exists! Set `overwrite=True` to overwrite file.".format(local_path))
-        with open(local_path, 'wb') as local:
-            local.write(contents)
-        return local_path
-        # todo: check hash
+    def _object_url(self, file_path):
+        return "{}/{}".format(self.public_url.rstrip("/"), quote(file_path))
+
+    def _get_object(self, file_path, headers=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        response = self._session.get(self._object_url(file_path), headers=headers, stream=True)
+        # as for Container, "304 Not Modified" (for conditional requests) is raised
+        if not response.ok or response.status_code == 304:
+            raise ClientException(response.reason, http_status=response.status_code,
+                                  http_response_content=response.content)
+        headers = {key.lower(): value for key, value in response.headers.items()}
+        return headers, response.iter_content(chunk_size)
+
+    def _get_object_stream(self, file_path, headers=None):
+        response = self._session.get(self._object_url(file_path), headers=headers, stream=True)
+        if not response.ok or response.status_code == 304:
+            raise ClientException(response.reason, http_status=response.status_code,
+                                  http_response_content=response.content)
+        response.raw.decode_content = True
+        return {key.lower(): value for key, value in response.headers.items()}, response.raw
+
+    def _head_object(self, file_path):
+        response = self._session.head(self._object_url(file_path))
+        if not response.ok:
+            raise ClientException(response.reason, http_status=response.status_code)
+        return {key.lower(): value for key, value in response.headers.items()}
+
+    def _get_slo_manifest(self, file_path):
+        response = self._session.get(self._object_url(file_path), params={"multipart-manifest": "get"})
+        if not response.ok:
+            raise ClientException(response.reason, http_status=response.status_code,
+                                  http_response_content=response.content)
+        return response.json()
+
+    def _get_listing_page(self, prefix=None, marker=None, end_marker=None, limit=LISTING_PAGE_SIZE,
+                          delimiter=None, reverse=False):
+        etag, entries = self._fetch_listing_page(marker=marker, limit=limit, prefix=prefix,
+                                                 end_marker=end_marker, delimiter=delimiter,
+                                                 reverse="on" if reverse else None)
+        return entries
 
     def read(self, file_path, decode='utf-8', accept=[]):
         """Read and return the contents of a file in the container.
@@ -1006,10 +3692,11 @@ class PublicContainer(object):  # todo: figure out inheritance relationship with
             Contents of the specified file.
         """
         text_content_types = ["application/json", ]
-        response = requests.get(self.url + file_path)
+        response = self._session.get(self._object_url(file_path))
         if response.ok:
-            contents = response.content
             headers = response.headers
+            codec = headers.get(CODEC_HEADER)
+            contents = b"".join(_decompress_chunks(codec, [response.content])) if codec else response.content
         else:
             raise Exception(response.content)
         # todo: check hash
@@ -1024,6 +3711,418 @@ class PublicContainer(object):  # todo: figure out inheritance relationship with
             return contents
 
 
+class PackedStore(object):
+    """Store many small files efficiently, by packing them into large objects.
+
+    Files added with :meth:`put` are buffered, then written together as a
+    single "pack" object in the container, below `prefix`. An index object
+    records the pack, offset and length of each file, so that a single file
+    can be read back with one ranged request. The index is cached locally,
+    in memory and optionally on disk, so looking up a file needs no request.
+
+    Only one process should write to a given store at a time.
+
+    .. code-block:: python
+
+        store = PackedStore(container, "spike_trains")
+        for name, data in results:
+            store.put(name, data)
+        store.flush()
+        data = store.get("cell_0042.dat")
+
+    The following actions can be performed:
+
+    ====================================   ====================================
+    Action                                 Method
+    ====================================   ====================================
+    Add a file                             :meth:`put`
+    Write buffered files to the container  :meth:`flush`
+    Read a file                            :meth:`get`
+    List stored files                      :meth:`names`
+    Reload the index                       :meth:`refresh`
+    ====================================   ====================================
+
+    Parameters
+    ----------
+    container : `hbp_archive.Container` or `hbp_archive.PublicContainer`
+        Container in which the packs are stored. A PublicContainer can only be read.
+    prefix : string
+        Directory within the container in which packs and index are stored.
+    pack_size : int, optional
+        Buffered data is written out as a pack once it reaches this size (default 64 MB).
+    cache_path : string, optional
+        Local file in which to keep a copy of the index between sessions.
+    """
+
+    def __init__(self, container, prefix, pack_size=67108864, cache_path=None):
+        self.container = container
+        self.prefix = prefix.strip("/")
+        self.pack_size = pack_size
+        self.cache_path = cache_path
+        self._index = {}
+        self._index_etag = None
+        self._pending = collections.OrderedDict()
+        self._pending_bytes = 0
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path) as fp:
+                cached = json.load(fp)
+            self._index, self._index_etag = cached["files"], cached["etag"]
+        self.refresh()
+
+    def __repr__(self):
+        return "PackedStore({!r}, '{}')".format(self.container, self.prefix)
+
+    def __contains__(self, name):
+        return name in self._index or name in self._pending
+
+    def __len__(self):
+        return len(set(self._index).union(self._pending))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    @property
+    def index_path(self):
+        return "{}/index.json.gz".format(self.prefix)
+
+    def refresh(self):
+        """Reload the index from the container, if it has changed."""
+        headers = {"If-None-Match": self._index_etag} if self._index_etag else None
+        try:
+            response_headers, contents = self.container._get_object(self.index_path, headers=headers)
+        except ClientException as err:
+            if err.http_status == 304:
+                return
+            elif err.http_status == 404:
+                self._index, self._index_etag = {}, None
+                return
+            raise
+        contents = b"".join(contents)
+        self._index = json.loads(zlib.decompress(contents, 31).decode("utf-8"))["files"]
+        self._index_etag = response_headers.get("etag")
+        self._save_cache()
+
+    def _save_cache(self):
+        if self.cache_path:
+            with open(self.cache_path, "w") as fp:
+                json.dump({"etag": self._index_etag, "files": self._index}, fp)
+
+    def names(self):
+        """Return a sorted list of the names of the files in the store."""
+        return sorted(set(self._index).union(self._pending))
+
+    def put(self, name, data):
+        """Add a file to the store.
+
+        The data is buffered, and written to the container by :meth:`flush`,
+        which is called automatically once `pack_size` bytes are buffered.
+        Adding a file with an existing name replaces the previous version.
+        """
+        if name in self._pending:
+            self._pending_bytes -= len(self._pending[name])
+        self._pending[name] = data
+        self._pending_bytes += len(data)
+        if self._pending_bytes >= self.pack_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered files to the container as a new pack, and update the index."""
+        if not self._pending:
+            return
+        pack_path = "{}/packs/{}.pack".format(self.prefix, uuid.uuid4().hex)
+        offset = 0
+        locations = {}
+        for name, data in self._pending.items():
+            locations[name] = [pack_path, offset, len(data)]
+            offset += len(data)
+        self.container.project._connection.put_object(self.container.name, pack_path,
+                                                      b"".join(self._pending.values()),
+                                                      content_type="application/octet-stream")
+        self.refresh()
+        index = dict(self._index, **locations)
+        compressor = _compressor("gzip")
+        contents = compressor.compress(json.dumps({"files": index}, separators=(",", ":")).encode("utf-8"))
+        contents += compressor.flush()
+        etag = self.container.project._connection.put_object(self.container.name, self.index_path, contents,
+                                                             content_type="application/gzip")
+        self._index, self._index_etag = index, etag
+        self._save_cache()
+        logger.info("Wrote {} file(s) to {}".format(len(locations), pack_path))
+        self._pending.clear()
+        self._pending_bytes = 0
+
+    def get(self, name):
+        """Return the contents of a file in the store, as bytes."""
+        if name in self._pending:
+            return self._pending[name]
+        if name not in self._index:
+            raise ValueError("'{}' is not in {}".format(name, self))
+        pack_path, offset, length = self._index[name]
+        if length == 0:
+            return b""
+        headers, contents = self.container._get_object(
+            pack_path, headers={"Range": "bytes={}-{}".format(offset, offset + length - 1)})
+        return b"".join(contents)
+
+
+class HBPArchiveFileSystem(AbstractFileSystem):
+    """An `fsspec <https://filesystem-spec.readthedocs.io>`_ file system for the archive,
+    allowing libraries such as pandas, xarray, zarr and dask to read files
+    directly, without downloading them first. Requires the "fsspec" package.
+
+    Paths have the form "hbp://<project>/<container>/<path>" for containers you
+    have access to with your CSCS account, and "hbp://AUTH_<id>/<container>/<path>"
+    (or the https URL of the file) for public containers.
+
+    .. code-block:: python
+
+        import fsspec
+        import pandas as pd
+
+        fs = fsspec.filesystem("hbp", username="xyzabc")
+        df = pd.read_csv(fs.open("bp00sp06/MyContainer/data.csv"))
+
+        # or, for a public container
+        df = pd.read_csv("hbp://AUTH_id/my_container/data.csv")
+
+    Parameters
+    ----------
+    username : string, optional
+        CSCS username, not needed if only public containers are accessed.
+    token : string, optional
+        Authentication token, as for :class:`Archive`.
+    workers : int, optional
+        Number of files (or byte ranges) to retrieve in parallel in
+        :meth:`cat` and :meth:`cat_ranges`.
+    """
+    protocol = ("hbp",)
+
+    def __init__(self, username=None, token=None, workers=8, **kwargs):
+        if not fsspec_available:
+            raise ImportError("Please install the 'fsspec' package to use HBPArchiveFileSystem")
+        super(HBPArchiveFileSystem, self).__init__(**kwargs)
+        self.username = username
+        self.token = token
+        self.workers = workers
+        self._archive = None
+        self._containers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if isinstance(path, list):
+            return [cls._strip_protocol(p) for p in path]
+        match = re.match(r"https?://[^/]+/v1/(AUTH_.*)", path)
+        if match:
+            return match.group(1).rstrip("/")
+        return super(HBPArchiveFileSystem, cls)._strip_protocol(path)
+
+    @property
+    def archive(self):
+        with self._lock:
+            if self._archive is None:
+                if self.username is None:
+                    raise ValueError("A username is needed to access non-public containers")
+                self._archive = Archive(self.username, token=self.token)
+        return self._archive
+
+    def _get_container(self, project_name, container_name):
+        key = (project_name, container_name)
+        if key not in self._containers:
+            if project_name.startswith("AUTH_"):
+                container = PublicContainer("{}/{}/{}".format(PUBLIC_STORAGE_URL, project_name, container_name))
+            else:
+                container = self.archive.projects[project_name].get_container(container_name)
+            with self._lock:
+                self._containers.setdefault(key, container)
+        return self._containers[key]
+
+    def _split(self, path):
+        """Return the container and the file path within it."""
+        parts = self._strip_protocol(path).strip("/").split("/", 2)
+        if len(parts) < 2:
+            raise ValueError("Path '{}' does not refer to a container".format(path))
+        return self._get_container(parts[0], parts[1]), (parts[2] if len(parts) > 2 else "")
+
+    def _file_info(self, base, entry):
+        return {"name": base + entry["name"], "size": entry["bytes"], "type": "file",
+                "ETag": entry["hash"], "content_type": entry["content_type"],
+                "last_modified": entry["last_modified"]}
+
+    def ls(self, path, detail=True, **kwargs):
+        path = self._strip_protocol(path).strip("/")
+        parts = path.split("/") if path else []
+        if len(parts) == 0:
+            entries = [{"name": name, "size": 0, "type": "directory"} for name in self.archive.projects]
+        elif len(parts) == 1:
+            if parts[0].startswith("AUTH_"):
+                raise ValueError("The containers of a public account cannot be listed")
+            entries = [{"name": "{}/{}".format(path, name), "size": 0, "type": "directory"}
+                       for name in self.archive.projects[parts[0]].container_names]
+        else:
+            container, key = self._split(path)
+            base = "/".join(parts[:2]) + "/"
+            entries = []
+            for entry in container._iter_listing(prefix=key + "/" if key else None, delimiter="/"):
+                if "subdir" in entry:
+                    entries.append({"name": base + entry["subdir"].rstrip("/"), "size": 0, "type": "directory"})
+                else:
+                    entries.append(self._file_info(base, entry))
+            if not entries and key:
+                entries = [self.info(path)]
+        if detail:
+            return entries
+        return [entry["name"] for entry in entries]
+
+    def info(self, path, **kwargs):
+        path = self._strip_protocol(path).strip("/")
+        if path.count("/") < 2:
+            return {"name": path, "size": 0, "type": "directory"}
+        container, key = self._split(path)
+        try:
+            headers = container._head_object(key)
+        except ClientException as err:
+            if err.http_status != 404:
+                raise
+        else:
+            # the size of a compressed file uploaded without its uncompressed size is unknown (None)
+            return {"name": path, "size": _decoded_size(headers, int(headers["content-length"])), "type": "file",
+                    "ETag": headers.get("etag", "").strip('"'), "content_type": headers.get("content-type"),
+                    "codec": headers.get(CODEC_HEADER.lower())}
+        if container._get_listing_page(prefix=key + "/", limit=1):
+            return {"name": path, "size": 0, "type": "directory"}
+        raise FileNotFoundError(path)
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        container, key = self._split(path)
+        if (start is not None and start < 0) or (end is not None and end < 0):
+            size = self.size(path)
+            if size is None:  # compressed, with unknown size before compression
+                return self.cat_file(path)[start:end]
+            start = size + start if start is not None and start < 0 else start
+            end = size + end if end is not None and end < 0 else end
+        headers = None
+        if start or end is not None:
+            start = start or 0
+            if end is not None and end <= start:
+                return b""
+            headers = {"Range": "bytes={}-{}".format(start, "" if end is None else end - 1)}
+        try:
+            response_headers, contents = container._get_object(key, headers=headers)
+        except ClientException as err:
+            if err.http_status == 404:
+                raise FileNotFoundError(path)
+            elif err.http_status != 416:
+                raise
+            # the range starts beyond the end of the stored file, which for a
+            # compressed file may still be within the decompressed contents
+            response_headers, contents = container._head_object(key), None
+            if not response_headers.get(CODEC_HEADER.lower()):
+                return b""
+        if response_headers.get(CODEC_HEADER.lower()):
+            # byte ranges refer to the compressed data, so decompress from the beginning
+            if headers is not None:
+                if hasattr(contents, "close"):
+                    contents.close()
+                response_headers, contents = container._get_object(key)
+            return _slice_chunks(_decode_stream(response_headers, contents), start or 0, end)
+        return b"".join(contents)
+
+    def cat(self, path, recursive=False, on_error="raise", **kwargs):
+        paths = self.expand_path(path, recursive=recursive)
+        parents = set(p.rsplit("/", 1)[0] for p in paths)
+        paths = [p for p in paths if p not in parents]  # skip pseudo-directories
+        if len(paths) == 1 and not isinstance(path, list) and paths[0] == self._strip_protocol(path):
+            return self.cat_file(paths[0], **kwargs)
+
+        def fetch(p):
+            try:
+                return self.cat_file(p, **kwargs)
+            except Exception as err:
+                if on_error == "raise":
+                    raise
+                return err
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = zip(paths, executor.map(fetch, paths))
+            return {p: contents for p, contents in results
+                    if not (on_error == "omit" and isinstance(contents, Exception))}
+
+    def cat_ranges(self, paths, starts, ends, max_gap=None, on_error="return", **kwargs):
+        if not isinstance(starts, list):
+            starts = [starts] * len(paths)
+        if not isinstance(ends, list):
+            ends = [ends] * len(paths)
+        if len(starts) != len(paths) or len(ends) != len(paths):
+            raise ValueError("paths, starts and ends must have the same length")
+
+        def fetch(args):
+            try:
+                return self.cat_file(*args)
+            except Exception as err:
+                if on_error == "raise":
+                    raise
+                return err
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(fetch, zip(paths, starts, ends)))
+
+    def _open(self, path, mode="rb", block_size=None, autocommit=True, cache_options=None, **kwargs):
+        if mode != "rb":
+            raise NotImplementedError("HBPArchiveFileSystem is read-only")
+        return _HBPArchiveFile(self, path, mode=mode, block_size=block_size or "default",
+                               cache_options=cache_options, **kwargs)
+
+
+class _HBPArchiveFile(AbstractBufferedFile):
+    """A read-only file opened by :class:`HBPArchiveFileSystem`, which
+    retrieves blocks of the file as they are needed, with ranged requests.
+
+    Files compressed when uploaded are instead decompressed as a single
+    stream, which is only restarted when seeking backwards.
+    """
+
+    def __init__(self, fs, path, mode="rb", size=None, **kwargs):
+        self._details = fs.info(path)
+        self._codec = self._details.get("codec")
+        self._reader = None
+        if size is None and self._details["size"] is None:
+            # compressed before the uncompressed size was recorded, so decompress it to find out
+            container, key = fs._split(path)
+            size = sum(len(chunk) for chunk in _decode_stream(*container._get_object(key)))
+        super(_HBPArchiveFile, self).__init__(fs, path, mode=mode, size=size, **kwargs)
+
+    def _fetch_range(self, start, end):
+        if not self._codec:
+            return self.fs.cat_file(self.path, start=start, end=end)
+        if self._reader is None or start < self._reader.tell():
+            self._close_reader()
+            self._reader = _ObjectReader(*self.fs._split(self.path))
+        _discard(self._reader, start - self._reader.tell())
+        data = []
+        count = end - start
+        while count > 0:
+            chunk = self._reader.read(count)
+            if not chunk:
+                break
+            data.append(chunk)
+            count -= len(chunk)
+        return b"".join(data)
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def close(self):
+        self._close_reader()
+        super(_HBPArchiveFile, self).close()
+
+
 class Project(object):
     """A representation of a CSCS Project.
 
@@ -1039,6 +4138,7 @@ class Project(object):
     List containers that you can access    :attr:`containers`
     Get names of containers in project     :attr:`container_names`
     Get mapping of usernames to user ids   :attr:`users`
+    Grant access to many containers        :meth:`set_access`
     ====================================   ====================================
     """
 
@@ -1050,7 +4150,8 @@ class Project(object):
         self.id = ks_project.id
         self.name = ks_project.name
         self._session = None
-        self.__connection = None
+        self._local = threading.local()  # holds one swift connection per thread
+        self._preauth = None  # storage URL and scoped token, for a project restored by pickle
         self._containers = None
         self._user_id_map = None
 
@@ -1060,13 +4161,32 @@ class Project(object):
     def __repr__(self):
         return "Project('{}', username='{}')".format(self.name, self.archive.username)
 
+    def __getstate__(self):
+        # replace the live session and connections by the storage URL and a
+        # scoped token, so that unpickled copies connect without authenticating again
+        state = self.__dict__.copy()
+        state.update(_preauth=self._get_auth(),
+                     _session=None, _local=None, _containers=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
     @property
     def _connection(self):
-        if self.__connection is None:
-            if self._session is None:
-                self._set_scope()
-            self.__connection = swiftclient.Connection(session=self._session)
-        return self.__connection
+        # swiftclient connections are not thread-safe, so each thread gets its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if self._preauth is not None:
+                storage_url, token = self._preauth
+                connection = swiftclient.Connection(preauthurl=storage_url, preauthtoken=token)
+            else:
+                if self._session is None:
+                    self._set_scope()
+                connection = swiftclient.Connection(session=self._session)
+            self._local.connection = connection
+        return connection
 
     def _set_scope(self):
         auth = v3.Token(auth_url=OS_AUTH_URL,
@@ -1074,6 +4194,24 @@ class Project(object):
                         project_id=self.id)
         self._session = session.Session(auth=auth)
 
+    def _get_auth(self):
+        """Return the storage URL and a token scoped to this project."""
+        if self._preauth is not None:
+            return self._preauth
+        return self._connection.get_auth()
+
+    def _request(self, method, path="", **kwargs):
+        """Send a request directly to the object storage for this project,
+        for operations not provided by swiftclient. `path` is relative to
+        the storage URL; other arguments are passed to `requests.request`."""
+        url, token = self._get_auth()
+        headers = kwargs.pop("headers", {})
+        headers["X-Auth-Token"] = token
+        url = url.rstrip("/")
+        if path:
+            url += "/" + path
+        return requests.request(method, url, headers=headers, **kwargs)
+
     def _get_container_info(self):
         try:
             headers, containers = self._connection.get_account()
@@ -1104,18 +4242,58 @@ class Project(object):
             c.grant_access("PUBLIC")
         logger.info("Successfully created the container named '{}'".format(container_name))
 
-    def rename_container(self):
+    def rename_container(self, container_name, new_name, workers=8):
         """
         Rename a container inside the current project
 
+        Swift does not support renaming containers directly (see
+        https://bugs.launchpad.net/swift/+bug/1231540), so a new container
+        is created with the same access permissions, metadata and settings,
+        the files are copied to it on the server, several at a time, and the
+        old container is deleted. The segments of large files are not copied:
+        they stay in the container where they were uploaded, and the moved
+        files still refer to them.
+
+        Parameters
+        ----------
+        container_name : string
+            name of container to be renamed
+        new_name : string
+            new name to be assigned to container
+        workers : int, optional
+            Number of files to copy in parallel.
+
+        Returns
+        -------
+        'hbp_archive.Container'
+            The renamed container.
+
         Note
         ----
         Use restricted to Superusers/Operators.
         """
-        raise NotImplementedError("It is not possible to directly rename a container."
-            "\nSee 'https://bugs.launchpad.net/swift/+bug/1231540' for more details."
-            "\nWorkaround: copy contents of existing container to a new container "
-            "(with desired name) and then delete the old container.")
+        container_names = self.container_names
+        if container_name not in container_names:
+            raise Exception("Container named '{}' does not exist, or you don't have access to it!".format(container_name))
+        if new_name in container_names:
+            raise Exception("Container named '{}' already exists!".format(new_name))
+        source = self.get_container(container_name)
+        headers = {key: value for key, value in source.metadata.items()
+                   if key in CONTAINER_SETTINGS_HEADERS or key.startswith("x-container-meta-")}
+        self._connection.put_container(new_name, headers=headers)
+        target = self.get_container(new_name)
+        result = source.replicate_to(target, workers=workers, delete_source=True)
+        if result.failed:
+            raise Exception("Unable to copy {} file(s) to container '{}'; container '{}' has not been deleted. "
+                            "Failed files: {}".format(len(result.failed), new_name, container_name,
+                                                      sorted(result.failed)))
+        remaining = source.list()
+        if remaining:
+            raise Exception("Unable to delete {} file(s) from container '{}'".format(len(remaining), container_name))
+        self._connection.delete_container(container_name)
+        del self._containers[container_name]
+        logger.info("Successfully renamed the container '{}' to '{}'".format(container_name, new_name))
+        return target
 
     def delete_container(self, container_name):
         """
@@ -1145,6 +4323,115 @@ class Project(object):
         self._connection.delete_container(container_name) # doesn't return anything on success
         logger.info("Successfully deleted the container named '{}'. '{}' item(s) deleted.".format(container_name, c.count()))
 
+    def set_access(self, containers, users, mode='read', action='grant', workers=8):
+        """
+        Grant or revoke access to several containers for several users at once.
+
+        The access control list of each container is retrieved once, modified
+        for all the users, and updated with a single request; the containers
+        are updated in parallel.
+
+        Parameters
+        ----------
+        containers : string, `hbp_archive.Container`, or list of these
+            container(s) whose access is to be changed.
+        users : string, list of strings
+            username(s) of the users concerned; 'PUBLIC' stands for public
+            read-only access (no password required).
+        mode : string, optional
+            the access permission concerned: 'read'/'write'; default = 'read'
+        action : string, optional
+            'grant' (default) to give the users access, 'revoke' to remove their
+            access, or 'set' to give access to exactly these users, removing it from all others.
+            Referrer grants and grants to other projects are never changed.
+        workers : int, optional
+            number of containers to update in parallel.
+
+        Returns
+        -------
+        `hbp_archive.TransferResult`
+            `completed` maps the name of each container whose access has
+            changed to a dict with keys 'added' and 'removed', each a list of
+            usernames; `skipped` lists the containers which needed no change,
+            and `failed` maps container names to the exception raised when updating them.
+
+        Note
+        ----
+        Use restricted to Superusers/Operators.
+        """
+        if mode not in ("read", "write"):
+            raise ValueError("mode must be 'read' or 'write'")
+        if action not in ("grant", "revoke", "set"):
+            raise ValueError("action must be 'grant', 'revoke' or 'set'")
+        if isinstance(users, str):
+            users = [users]
+        if isinstance(containers, (str, Container)):
+            containers = [containers]
+        if "PUBLIC" in users and mode != "read":
+            raise ValueError("Public access can only be given for reading")
+        user_id_map = self.users
+        name_map = {v: k for k, v in user_id_map.items()}
+        unknown = [username for username in users if username != "PUBLIC" and username not in name_map]
+        if unknown:
+            raise ValueError("Unknown user(s): {}".format(", ".join(unknown)))
+        public_items = ['.r:*', '.rlistings']
+        requested = set(name_map.get(username, "PUBLIC") for username in users)
+
+        def managed_user(item):
+            if item in public_items:
+                return "PUBLIC"
+            project_id, _, user_id = item.partition(":")
+            if project_id == self.id and user_id and user_id != "*":
+                return user_id
+            return None
+
+        def update(container):
+            name = getattr(container, "name", container)
+            headers = self._connection.head_container(name)
+            acl = [item for item in headers.get('x-container-{}'.format(mode), "").split(",") if item]
+            # only the public items and the "project:user_id" items of this project are managed here;
+            # referrer, cross-project and other projects' grants are always kept
+            managed = dict((item, managed_user(item)) for item in acl)
+            current = set(user_id for user_id in managed.values() if user_id is not None)
+            if action == "grant":
+                added, removed = requested - current, set()
+            elif action == "revoke":
+                added, removed = set(), requested & current
+            else:
+                added, removed = requested - current, current - requested
+            if not (added or removed):
+                return name, None
+            new_acl = [item for item in acl if managed[item] is None or managed[item] not in removed]
+            for user_id in sorted(added):
+                if user_id == "PUBLIC":
+                    new_acl.extend(public_items)
+                else:
+                    new_acl.append("{}:{}".format(self.id, user_id))
+            self._connection.post_container(name, {"x-container-{}".format(mode): ",".join(new_acl)})
+            for cached in (container, (self._containers or {}).get(name)):
+                if isinstance(cached, Container):
+                    cached._metadata = None  # needs to be refreshed
+            return name, {"added": sorted(user_id_map.get(user_id, user_id) for user_id in added),
+                          "removed": sorted(user_id_map.get(user_id, user_id) for user_id in removed)}
+
+        result = TransferResult()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(update, container): getattr(container, "name", container)
+                       for container in containers}
+            for future in as_completed(futures):
+                try:
+                    name, change = future.result()
+                except Exception as err:
+                    logger.warning("Unable to change access to container '{}': {}".format(futures[future], err))
+                    result.failed[futures[future]] = err
+                    continue
+                if change is None:
+                    result.skipped.append(name)
+                else:
+                    logger.info("Changed {} access to container '{}': {}".format(mode, name, change))
+                    result.completed[name] = change
+        return result
+
     def get_container(self, name):
         """Get a container from project.
 
@@ -1176,7 +4463,8 @@ class Project(object):
         """
         if self._containers is None:
             self._containers = {name: Container(name, username=self.archive.username, project=self)
-                                for name in self.container_names if not name.endswith("_versions")}
+                                for name in self.container_names
+                                if not name.endswith(("_versions", "_segments"))}
         return self._containers
 
     @property
@@ -1215,10 +4503,160 @@ class Project(object):
         return self._user_id_map
 
 
+class Inventory(object):
+    """An index of the files in the archive, stored in an SQLite database.
+
+    An inventory is created or updated with :meth:`Archive.build_inventory`.
+    Once built, it can be opened and queried without a network connection::
+
+        inventory = Inventory("archive.sqlite")
+        large_nwb_files = inventory.find(extension=".nwb", min_size=1073741824)
+
+    The following actions can be performed:
+
+    ====================================   ====================================
+    Action                                 Method
+    ====================================   ====================================
+    Search for files                       :meth:`find`
+    List indexed containers                :meth:`containers`
+    Run an arbitrary SQL query             :meth:`query`
+    ====================================   ====================================
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS containers (
+            project TEXT, name TEXT, count INTEGER, bytes INTEGER, last_modified TEXT,
+            PRIMARY KEY (project, name));
+        CREATE TABLE IF NOT EXISTS files (
+            project TEXT, container TEXT, name TEXT, extension TEXT, bytes INTEGER,
+            hash TEXT, content_type TEXT, last_modified TEXT,
+            PRIMARY KEY (project, container, name));
+        CREATE INDEX IF NOT EXISTS files_name ON files (name);
+        CREATE INDEX IF NOT EXISTS files_extension ON files (extension, bytes);
+        CREATE INDEX IF NOT EXISTS files_bytes ON files (bytes);
+        CREATE INDEX IF NOT EXISTS files_hash ON files (hash, bytes);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.executescript(self.schema)
+
+    def __repr__(self):
+        return "Inventory('{}')".format(self.path)
+
+    def close(self):
+        self._db.close()
+
+    def query(self, sql, parameters=()):
+        """Run an SQL query against the inventory.
+
+        The database contains two tables, "containers" (project, name, count,
+        bytes, last_modified) and "files" (project, container, name,
+        extension, bytes, hash, content_type, last_modified).
+
+        Returns
+        -------
+        list
+            List of dicts, one per row.
+        """
+        return [dict(row) for row in self._db.execute(sql, parameters)]
+
+    def containers(self, project=None):
+        """List the containers in the inventory, with their size and number of files."""
+        if project:
+            return self.query("SELECT * FROM containers WHERE project = ? ORDER BY project, name", (project,))
+        return self.query("SELECT * FROM containers ORDER BY project, name")
+
+    def find(self, name=None, extension=None, min_size=None, max_size=None, project=None, container=None,
+             content_type=None, hash=None, newer_than=None, older_than=None):
+        """Search for files in the inventory.
+
+        Parameters
+        ----------
+        name : string, optional
+            pattern to match against file paths, in which "*" matches any
+            sequence of characters and "?" matches a single character.
+        extension : string, optional
+            file extension, e.g. ".nwb" (case insensitive).
+        min_size, max_size : int, optional
+            limits on file size, in bytes.
+        project, container : string, optional
+            restrict the search to a given project and/or container.
+        content_type : string, optional
+            content type of files.
+        hash : string, optional
+            MD5 checksum (ETag) of files.
+        newer_than, older_than : datetime, optional
+            limits on the last-modified time of files.
+
+        Returns
+        -------
+        list
+            List of dicts, with keys "project", "container", "name",
+            "extension", "bytes", "hash", "content_type" and "last_modified".
+        """
+        conditions = []
+        parameters = []
+        for column, operator, value in (("name", "GLOB", name),
+                                        ("extension", "=", extension and extension.lower()),
+                                        ("bytes", ">=", min_size),
+                                        ("bytes", "<=", max_size),
+                                        ("project", "=", project),
+                                        ("container", "=", container),
+                                        ("content_type", "=", content_type),
+                                        ("hash", "=", hash),
+                                        ("last_modified", ">=", newer_than and newer_than.strftime(LISTING_DATE_FORMAT)),
+                                        ("last_modified", "<=", older_than and older_than.strftime(LISTING_DATE_FORMAT))):
+            if value is not None:
+                conditions.append("{} {} ?".format(column, operator))
+                parameters.append(value)
+        sql = "SELECT * FROM files"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return self.query(sql + " ORDER BY project, container, name", parameters)
+
+    def _is_current(self, project, container_info):
+        row = self._db.execute("SELECT count, bytes, last_modified FROM containers WHERE project = ? AND name = ?",
+                               (project, container_info["name"])).fetchone()
+        return row is not None and tuple(row) == (container_info["count"], container_info["bytes"],
+                                                  container_info.get("last_modified"))
+
+    def _update_container(self, project, container_info, contents):
+        with self._db:
+            self._db.execute("DELETE FROM files WHERE project = ? AND container = ?",
+                             (project, container_info["name"]))
+            self._db.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((project, container_info["name"], item["name"], os.path.splitext(item["name"])[1].lower(),
+                  item["bytes"], item["hash"], item["content_type"], item["last_modified"])
+                 for item in contents))
+            self._db.execute("INSERT OR REPLACE INTO containers VALUES (?, ?, ?, ?, ?)",
+                             (project, container_info["name"], container_info["count"],
+                              container_info["bytes"], container_info.get("last_modified")))
+
+    def _remove_missing_containers(self, project, container_names):
+        with self._db:
+            for (name,) in self._db.execute("SELECT name FROM containers WHERE project = ?", (project,)).fetchall():
+                if name not in container_names:
+                    self._db.execute("DELETE FROM files WHERE project = ? AND container = ?", (project, name))
+                    self._db.execute("DELETE FROM containers WHERE project = ? AND name = ?", (project, name))
+
+
+_KeystoneProject = collections.namedtuple("_KeystoneProject", ["id", "name"])
+
+
 class Archive(object):
     """A representation of the Human Brain Project archival storage
     (Pollux SWIFT) at CSCS.
 
+    :class:`Archive`, :class:`Project`, :class:`Container` and :class:`File`
+    objects can be pickled, e.g. to send them to other processes with
+    :mod:`multiprocessing` or to dask workers. The pickled form contains an
+    authentication token rather than your password, so treat it as a secret;
+    it is valid only until the token expires.
+
     The following actions can be performed:
 
     ====================================   ====================================
@@ -1226,6 +4664,7 @@ class Archive(object):
     ====================================   ====================================
     List projects that you can access      :attr:`projects`
     Search for container in all projects   :meth:`find_container`
+    Build a searchable index of all files  :meth:`build_inventory`
     ====================================   ====================================
     """
 
@@ -1256,6 +4695,22 @@ class Archive(object):
                              for ksprj in self._client.projects.list(user=self.user_id)}
         self._projects = None
 
+    def __getstate__(self):
+        # keystone sessions and clients cannot be pickled, so keep only the token
+        return {"username": self.username,
+                "user_id": self.user_id,
+                "token": self._session.get_token(),
+                "projects": {name: ksprj.id for name, ksprj in self._ks_projects.items()}}
+
+    def __setstate__(self, state):
+        self.username = state["username"]
+        self.user_id = state["user_id"]
+        self._session = session.Session(auth=v3.Token(auth_url=OS_AUTH_URL, token=state["token"]))
+        self._client = ksclient.Client(session=self._session, interface='public')
+        self._ks_projects = {name: _KeystoneProject(project_id, name)
+                             for name, project_id in state["projects"].items()}
+        self._projects = None
+
     @property
     def projects(self):
         """Projects you have access to
@@ -1292,3 +4747,64 @@ class Archive(object):
                 pass
         raise ValueError(
             "Container {} not found. Please check your access permissions.".format(container))
+
+    def build_inventory(self, path, projects=None, workers=4):
+        """Create or update an index of all the files in the archive.
+
+        Only containers whose number of files, total size or modification
+        time have changed since the inventory was last updated are listed again.
+
+        Parameters
+        ----------
+        path : string
+            Path of the SQLite database file in which the inventory is stored.
+        projects : list of strings, optional
+            Names of the projects to include; default is all projects you have access to.
+        workers : int, optional
+            Number of projects and containers to list in parallel.
+
+        Returns
+        -------
+        `hbp_archive.Inventory`
+            The updated inventory.
+        """
+        inventory = Inventory(path)
+        if projects is None:
+            projects = list(self.projects.values())
+        else:
+            projects = [self.projects[name] for name in projects]
+
+        def list_account(project):
+            # unlike Project._get_container_info(), errors are not hidden, as an
+            # empty list would remove all the containers of the project from the inventory
+            try:
+                headers, containers = project._connection.get_account(full_listing=True)
+            except ClientException as err:
+                logger.warning("Unable to list containers of project '{}': {}".format(project.name, err))
+                return None
+            return containers
+
+        def list_container(project, container_info):
+            headers, contents = project._connection.get_container(container_info["name"], full_listing=True)
+            return contents
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            container_infos = dict(zip(projects, executor.map(list_account, projects)))
+            futures = {}
+            for project, infos in container_infos.items():
+                if infos is None:
+                    continue  # keep the previous inventory for this project
+                inventory._remove_missing_containers(project.name, set(info["name"] for info in infos))
+                for info in infos:
+                    if not inventory._is_current(project.name, info):
+                        futures[executor.submit(list_container, project, info)] = (project, info)
+            for future in as_completed(futures):
+                project, info = futures[future]
+                try:
+                    contents = future.result()
+                except ClientException as err:
+                    logger.warning("Unable to list container '{}/{}': {}".format(project.name, info["name"], err))
+                else:
+                    inventory._update_container(project.name, info, contents)
+                    logger.info("Updated inventory for '{}/{}'".format(project.name, info["name"]))
+        return inventory
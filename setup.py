@@ -36,5 +36,13 @@ setup(
                       'keystoneauth1',
                       'python-keystoneclient',
                       'python-swiftclient',
-                      'pathlib2;python_version<"3"',]
+                      'pathlib2;python_version<"3"',
+                      'futures;python_version<"3"',],
+    extras_require={
+        'zstd': ['zstandard'],
+        'fsspec': ['fsspec'],
+    },
+    entry_points={
+        'fsspec.specs': ['hbp=hbp_archive.HBPArchiveFileSystem'],
+    }
 )
@@ -18,10 +18,47 @@ Unit tests for hbp_archive
 
 """
 
+import array
+import collections
+import gc
+import hashlib
+import io
+import json
 import os
+import pickle
+import tarfile
+import tempfile
+import threading
+import zlib
 import mock
-from unittest import TestCase
-from hbp_archive import Archive, Project, Container, PublicContainer
+from unittest import TestCase, skipUnless
+import hbp_archive
+from hbp_archive import (Archive, Project, Container, PublicContainer, File, Inventory, PackedStore,
+                         HBPArchiveFileSystem, fsspec_available)
+from swiftclient.exceptions import ClientException
+
+
+def mock_container(name="cont"):
+    """Return a Container with a mock project and connection, which never
+    contacts the archive."""
+    container = Container.__new__(Container)
+    container.name = name
+    container.project = mock.Mock(id="abc")
+    container._metadata = None
+    return container
+
+
+def mock_project(test_case, **properties):
+    """Return a Project with the id "abc", whose properties (e.g. `_connection`
+    or `users`) are replaced by the values given for the duration of the test."""
+    project = Project.__new__(Project)
+    project.id = "abc"
+    project._containers = None
+    for name, value in properties.items():
+        patch = mock.patch.object(Project, name, new_callable=mock.PropertyMock, return_value=value)
+        patch.start()
+        test_case.addCleanup(patch.stop)
+    return project
 
 
 class ArchiveTest(TestCase):
@@ -47,6 +84,15 @@ class ArchiveTest(TestCase):
     def test_find_container_with_invalid_name(self):
         self.assertRaises(ValueError, self.arch.find_container, "iucghaiwgcmazic84")
 
+    def test_build_inventory(self):
+        path = os.path.join(tempfile.mkdtemp(), "inventory.sqlite")
+        self.arch.build_inventory(path, projects=["bp00sp06"]).close()
+        inventory = Inventory(path)  # reopen, as when working offline
+        results = inventory.find(name="README.txt", container="sp6_validation_data")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["project"], "bp00sp06")
+        inventory.close()
+
 
 class ProjectTest(TestCase):
 
@@ -105,6 +151,26 @@ class ContainerTest(TestCase):
         content = self.container.read("README.txt")
         self.assertGreater(len(content), 0)
 
+    def test_usage(self):
+        usage = self.container.usage(depth=1)
+        markers = [f for f in self.container.list() if f.name.endswith("/")]
+        self.assertEqual(usage[""], (self.container.size(), self.container.count() - len(markers)))
+        self.assertEqual(sum(count for path, (size, count) in usage.items() if path),
+                         self.container.count() - len(self.container.tree().files))
+        self.assertIn("README.txt", self.container.tree().ls())
+
+    def test_diff_with_public_copy(self):
+        public = PublicContainer("https://object.cscs.ch/v1/AUTH_c0a333ecf7c045809321ce9d9ecdfdea/sp6_validation_data")
+        self.assertEqual(list(self.container.diff(public)), [])
+        entries = list(self.container.diff(public, include_unchanged=True))
+        self.assertEqual(len(entries), self.container.count())
+
+    def test_pickle(self):
+        container = pickle.loads(pickle.dumps(self.container))
+        self.assertEqual(container.read("README.txt"), self.container.read("README.txt"))
+        f = pickle.loads(pickle.dumps(self.container.get("README.txt")))
+        self.assertEqual(f.read(), self.container.read("README.txt"))
+
     def test_access_control(self):
         self.assertEqual(self.container.access_control(),
                          {'read': [], 'write': []})  # empty for normal user account
@@ -162,6 +228,45 @@ class PublicContainerTest(TestCase):
         content = self.container.read("README.txt")
         self.assertGreater(len(content), 0)
 
+    def test_metadata(self):
+        self.assertEqual(self.container.count(), len(self.container.list()))
+        self.assertEqual(self.container.size(), sum(f.bytes for f in self.container.list()))
+        self.assertIn("x-container-object-count", self.container.metadata)
+
+    def test_list_refresh(self):
+        names = [f.name for f in self.container.list()]
+        self.assertEqual([f.name for f in self.container.list(refresh=True)], names)
+        self.assertEqual([f.name for f in self.container.list(prefix="README", refresh=True)],
+                         [name for name in names if name.startswith("README")])
+
+    def test_open(self):
+        with self.container.open("README.txt") as fp:
+            self.assertEqual(fp.read(), self.container.read("README.txt"))
+        with self.container.open("README.txt", "rb") as fp:
+            fp.seek(3)
+            self.assertEqual(fp.read(5), self.container.read("README.txt", decode=False)[3:8])
+
+    def test_read_into(self):
+        content = self.container.read("README.txt", decode=False)
+        buffer = bytearray(len(content) + 10)
+        self.assertEqual(self.container.read_into("README.txt", buffer), len(content))
+        self.assertEqual(bytes(buffer[:len(content)]), content)
+        buffer = bytearray(5)
+        self.assertEqual(self.container.read_into("README.txt", buffer, offset=3), 5)
+        self.assertEqual(bytes(buffer), content[3:8])
+
+    def test_iter_files(self):
+        expected = [f.name for f in self.container.list()]
+        self.assertEqual([f.name for f in self.container.iter_files(workers=4)], expected)
+        self.assertEqual(sorted(f.name for f in self.container.iter_files(workers=4, ordered=False)), sorted(expected))
+
+    def test_iter_files_sharded(self):
+        expected = sorted(f.name for f in self.container.list())
+        for partition in ("hash", "range"):
+            shards = [[f.name for f in self.container.iter_files(shard=i, num_shards=3, partition=partition)]
+                      for i in range(3)]
+            self.assertEqual(sorted(sum(shards, [])), expected)
+
     def test_download(self):
         test_filename = "README.txt"
         tmp_testdir = "tmp_test"
@@ -175,6 +280,80 @@ class PublicContainerTest(TestCase):
 
         os.remove(local_path)
 
+    def test_download_resume_with_stale_checkpoint(self):
+        test_filename = "README.txt"
+        tmp_testdir = "tmp_test"
+        expected_local_path = os.path.abspath(os.path.join(tmp_testdir, test_filename))
+        if not os.path.exists(tmp_testdir):
+            os.makedirs(tmp_testdir)
+        with open(expected_local_path + ".part", "wb") as fp:
+            fp.write(b"garbage")
+        with open(expected_local_path + ".part.json", "w") as fp:
+            fp.write('{"etag": "outdated", "bytes": 7, "ranges": [[0, 7]]}')
+
+        local_path = self.container.download(test_filename, local_directory=tmp_testdir, overwrite=True)
+        with open(local_path) as fp:
+            self.assertEqual(fp.read(), self.container.read(test_filename))
+        self.assertFalse(os.path.exists(local_path + ".part"))
+        self.assertFalse(os.path.exists(local_path + ".part.json"))
+
+        os.remove(local_path)
+
+    def test_download_many(self):
+        tmp_testdir = "tmp_test_many"
+        result = self.container.download_many(["README.txt", "does_not_exist.txt"],
+                                               local_directory=tmp_testdir, overwrite=True)
+        self.assertEqual(list(result.completed), ["README.txt"])
+        self.assertEqual(list(result.failed), ["does_not_exist.txt"])
+        self.assert_(os.path.exists(result.completed["README.txt"]))
+
+        os.remove(result.completed["README.txt"])
+
+    def test_head_many(self):
+        result = self.container.head_many(["README.txt", "does_not_exist.txt"])
+        self.assertEqual(list(result.failed), ["does_not_exist.txt"])
+        f = result.completed["README.txt"]
+        self.assertEqual(f.bytes, self.container.get("README.txt").bytes)
+        self.assertIsInstance(f.metadata, dict)
+
+    def test_read_many(self):
+        result = self.container.read_many(["README.txt", "does_not_exist.txt"])
+        self.assertEqual(result.completed, {"README.txt": self.container.read("README.txt")})
+        self.assertEqual(list(result.failed), ["does_not_exist.txt"])
+
+    def test_iter_contents(self):
+        files = self.container.list()[:5]
+        self.assertEqual([(f.name, contents) for f, contents in self.container.iter_contents(files, prefetch=2)],
+                         [(f.name, self.container.read(f.name, decode=False)) for f in files])
+
+    def test_scrub(self):
+        report = self.container.scrub(prefix="README")
+        self.assertTrue(report.ok)
+        self.assertEqual(report.verified, len(self.container.list(prefix="README")))
+
+    def test_export_archive(self):
+        # export only the smallest top-level directory, so the archive held in memory stays small
+        usage = self.container.usage(depth=1)
+        directory = min((path for path in usage if path), key=lambda path: usage[path][0])
+        buffer = io.BytesIO()
+        exported = self.container.export_archive(directory, buffer, format="tar")
+        buffer.seek(0)
+        archive = tarfile.open(fileobj=buffer)
+        self.assertEqual(archive.getnames(), [f.name for f in exported])
+        self.assertEqual(archive.getnames(), [f.name for f in self.container.list(prefix=directory)])
+        name = exported[0].name
+        self.assertEqual(archive.extractfile(name).read(), self.container.read(name, decode=False))
+
+    @skipUnless(fsspec_available, "fsspec is not installed")
+    def test_fsspec(self):
+        fs = HBPArchiveFileSystem()
+        path = self.container.public_url + "/README.txt"
+        self.assertEqual(fs.cat(path).decode("utf-8"), self.container.read("README.txt"))
+        with fs.open(path) as fp:
+            fp.seek(2)
+            self.assertEqual(fp.read(5), fs.cat_file(path, 2, 7))
+        self.assertIn("README.txt", [name.split("/")[-1] for name in fs.ls(path.rsplit("/", 1)[0], detail=False)])
+
 
 class FileTest(TestCase):
 
@@ -186,3 +365,936 @@ class FileTest(TestCase):
         content1 = self.container.read("README.txt")
         content2 = self.container.get("README.txt").read()
         self.assertEqual(content1, content2)
+
+
+class BulkTest(TestCase):
+    """Tests of the handling of tar streams and bulk middleware reports, which
+    do not need a connection to the archive."""
+
+    def setUp(self):
+        self.container = mock_container()
+        self.directory = tempfile.mkdtemp()
+        self.batch = []
+        for name in ("a.txt", "b.txt", "c.txt"):
+            local_path = os.path.join(self.directory, name)
+            with open(local_path, "wb") as fp:
+                fp.write(name.encode("utf-8") * 100)
+            self.batch.append((local_path, "dir/" + name, os.path.getsize(local_path)))
+
+    def extract(self, report):
+        self.container.project._request.return_value.json.return_value = report
+        with mock.patch.object(Container, "_upload_file") as upload_file:
+            remote_paths = self.container._extract_archive(self.batch)
+        self.assertEqual(remote_paths, [remote_path for local_path, remote_path, size in self.batch])
+        return sorted(call[0][1] for call in upload_file.call_args_list)
+
+    def test_iter_tar(self):
+        members = []
+        for local_path, remote_path, size in self.batch:
+            tarinfo = tarfile.TarInfo(remote_path)
+            tarinfo.size = size
+            with open(local_path, "rb") as fp:
+                members.append((tarinfo, [fp.read()]))
+        data = b"".join(hbp_archive._iter_tar(members))
+        self.assertEqual(len(data) % tarfile.RECORDSIZE, 0)
+        archive = tarfile.open(fileobj=io.BytesIO(data))
+        self.assertEqual(archive.getnames(), ["dir/a.txt", "dir/b.txt", "dir/c.txt"])
+        self.assertEqual(archive.extractfile("dir/b.txt").read(), b"b.txt" * 100)
+
+    def test_iter_tar_size_changed(self):
+        tarinfo = tarfile.TarInfo("x")
+        tarinfo.size = 10
+        self.assertRaises(IOError, list, hbp_archive._iter_tar([(tarinfo, [b"short"])]))
+
+    def test_extract_archive_success(self):
+        self.assertEqual(self.extract({"Response Status": "201 Created", "Number Files Created": 3,
+                                       "Errors": []}), [])
+
+    def test_extract_archive_partial_failure(self):
+        self.assertEqual(self.extract({"Response Status": "400 Bad Request", "Number Files Created": 2,
+                                       "Errors": [["/v1/AUTH_abc/cont/dir/b.txt", "503 Service Unavailable"]]}),
+                         ["dir/b.txt"])
+
+    def test_extract_archive_request_failed(self):
+        # failures of the whole request are reported in the body, with no per-file errors
+        for report in ({"Response Status": "400 Bad Request", "Response Body": "Invalid Tar File",
+                        "Number Files Created": 0, "Errors": []},
+                       {"Response Status": "201 Created", "Number Files Created": 1, "Errors": []},
+                       {}):
+            self.assertEqual(self.extract(report), ["dir/a.txt", "dir/b.txt", "dir/c.txt"])
+
+
+class PackedStoreTest(TestCase):
+    """Tests of PackedStore using an in-memory stand-in for the object store."""
+
+    def setUp(self):
+        self.objects = {}
+        self.container = mock_container()
+        self.container.project._connection.put_object.side_effect = self.put_object
+        self.container.project._connection.get_object.side_effect = self.get_object
+        self.public_container = PublicContainer("https://object.cscs.ch/v1/AUTH_abc/cont")
+        self.public_container._session = mock.Mock()
+        self.public_container._session.get.side_effect = self.public_get
+        self.cache_path = os.path.join(tempfile.mkdtemp(), "index.json")
+
+    def put_object(self, container_name, path, contents, content_type=None):
+        self.objects[path] = contents
+        return hashlib.md5(contents).hexdigest()
+
+    def get_object(self, container_name, path, resp_chunk_size=None, headers=None):
+        response = self.public_get(path, headers=headers)
+        if response.status_code != 200:
+            raise ClientException(response.reason, http_status=response.status_code)
+        return {"etag": response.headers["ETag"]}, iter([response.content])
+
+    def public_get(self, url, headers=None, stream=False):
+        path = url.split("/cont/", 1)[-1]
+        headers = headers or {}
+        response = mock.Mock(status_code=200, ok=True, reason="OK", content=b"", headers={})
+        if path not in self.objects:
+            response.status_code, response.ok, response.reason = 404, False, "Not Found"
+            return response
+        contents = self.objects[path]
+        response.headers["ETag"] = hashlib.md5(contents).hexdigest()
+        if headers.get("If-None-Match") == response.headers["ETag"]:
+            response.status_code, response.reason = 304, "Not Modified"
+        elif "Range" in headers:
+            start, end = [int(value) for value in headers["Range"].split("=")[1].split("-")]
+            response.content = contents[start:end + 1]
+        else:
+            response.content = contents
+        response.iter_content.return_value = iter([response.content])
+        return response
+
+    def test_put_get(self):
+        with PackedStore(self.container, "store", cache_path=self.cache_path) as store:
+            store.put("a", b"first")
+            store.put("b", b"")
+            self.assertEqual(store.get("a"), b"first")  # before flushing
+        self.assertEqual(len([path for path in self.objects if path.startswith("store/packs/")]), 1)
+        store = PackedStore(self.container, "store")
+        self.assertEqual(store.names(), ["a", "b"])
+        self.assertEqual(store.get("a"), b"first")
+        self.assertEqual(store.get("b"), b"")
+        self.assertRaises(ValueError, store.get, "c")
+
+    def test_refresh_not_modified(self):
+        with PackedStore(self.container, "store", cache_path=self.cache_path) as store:
+            store.put("a", b"first")
+        # the cached index is still valid, so the server replies "304 Not Modified"
+        for container in (self.container, self.public_container):
+            store = PackedStore(container, "store", cache_path=self.cache_path)
+            store.refresh()
+            self.assertEqual(store.get("a"), b"first")
+        with PackedStore(self.container, "store") as store:
+            store.put("b", b"second")
+        store = PackedStore(self.public_container, "store", cache_path=self.cache_path)
+        self.assertEqual(store.names(), ["a", "b"])
+
+
+class ObjectWriterTest(TestCase):
+    """Tests of Container.open in write mode, with a mock connection."""
+
+    def setUp(self):
+        self.container = mock_container()
+        self.put_object = self.container.project._connection.put_object
+
+    def test_write(self):
+        for mode, data in (("w", u"complete"), ("wb", b"complete")):
+            with self.container.open("out.txt", mode) as fp:
+                fp.write(data)
+        self.assertEqual([call[0][2] for call in self.put_object.call_args_list], [b"complete", b"complete"])
+
+    def test_write_memoryview(self):
+        with self.container.open("out.dat", "wb") as fp:
+            self.assertEqual(fp.write(memoryview(array.array("i", [1, 2, 3]))), 12)
+        self.assertEqual(len(self.put_object.call_args[0][2]), 12)
+
+    def test_replace_large_file(self):
+        self.container._metadata = {}
+        self.container.project._connection.head_object.return_value = {"x-static-large-object": "True"}
+        manifest = [{"name": "/cont_segments/out.dat/slo/0123/00000000", "hash": "h", "bytes": 1048576},
+                    {"name": "/cont_segments/other.dat/slo/4567/00000000", "hash": "h", "bytes": 1048576},
+                    {"name": "/elsewhere/out.dat/slo/89ab/00000000", "hash": "h", "bytes": 1}]
+        self.container.project._connection.get_object.return_value = ({}, json.dumps(manifest).encode("utf-8"))
+        delete_object = self.container.project._connection.delete_object
+        with self.container.open("out.dat", "wb") as fp:
+            fp.write(b"data")
+        delete_object.assert_called_once_with("cont_segments", "out.dat/slo/0123/00000000")
+        # previous versions still need their segments
+        delete_object.reset_mock()
+        self.container._metadata = {"x-versions-location": "cont_versions"}
+        with self.container.open("out.dat", "wb") as fp:
+            fp.write(b"data")
+        self.assertFalse(delete_object.called)
+
+    def test_content_type(self):
+        for file_path, content_type, expected in (("out.txt", None, "text/plain"),
+                                                  ("out.json", None, "application/json"),
+                                                  ("out.txt", "text/csv", "text/csv"),
+                                                  ("out", None, None)):
+            with self.container.open(file_path, "wb", content_type=content_type) as fp:
+                fp.write(b"data")
+            self.assertEqual(self.put_object.call_args[1]["content_type"], expected)
+
+    def test_exception_discards_data(self):
+        for mode, data in (("w", u"partial"), ("wb", b"partial")):
+            try:
+                with self.container.open("out.txt", mode) as fp:
+                    fp.write(data)
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+        self.assertFalse(self.put_object.called)
+
+    def test_not_closed_discards_data(self):
+        for mode, data in (("w", u"partial"), ("wb", b"partial")):
+            fp = self.container.open("out.txt", mode)
+            fp.write(data)
+            del fp
+            gc.collect()
+        self.assertFalse(self.put_object.called)
+
+
+class DeduplicateTest(TestCase):
+    """Tests of uploading with `dedup=True`, with a mock connection."""
+
+    def setUp(self):
+        self.container = mock_container()
+        self.container.project.archive._ks_projects = {"other": mock.Mock(id="def")}
+        self.put_object = self.container.project._connection.put_object
+        self.local_path = os.path.join(tempfile.mkdtemp(), "data.txt")
+        with open(self.local_path, "wb") as fp:
+            fp.write(b"contents")
+        self.checksum = hashlib.md5(b"contents").hexdigest()
+
+    def upload(self, existing_files, index=None):
+        with mock.patch.object(Container, "list", return_value=existing_files):
+            return self.container.upload(self.local_path, "new", dedup=True, index=index)
+
+    def copy_sources(self):
+        return [call[1]["headers"]["X-Copy-From"] for call in self.put_object.call_args_list
+                if call[1].get("headers")]
+
+    def test_copy_identical_file(self):
+        existing = File("old/data.txt", 8, "text/plain", self.checksum, "2020-01-01T00:00:00.000000",
+                        container=mock.Mock(public_url=None))
+        self.assertEqual(self.upload([existing]), ["new/data.txt"])
+        self.assertEqual(self.copy_sources(), ["/cont/old/data.txt"])
+        self.assertEqual(self.put_object.call_count, 1)
+
+    def test_identical_file_in_place(self):
+        existing = File("new/data.txt", 8, "text/plain", self.checksum, "2020-01-01T00:00:00.000000",
+                        container=mock.Mock(public_url=None))
+        with mock.patch.object(Container, "list", return_value=[existing]):
+            self.assertEqual(self.container.upload(self.local_path, "new", overwrite=True, dedup=True),
+                             ["new/data.txt"])
+        self.assertFalse(self.put_object.called)
+
+    def test_stale_index(self):
+        index = mock.Mock()
+        index.find.return_value = [{"project": "other", "container": "deleted", "name": "data.txt"}]
+
+        def put_object(container_name, path, contents, headers=None, query_string=None):
+            if headers:
+                raise ClientException("Not Found", http_status=404)
+        self.put_object.side_effect = put_object
+        self.assertEqual(self.upload([], index), ["new/data.txt"])
+        self.assertEqual(self.copy_sources(), ["/deleted/data.txt"])
+        self.assertEqual(self.put_object.call_count, 2)  # the failed copy, then the upload
+
+
+class ReplicateTest(TestCase):
+    """Tests of moving files with `replicate_to`, with mock connections."""
+
+    def setUp(self):
+        self.source, self.target = mock_container("src"), mock_container("dst")
+        self.source.list = mock.Mock(return_value=[
+            File(name, 1, "text/plain", "h", "2020-01-01T00:00:00.000000",
+                 container=mock.Mock(public_url=None))
+            for name in ("a.txt", "b.txt", "c.txt")])
+        self.target.list = mock.Mock(return_value=[])
+        self.target._server_side_copy = mock.Mock()
+
+    def move(self, report):
+        self.source.project._request.return_value.json.return_value = report
+        return self.source.replicate_to(self.target, delete_source=True)
+
+    def test_delete_failures_reported(self):
+        result = self.move({"Response Status": "400 Bad Request", "Number Deleted": 2, "Number Not Found": 0,
+                            "Errors": [["/src/b.txt", "409 Conflict"]]})
+        self.assertEqual(sorted(result.completed), ["a.txt", "c.txt"])
+        self.assertEqual(list(result.failed), ["b.txt"])
+        self.assertFalse(self.source.project._connection.delete_object.called)
+
+    def test_bulk_delete_request_failed(self):
+        self.source.project._connection.delete_object.side_effect = [None, ClientException("", http_status=503),
+                                                                     None]
+        result = self.move({"Response Status": "413 Request Entity Too Large", "Errors": []})
+        self.assertEqual(self.source.project._connection.delete_object.call_count, 3)
+        self.assertEqual(len(result.completed), 2)
+        self.assertEqual(len(result.failed), 1)
+
+    def test_move_manifests(self):
+        # large files moved within a project keep their segments, but copies are independent
+        self.move({"Response Status": "200 OK", "Number Deleted": 3, "Errors": []})
+        self.source.replicate_to(self.target)
+        self.target.project.id = "def"
+        self.move({"Response Status": "200 OK", "Number Deleted": 3, "Errors": []})
+        self.assertEqual([call[0][4] for call in self.target._server_side_copy.call_args_list],
+                         [True] * 3 + [False] * 6)
+
+
+class RenameContainerTest(TestCase):
+    """Tests of Project.rename_container, with a mock connection."""
+
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.connection.head_container.return_value = {
+            "x-container-read": "abc:u1", "x-container-meta-experiment": "A", "x-versions-location": "old_versions",
+            "x-container-object-count": "1", "x-container-bytes-used": "10", "x-timestamp": "1577836800.00000"}
+        containers = {}
+        self.project = mock_project(self, _connection=self.connection, container_names=["old"],
+                                    containers=containers)
+        self.project._containers = containers
+        self.project.archive = mock.Mock(username="someone")
+        patches = [mock.patch.object(Container, "replicate_to", return_value=hbp_archive.TransferResult()),
+                   mock.patch.object(Container, "list", return_value=[])]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_settings_copied(self):
+        self.project._containers["old"] = Container("old", "someone", project=self.project)
+        target = self.project.rename_container("old", "new")
+        self.assertEqual(target.name, "new")
+        self.connection.put_container.assert_called_once_with("new", headers={
+            "x-container-read": "abc:u1", "x-container-meta-experiment": "A", "x-versions-location": "old_versions"})
+        Container.replicate_to.assert_called_once_with(target, workers=8, delete_source=True)
+        self.connection.delete_container.assert_called_once_with("old")
+
+
+class DirectoryTest(TestCase):
+    """Tests of PrefixTree and of the directory operations, with a mock connection."""
+
+    def setUp(self):
+        self.container = mock_container()
+        self.files = [File(name, size, "text/plain", "h", "2020-01-01T00:00:00.000000",
+                           container=mock.Mock(public_url=None))
+                      for name, size in (("dir/", 0), ("dir/a.txt", 10), ("dir/sub/", 0), ("dir/sub/b.txt", 20),
+                                         ("other.txt", 5))]
+        patches = [mock.patch.object(Container, "iter_files", return_value=self.files),
+                   mock.patch.object(Container, "list", side_effect=AssertionError("listed again"))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.container.project._request.return_value.json.return_value = {
+            "Response Status": "200 OK", "Number Deleted": 3, "Number Not Found": 0, "Errors": []}
+
+    def deleted(self):
+        return sorted(self.container.project._request.call_args[1]["data"].decode("utf-8").split("\n"))
+
+    def test_markers_not_counted(self):
+        tree = self.container.tree()
+        self.assertEqual((tree.count, tree.bytes), (3, 35))
+        self.assertEqual(tree.ls("dir"), ["a.txt", "sub/"])
+        self.assertEqual(tree.find("dir/sub").count, 1)
+        self.assertEqual([f.name for f in tree.iter_files()], ["other.txt", "dir/a.txt", "dir/sub/b.txt"])
+        self.assertEqual(self.container.usage(depth=1), collections.OrderedDict(
+            [("", (35, 3)), ("dir/", (30, 2))]))
+
+    def test_copy_directory(self):
+        self.container.copy_directory("dir", "copy")
+        self.assertEqual([call[1]["destination"] for call in
+                          self.container.project._connection.copy_object.call_args_list],
+                         ["cont/copy/a.txt", "cont/copy/b.txt"])
+
+    def test_move_directory(self):
+        self.container.move_directory("dir", "moved")
+        self.assertEqual(self.container.project._connection.copy_object.call_count, 2)
+        self.assertEqual(self.deleted(), ["/cont/dir/", "/cont/dir/a.txt", "/cont/dir/sub/", "/cont/dir/sub/b.txt"])
+
+    def test_delete_directory(self):
+        self.container.delete_directory("dir/sub")
+        self.assertEqual(self.deleted(), ["/cont/dir/sub/", "/cont/dir/sub/b.txt"])
+        self.assertFalse(self.container.project._connection.delete_object.called)
+        self.assertRaises(Exception, self.container.delete_directory, "missing")
+
+
+class UploadDirectoryTest(TestCase):
+    """Tests of Container.upload_directory, with a mock connection."""
+
+    def setUp(self):
+        self.container = mock_container()
+        self.directory = tempfile.mkdtemp()
+        for relative_path in ("a.txt", "sub/b.txt", "sub/deeper/c.txt"):
+            local_path = os.path.join(self.directory, *relative_path.split("/"))
+            if not os.path.exists(os.path.dirname(local_path)):
+                os.makedirs(os.path.dirname(local_path))
+            with open(local_path, "wb") as fp:
+                fp.write(relative_path.encode("utf-8"))
+
+    def upload(self, existing=(), **kwargs):
+        with mock.patch.object(Container, "iter_files", return_value=list(existing)), \
+                mock.patch.object(Container, "_upload_file") as upload_file:
+            result = self.container.upload_directory(self.directory, "remote/", **kwargs)
+        uploaded = sorted(call[0][1] for call in upload_file.call_args_list)
+        self.assertEqual(sorted(result.completed.values()), uploaded)
+        return result, uploaded
+
+    def test_upload_tree(self):
+        result, uploaded = self.upload()
+        self.assertEqual(uploaded, ["remote/a.txt", "remote/sub/b.txt", "remote/sub/deeper/c.txt"])
+        self.assertEqual(result.completed[os.path.join(self.directory, "sub", "b.txt")], "remote/sub/b.txt")
+
+    def test_skip_unchanged(self):
+        unchanged = File("remote/a.txt", 5, "text/plain", hashlib.md5(b"a.txt").hexdigest(),
+                         "2020-01-01T00:00:00.000000", container=mock.Mock(public_url=None))
+        changed = File("remote/sub/b.txt", 9, "text/plain", hashlib.md5(b"different").hexdigest(),
+                       "2020-01-01T00:00:00.000000", container=mock.Mock(public_url=None))
+        result, uploaded = self.upload([unchanged, changed])
+        self.assertEqual(uploaded, ["remote/sub/b.txt", "remote/sub/deeper/c.txt"])
+        self.assertEqual(result.skipped, [os.path.join(self.directory, "a.txt")])
+
+    def test_sharded(self):
+        shards = [self.upload(shard=i, num_shards=3)[1] for i in range(3)]
+        self.assertEqual(sorted(sum(shards, [])), ["remote/a.txt", "remote/sub/b.txt", "remote/sub/deeper/c.txt"])
+        for i, uploaded in enumerate(shards):
+            for remote_path in uploaded:
+                self.assertEqual(hbp_archive._shard_of(remote_path, 3), i)
+
+
+class CompressionTest(TestCase):
+    """Tests of uploading with `compress` and reading compressed files back,
+    using an in-memory stand-in for the object store."""
+
+    def setUp(self):
+        self.objects = {}  # path: (headers, contents)
+        self.container = mock_container()
+        connection = self.container.project._connection
+        connection.put_object.side_effect = self.put_object
+        connection.get_object.side_effect = self.get_object
+        connection.head_object.side_effect = lambda container_name, path: dict(self.objects[path][0])
+        connection.get_container.side_effect = self.get_container
+        self.directory = tempfile.mkdtemp()
+        self.local_paths = []
+        for name, data in (("a.txt", b"abc" * 1000), ("b.txt", b""), ("c.dat", os.urandom(3000))):
+            local_path = os.path.join(self.directory, name)
+            with open(local_path, "wb") as fp:
+                fp.write(data)
+            self.local_paths.append(local_path)
+
+    def put_object(self, container_name, path, contents, headers=None, content_length=None):
+        contents = b"".join(contents)
+        headers = dict((key.lower(), value) for key, value in (headers or {}).items())
+        headers.update({"content-length": str(len(contents)), "etag": hashlib.md5(contents).hexdigest(),
+                        "content-type": "application/octet-stream"})
+        self.objects[path] = (headers, contents)
+
+    def get_object(self, container_name, path, resp_chunk_size=None, headers=None):
+        response_headers, contents = self.objects[path]
+        if resp_chunk_size is None:
+            return dict(response_headers), contents
+        return dict(response_headers), iter([contents[i:i + 1000] for i in range(0, len(contents), 1000)])
+
+    def get_container(self, container_name, prefix=None, marker=None, end_marker=None, limit=None,
+                      delimiter=None, full_listing=False, query_string=None):
+        entries = [{"name": path, "bytes": len(contents), "hash": headers["etag"],
+                    "content_type": headers["content-type"], "last_modified": "2020-01-01T00:00:00.000000"}
+                   for path, (headers, contents) in sorted(self.objects.items())
+                   if path.startswith(prefix or "") and (marker is None or path > marker)]
+        return {}, entries
+
+    def original(self, remote_path):
+        with open(os.path.join(self.directory, remote_path.split("/")[-1]), "rb") as fp:
+            return fp.read()
+
+    def upload(self):
+        remote_paths = self.container.upload(self.local_paths, "dir", compress="gzip", compress_workers=1)
+        self.assertEqual(remote_paths, ["dir/a.txt", "dir/b.txt", "dir/c.dat"])
+        return remote_paths
+
+    def test_upload_compressed(self):
+        for remote_path in self.upload():
+            headers, contents = self.objects[remote_path]
+            self.assertEqual(headers["x-object-meta-codec"], "gzip")
+            self.assertEqual(headers["x-object-meta-uncompressed-size"], str(len(self.original(remote_path))))
+            self.assertEqual(zlib.decompress(contents, 31), self.original(remote_path))
+        self.assertLess(len(self.objects["dir/a.txt"][1]), 3000)
+
+    def test_read_and_download(self):
+        local_directory = tempfile.mkdtemp()
+        for remote_path in self.upload():
+            self.assertEqual(self.container.read(remote_path, decode=False), self.original(remote_path))
+            with open(self.container.download(remote_path, local_directory), "rb") as fp:
+                self.assertEqual(fp.read(), self.original(remote_path))
+
+    def test_iter_contents(self):
+        self.upload()
+        for max_prefetch_bytes in (0, 1000000):  # streamed, or retrieved in advance
+            self.assertEqual([(f.name, contents if isinstance(contents, bytes) else b"".join(contents))
+                              for f, contents in self.container.iter_contents(
+                                  self.container.list(), max_prefetch_bytes=max_prefetch_bytes)],
+                             [(name, self.original(name)) for name in ("dir/a.txt", "dir/b.txt", "dir/c.dat")])
+
+    def test_export_archive(self):
+        self.upload()
+        del self.objects["dir/c.dat"][0]["x-object-meta-uncompressed-size"]  # as for older uploads
+        for max_prefetch_bytes in (0, 1000000):
+            buffer = io.BytesIO()
+            self.container.export_archive("dir", buffer, max_prefetch_bytes=max_prefetch_bytes)
+            buffer.seek(0)
+            archive = tarfile.open(fileobj=buffer)
+            for name in ("dir/a.txt", "dir/b.txt", "dir/c.dat"):
+                self.assertEqual(archive.extractfile(name).read(), self.original(name))
+
+    def test_diff_with_local_directory(self):
+        self.upload()
+        self.assertEqual(list(self.container.diff(self.directory, prefix="dir/")), [])
+        with open(self.local_paths[0], "ab") as fp:
+            fp.write(b"more")
+        self.assertEqual([entry.name for entry in self.container.diff(self.directory, prefix="dir/")],
+                         ["dir/a.txt"])
+
+
+class PublicListingTest(TestCase):
+    """Tests of listing a public container, with a mock server which returns
+    fewer entries per page than requested, as with a low `container_listing_limit`."""
+
+    def setUp(self):
+        self.names = ["file{:02d}.txt".format(i) for i in range(10)]
+        self.requests = []
+        self.container = PublicContainer("https://object.cscs.ch/v1/AUTH_abc/cont")
+        self.container._session = mock.Mock()
+        self.container._session.get.side_effect = self.public_get
+
+    def public_get(self, url, params=None, headers=None):
+        self.requests.append(params.get("marker"))
+        names = [name for name in self.names if params.get("marker") is None or name > params["marker"]]
+        page = [{"name": name, "bytes": 1, "hash": "h", "content_type": "text/plain",
+                 "last_modified": "2020-01-01T00:00:00.000000"} for name in names[:3]]
+        etag = hashlib.md5(repr(page).encode("utf-8")).hexdigest()
+        response = mock.Mock(ok=True, status_code=200, headers={"ETag": etag})
+        if headers and headers.get("If-None-Match") == etag:
+            response.status_code = 304
+        response.json.return_value = page
+        return response
+
+    def test_short_pages(self):
+        self.assertEqual([f.name for f in self.container.list()], self.names)
+        self.assertEqual(self.requests, [None, "file02.txt", "file05.txt", "file08.txt", "file09.txt"])
+
+    def test_count_and_size(self):
+        head = self.container._session.head
+        head.return_value = mock.Mock(ok=True, headers={"X-Container-Object-Count": "10",
+                                                        "X-Container-Bytes-Used": "2048"})
+        self.assertEqual((self.container.count(), self.container.size()), (10, 2048))
+        self.assertEqual(self.container.metadata["x-container-object-count"], "10")
+        self.assertEqual(head.call_count, 1)  # cached for metadata_ttl seconds
+        self.assertEqual(self.requests, [])  # without retrieving the listing
+        self.container.metadata_ttl = 0
+        self.container.count()
+        self.assertEqual(head.call_count, 2)
+
+    def test_refresh(self):
+        self.container.list()
+        self.names.append("file10.txt")
+        self.assertEqual([f.name for f in self.container.list(refresh=True)], self.names)
+        self.assertEqual([f.name for f in self.container.list(refresh=True)], self.names)
+
+
+class ListingContainer(hbp_archive._BaseContainer):
+    """A container whose listing is a sorted list of names held in memory."""
+
+    def __init__(self, names, page_size=hbp_archive.LISTING_PAGE_SIZE):
+        self.names = sorted(names)
+        self.page_size = page_size
+        self.public_url = None
+
+    def _get_listing_page(self, prefix=None, marker=None, end_marker=None, limit=hbp_archive.LISTING_PAGE_SIZE,
+                          delimiter=None, reverse=False):
+        prefix = prefix or ""
+        entries = []
+        for name in self.names:
+            if delimiter and delimiter in name[len(prefix):]:
+                key = name[:name.index(delimiter, len(prefix)) + 1]
+                entry = {"subdir": key}
+            else:
+                key = name
+                entry = {"name": name, "bytes": 1, "hash": "h", "content_type": "text/plain",
+                         "last_modified": "2020-01-01T00:00:00.000000"}
+            if (name.startswith(prefix) and (marker is None or key > marker)
+                    and (end_marker is None or key < end_marker) and (not entries or entries[-1] != entry)):
+                entries.append(entry)
+        if reverse:
+            entries.reverse()
+        return entries[:min(limit, self.page_size)]
+
+
+class SplitPointsTest(TestCase):
+    """Tests of the division of a large listing into ranges by `iter_files`."""
+
+    def assert_balanced(self, names, num_points=15):
+        container = ListingContainer(names)
+        points = container._sample_split_points(None, num_points)
+        self.assertGreater(len(points), num_points // 2)
+        bounds = [None] + points + [None]
+        sizes = [len([name for name in container.names if (lower is None or name > lower)
+                      and (upper is None or name <= upper)])
+                 for lower, upper in zip(bounds[:-1], bounds[1:])]
+        self.assertEqual(sum(sizes), len(names))
+        # no range is more than twice the size it would have if all were equal
+        self.assertLess(max(sizes), 2 * len(names) / len(sizes))
+        self.assertEqual([f.name for f in container.iter_files(workers=4)], container.names)
+
+    def test_flat_numbered_names(self):
+        self.assert_balanced(["file{:06d}.dat".format(i) for i in range(50000)])
+
+    def test_flat_hashed_names(self):
+        self.assert_balanced([hashlib.md5(str(i).encode("utf-8")).hexdigest() for i in range(50000)])
+
+    def test_fixed_split_points(self):
+        container = ListingContainer(["dir{:02d}/file.dat".format(i) for i in range(20)])
+        split_points = container.sample_split_points(3)
+        self.assertEqual(len(split_points), 3)
+        # files added after the split points were chosen still belong to exactly one share
+        container.names = sorted(container.names + ["dir{:02d}/new.dat".format(i) for i in range(0, 20, 3)]
+                                 + ["aaa.dat", "zzz.dat"])
+        shards = [[f.name for f in container.iter_files(shard=i, num_shards=4, partition="range",
+                                                         split_points=split_points)]
+                  for i in range(4)]
+        self.assertEqual(sorted(sum(shards, [])), container.names)
+        self.assertRaises(ValueError, list, container.iter_files(shard=0, num_shards=2, partition="range",
+                                                                 split_points=split_points))
+
+    def test_short_listing(self):
+        names = ["dir{}/file.dat".format(i) for i in range(100)]
+        container = ListingContainer(names)
+        self.assertEqual([f.name for f in container.iter_files(workers=4)], sorted(names))
+
+
+class ObjectsContainer(hbp_archive._BaseContainer):
+    """A container whose objects are held in memory, with a server which
+    may ignore Range headers."""
+
+    def __init__(self, objects, honour_range=True, manifests=None):
+        self.objects = objects  # path: (headers, contents)
+        self.honour_range = honour_range
+        self.manifests = manifests or {}  # path: manifest, for static large objects
+        self.name = "cont"
+        self.public_url = None
+
+    def _get_listing_page(self, prefix=None, marker=None, end_marker=None, limit=hbp_archive.LISTING_PAGE_SIZE,
+                          delimiter=None, reverse=False):
+        return [{"name": path, "bytes": len(contents), "hash": headers.get("etag", "").strip('"'),
+                 "content_type": "application/octet-stream", "last_modified": "2020-01-01T00:00:00.000000"}
+                for path, (headers, contents) in sorted(self.objects.items())
+                if path.startswith(prefix or "") and (marker is None or path > marker)][:limit]
+
+    def _get_slo_manifest(self, file_path):
+        return self.manifests[file_path]
+
+    def _head_object(self, file_path):
+        return dict(self.objects[file_path][0])
+
+    def _get_object(self, file_path, headers=None, chunk_size=hbp_archive.DOWNLOAD_CHUNK_SIZE):
+        response_headers, stream = self._get_object_stream(file_path, headers)
+        return response_headers, iter(lambda: stream.read(chunk_size), b"")
+
+    def _get_object_stream(self, file_path, headers=None):
+        response_headers, contents = self.objects[file_path]
+        response_headers = dict(response_headers)
+        if headers and "Range" in headers and self.honour_range:
+            start, end = headers["Range"].split("=")[1].split("-")
+            start, end = int(start), min(int(end or len(contents) - 1), len(contents) - 1)
+            if start >= len(contents):
+                raise ClientException("Requested Range Not Satisfiable", http_status=416)
+            response_headers["content-range"] = "bytes {}-{}/{}".format(start, end, len(contents))
+            contents = contents[start:end + 1]
+        return response_headers, io.BytesIO(contents)
+
+
+class ReadIntoTest(TestCase):
+    """Tests of reading into a buffer with `read_into`."""
+
+    def setUp(self):
+        self.data = bytes(bytearray(range(256))) * 40
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compressed = compressor.compress(self.data) + compressor.flush()
+        self.objects = {"plain.dat": ({}, self.data),
+                        "compressed.dat": ({"x-object-meta-codec": "gzip"}, compressed)}
+
+    def test_range(self):
+        for honour_range in (True, False):
+            container = ObjectsContainer(self.objects, honour_range)
+            for file_path in ("plain.dat", "compressed.dat"):
+                buffer = bytearray(100)
+                self.assertEqual(container.read_into(file_path, buffer, offset=5000), 100)
+                self.assertEqual(bytes(buffer), self.data[5000:5100])
+                buffer = bytearray(len(self.data))
+                self.assertEqual(container.read_into(file_path, buffer, offset=10), len(self.data) - 10)
+                self.assertEqual(bytes(buffer[:-10]), self.data[10:])
+
+    @skipUnless(hbp_archive.numpy is not None, "NumPy is not installed")
+    def test_load_array(self):
+        import numpy
+        container = ObjectsContainer(self.objects)
+        expected = numpy.frombuffer(self.data, dtype="<u2").reshape(40, 128)
+        for file_path in ("plain.dat", "compressed.dat"):
+            numpy.testing.assert_array_equal(container.load_array(file_path, "<u2", (40, 128)), expected)
+            numpy.testing.assert_array_equal(container.load_array(file_path, "<u2", (128, 40), order="F"),
+                                             expected.T)
+            numpy.testing.assert_array_equal(container.load_array(file_path, "u1", 10, offset=256),
+                                             numpy.arange(10, dtype="u1"))
+            self.assertRaises(IOError, container.load_array, file_path, "<u2", (41, 128))
+
+    def test_offset_beyond_stored_size(self):
+        container = ObjectsContainer(self.objects)
+        offset = len(self.objects["compressed.dat"][1]) + 10  # still within the decompressed contents
+        buffer = bytearray(10)
+        self.assertEqual(container.read_into("compressed.dat", buffer, offset=offset), 10)
+        self.assertEqual(bytes(buffer), self.data[offset:offset + 10])
+        self.assertEqual(container.read_into("plain.dat", buffer, offset=len(self.data)), 0)
+
+
+class ManyFilesTest(TestCase):
+    """Tests of reading all the files of an in-memory container, with
+    `iter_contents` and `scrub`."""
+
+    def setUp(self):
+        self.small = os.urandom(100)
+        self.segments = [os.urandom(1000), os.urandom(500)]
+        manifest = [{"name": "/cont_segments/big.dat/{}".format(i), "hash": hashlib.md5(segment).hexdigest(),
+                     "bytes": len(segment)} for i, segment in enumerate(self.segments)]
+        # the ETag of a static large object is the checksum of the checksums of its segments
+        etag = hashlib.md5("".join(segment["hash"] for segment in manifest).encode("ascii")).hexdigest()
+        self.container = ObjectsContainer(
+            {"big.dat": ({"etag": '"{}"'.format(etag), "x-static-large-object": "True"}, b"".join(self.segments)),
+             "small.dat": ({"etag": hashlib.md5(self.small).hexdigest()}, self.small)},
+            manifests={"big.dat": manifest})
+
+    def test_iter_contents(self):
+        contents = list(self.container.iter_contents(self.container.iter_files(), prefetch=1,
+                                                     max_prefetch_bytes=1200))
+        self.assertEqual([f.name for f, data in contents], ["big.dat", "small.dat"])
+        # files larger than max_prefetch_bytes are streamed rather than retrieved in advance
+        self.assertNotIsInstance(contents[0][1], bytes)
+        self.assertEqual(b"".join(contents[0][1]), b"".join(self.segments))
+        self.assertEqual(contents[1][1], self.small)
+
+    def test_scrub(self):
+        report = self.container.scrub()
+        self.assertTrue(report.ok)
+        self.assertEqual((report.verified, report.bytes_verified), (2, 1600))
+
+    def test_scrub_corrupted(self):
+        headers, contents = self.container.objects["big.dat"]
+        self.container.objects["big.dat"] = (headers, contents[:1200] + b"x" + contents[1201:])
+        headers, contents = self.container.objects["small.dat"]
+        self.container.objects["small.dat"] = (headers, b"x" + contents[1:])
+        report = self.container.scrub(workers=2)
+        self.assertEqual(report.verified, 0)
+        self.assertEqual(report.corrupted["big.dat"], "segment /cont_segments/big.dat/1 does not match its checksum")
+        self.assertIn("does not match ETag", report.corrupted["small.dat"])
+
+    def test_scrub_checkpoint(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), "scrub.json")
+        with open(checkpoint, "w") as fp:
+            json.dump({"marker": "big.dat", "verified": 1, "bytes_verified": 1500, "corrupted": {},
+                       "unverified": [], "failed": {}}, fp)
+        with mock.patch.object(ObjectsContainer, "_get_object", autospec=True,
+                               side_effect=ObjectsContainer._get_object) as get_object:
+            report = self.container.scrub(checkpoint=checkpoint)
+        self.assertEqual([call[0][1] for call in get_object.call_args_list], ["small.dat"])
+        self.assertEqual((report.verified, report.bytes_verified), (2, 1600))
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+class ResumeDownloadTest(TestCase):
+    """Tests of resuming interrupted downloads, with an in-memory container
+    whose connection breaks after each chunk."""
+
+    def setUp(self):
+        self.data = os.urandom(10000)
+        self.container = ObjectsContainer({"data.bin": ({"content-length": str(len(self.data)),
+                                                         "etag": hashlib.md5(self.data).hexdigest()}, self.data)})
+        get_object = self.container._get_object
+
+        def flaky_get_object(file_path, headers=None, chunk_size=None):
+            response_headers, chunks = get_object(file_path, headers=headers, chunk_size=1000)
+
+            def broken():
+                for i, chunk in enumerate(chunks):
+                    if i == 1:
+                        raise IOError("Connection reset")
+                    yield chunk
+            return response_headers, broken()
+        self.container._get_object = flaky_get_object
+        self.local_path = os.path.join(tempfile.mkdtemp(), "data.bin")
+
+    def test_retries_reset_by_progress(self):
+        self.container._download_to("data.bin", self.local_path, retries=1)
+        with open(self.local_path, "rb") as fp:
+            self.assertEqual(fp.read(), self.data)
+
+    def test_unreadable_checkpoint(self):
+        with mock.patch("hbp_archive._read_checkpoint", return_value=None):
+            with self.assertRaises(IOError) as context:
+                self.container._download_to("data.bin", self.local_path, retries=2)
+        self.assertEqual(str(context.exception), "Connection reset")
+
+
+@skipUnless(fsspec_available, "fsspec is not installed")
+class FileSystemTest(TestCase):
+    """Tests of HBPArchiveFileSystem, with an in-memory container."""
+
+    def setUp(self):
+        self.data = bytes(bytearray(range(256))) * 400
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compressed = compressor.compress(self.data) + compressor.flush()
+        codec = {"content-length": str(len(compressed)), "x-object-meta-codec": "gzip"}
+        self.container = ObjectsContainer({
+            "plain.dat": ({"content-length": str(len(self.data))}, self.data),
+            "compressed.dat": (dict(codec, **{"x-object-meta-uncompressed-size": str(len(self.data))}), compressed),
+            "old.dat": (codec, compressed)})  # compressed before the uncompressed size was recorded
+        self.container._get_object_stream = mock.Mock(side_effect=self.container._get_object_stream)
+        self.fs = HBPArchiveFileSystem(skip_instance_cache=True)
+        self.fs._containers[("AUTH_abc", "cont")] = self.container
+
+    def test_info(self):
+        self.assertEqual(self.fs.info("AUTH_abc/cont/plain.dat")["size"], len(self.data))
+        self.assertEqual(self.fs.info("AUTH_abc/cont/compressed.dat")["size"], len(self.data))
+        self.assertIsNone(self.fs.info("AUTH_abc/cont/old.dat")["size"])
+        self.assertFalse(self.container._get_object_stream.called)
+
+    def test_read(self):
+        for name in ("plain.dat", "compressed.dat", "old.dat"):
+            path = "hbp://AUTH_abc/cont/" + name
+            with self.fs.open(path, block_size=1000) as fp:
+                self.assertEqual(fp.read(), self.data)
+                fp.seek(500)
+                self.assertEqual(fp.read(10), self.data[500:510])
+            self.assertEqual(self.fs.cat_file(path, 100, 200), self.data[100:200])
+            self.assertEqual(self.fs.cat_file(path, -10), self.data[-10:])
+
+    def test_sequential_read_compressed(self):
+        with self.fs.open("AUTH_abc/cont/compressed.dat", block_size=1000) as fp:
+            self.assertEqual(b"".join(iter(lambda: fp.read(1000), b"")), self.data)
+        self.assertEqual(self.container._get_object_stream.call_count, 1)
+
+
+class ShortPagesTest(TestCase):
+    """Tests of listing a container whose server returns fewer entries per
+    page than requested, as with a low `container_listing_limit`."""
+
+    def setUp(self):
+        self.names = ["dir{}/file{}.txt".format(i, j) for i in range(4) for j in range(5)]
+        self.container = ListingContainer(self.names, page_size=3)
+
+    def test_iter_listing(self):
+        self.assertEqual([entry["name"] for entry in self.container._iter_listing()], self.names)
+        self.assertEqual([entry.get("subdir") for entry in self.container._iter_listing(delimiter="/")],
+                         ["dir0/", "dir1/", "dir2/", "dir3/"])
+
+    def test_iter_files(self):
+        self.assertEqual([f.name for f in self.container.iter_files()], self.names)
+        self.assertEqual([f.name for f in self.container.iter_files(workers=3, split_points=["dir1/", "dir2/"])],
+                         self.names)
+        shards = [[f.name for f in self.container.iter_files(shard=i, num_shards=2, partition="range")]
+                  for i in range(2)]
+        self.assertEqual(sorted(sum(shards, [])), self.names)
+
+
+class PickleTest(TestCase):
+    """Tests of pickling archive objects, e.g. to send them to other processes."""
+
+    def setUp(self):
+        archive = Archive.__new__(Archive)
+        archive.username = "someone"
+        archive.user_id = "u1"
+        archive._session = mock.Mock()
+        archive._session.get_token.return_value = "unscoped-token"
+        archive._ks_projects = {"proj": hbp_archive._KeystoneProject("abc", "proj")}
+        archive._projects = None
+        self.container = Container("cont", "someone", project=Project("proj", "someone", archive=archive))
+        self.container._metadata = {}  # private container
+        self.container.project._user_id_map = {}
+        self.auth = ("https://object.cscs.ch/v1/AUTH_abc", "scoped-token")
+
+    def test_round_trip(self):
+        f = File("a.txt", 1, "text/plain", "h", "2020-01-01T00:00:00.000000", container=self.container)
+        with mock.patch.object(Project, "_connection", new_callable=mock.PropertyMock) as connection:
+            connection.return_value.get_auth.return_value = self.auth
+            restored = pickle.loads(pickle.dumps(f))
+        self.assertEqual((restored.name, restored.container.name), ("a.txt", "cont"))
+        project = restored.container.project
+        self.assertEqual((project.id, project.name), ("abc", "proj"))
+        self.assertEqual(project.archive._ks_projects["proj"].id, "abc")
+        self.assertEqual(project.archive._session.auth.auth_methods[0].token, "unscoped-token")
+        # the unpickled project connects with the scoped token, without authenticating again
+        self.assertEqual(project._get_auth(), self.auth)
+        connection = project._connection
+        self.assertEqual((connection.url, connection.token), self.auth)
+        self.assertIs(project._connection, connection)
+
+        connections = []
+        thread = threading.Thread(target=lambda: connections.append(project._connection))
+        thread.start()
+        thread.join()
+        self.assertIsNot(connections[0], connection)  # swiftclient connections are not thread-safe
+        self.assertEqual((connections[0].url, connections[0].token), self.auth)
+        # and can be pickled again, keeping the scoped token
+        with mock.patch.object(hbp_archive.session.Session, "get_token", return_value="unscoped-token"):
+            self.assertEqual(pickle.loads(pickle.dumps(project))._preauth, self.auth)
+
+
+class SetAccessTest(TestCase):
+    """Tests of Project.set_access, with a mock connection."""
+
+    def setUp(self):
+        self.connection = mock.Mock()
+        self.connection.head_container.return_value = {"x-container-read": "abc:u1"}
+        self.project = mock_project(self, _connection=self.connection, users={"u1": "alice", "u2": "bob"})
+
+    def test_single_user(self):
+        result = self.project.set_access("cont", "bob")
+        self.assertEqual(result.completed, {"cont": {"added": ["bob"], "removed": []}})
+        self.connection.post_container.assert_called_once_with("cont", {"x-container-read": "abc:u1,abc:u2"})
+        self.assertRaises(ValueError, self.project.set_access, ["cont"], "carol")
+
+    def test_revoke(self):
+        result = self.project.set_access(["cont", "other"], ["alice", "bob"], action="revoke")
+        self.assertEqual(result.completed, {"cont": {"added": [], "removed": ["alice"]},
+                                            "other": {"added": [], "removed": ["alice"]}})
+        self.assertEqual(self.connection.post_container.call_args[0][1], {"x-container-read": ""})
+
+    def test_set_keeps_unmanaged_grants(self):
+        self.connection.head_container.return_value = {
+            "x-container-read": ".r:example.com,abc:u1,other:*,other:u2,abc:*"}
+        result = self.project.set_access("cont", ["bob", "PUBLIC"], action="set")
+        self.assertEqual(result.completed, {"cont": {"added": ["PUBLIC", "bob"], "removed": ["alice"]}})
+        self.connection.post_container.assert_called_once_with("cont", {
+            "x-container-read": ".r:example.com,other:*,other:u2,abc:*,.r:*,.rlistings,abc:u2"})
+
+
+class UpdateMetadataTest(TestCase):
+    """Tests of Container.update_metadata, with a mock connection."""
+
+    def setUp(self):
+        self.container = mock_container()
+        self.container._metadata = {}
+        self.connection = self.container.project._connection
+        self.connection.head_object.return_value = {
+            "content-length": "10", "content-type": "application/octet-stream", "etag": "h",
+            "last-modified": "Wed, 01 Jan 2020 00:00:00 GMT", "content-encoding": "identity",
+            "content-disposition": "attachment", "x-delete-at": "1900000000",
+            "x-object-meta-codec": "gzip", "x-object-meta-experiment": "A"}
+
+    def test_update(self):
+        result = self.container.update_metadata({"data.bin": {"experiment": None, "run": 2,
+                                                              "content-type": "application/x-test"}})
+        self.assertEqual(list(result.completed), ["data.bin"])
+        self.assertEqual(result.completed["data.bin"].metadata, {"codec": "gzip", "run": "2"})
+        self.connection.post_object.assert_called_once_with("cont", "data.bin", {
+            "X-Object-Meta-codec": "gzip", "X-Object-Meta-run": "2", "Content-Type": "application/x-test",
+            "content-encoding": "identity", "content-disposition": "attachment", "x-delete-at": "1900000000"})